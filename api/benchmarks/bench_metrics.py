@@ -0,0 +1,69 @@
+"""Per request overhead of the metrics middleware
+
+Sends requests straight through the ASGI interface of a bare Starlette app
+with and without MetricsMiddleware, so the difference is the cost of
+recording the request count, latency and in flight gauge.
+
+    cd api && python benchmarks/bench_metrics.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("DATABASE_TYPE", "sqlite")
+os.environ.setdefault("CONNECTION_URI", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+from src import metrics  # noqa: E402
+
+
+async def endpoint(request):
+    return Response(b"{}", media_type="application/json")
+
+
+def build(with_metrics):
+    app = Starlette(routes=[Route("/apps/{app_id}/users/{user_id}/sessions/{session_id}", endpoint)])
+    if with_metrics:
+        app.add_middleware(metrics.MetricsMiddleware)
+    return app
+
+
+async def bench(app, number):
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "root_path": "",
+        "path": "/apps/app/users/user/sessions/1", "raw_path": b"/apps/app/users/user/sessions/1",
+        "query_string": b"", "headers": [], "server": ("test", 80), "client": ("test", 1234),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(1000):
+        await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(number):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / number
+
+
+async def main():
+    number = 20000
+    before = await bench(build(False), number)
+    after = await bench(build(True), number)
+    print(f"  without metrics {before * 1e6:6.1f} us per request")
+    print(f"  with metrics    {after * 1e6:6.1f} us per request (+{(after - before) * 1e6:.1f} us)")
+    start = time.perf_counter()
+    metrics.registry.render()
+    print(f"  render /metrics {(time.perf_counter() - start) * 1e6:6.1f} us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,36 @@
+"""Overhead of taking a token from each rate limit store
+
+    cd api && python benchmarks/bench_ratelimit.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_TYPE", "sqlite")
+os.environ.setdefault("CONNECTION_URI", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src import ratelimit  # noqa: E402
+
+
+async def bench(store, number):
+    limit = ratelimit.Limit.parse("1000000/second")
+    keys = [f"read:app-{i}" for i in range(100)]
+    start = time.perf_counter()
+    for i in range(number):
+        await store.acquire(keys[i % len(keys)], limit)
+    return (time.perf_counter() - start) / number
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        stores = [ratelimit.MemoryStore(), ratelimit.SQLiteStore(os.path.join(directory, "buckets.db"))]
+        for store in stores:
+            seconds = await bench(store, 20000)
+            print(f"  {store.name:<7} {seconds * 1e6:8.1f} us per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""Time to turn a 50 item page of ORM rows into a response body
+
+Compares the response_model path FastAPI takes when a route returns ORM
+objects (build the Page, validate it against the response model, dump it to
+JSON compatible data and encode) with the serializers used by the routes.
+
+    cd api && python benchmarks/bench_serialization.py
+"""
+import datetime
+import os
+import sys
+import timeit
+import uuid
+
+os.environ.setdefault("DATABASE_TYPE", "sqlite")
+os.environ.setdefault("CONNECTION_URI", "sqlite://")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi_pagination import Page, Params  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+from src import codec, models, schemas, serializers  # noqa: E402
+
+PAGE_SIZE = 50
+
+
+def rows():
+    now = datetime.datetime.utcnow()
+    session_id = uuid.uuid4()
+    collection_id = uuid.uuid4()
+    return {
+        "session": [
+            models.Session(id=uuid.uuid4(), app_id="app", user_id="user", location_id="default", is_active=True,
+                           h_metadata={"index": i}, created_at=now)
+            for i in range(PAGE_SIZE)
+        ],
+        "message": [
+            models.Message(id=uuid.uuid4(), session_id=session_id, is_user=i % 2 == 0, content=f"message {i}" * 20,
+                           created_at=now)
+            for i in range(PAGE_SIZE)
+        ],
+        "document": [
+            models.Document(id=uuid.uuid4(), collection_id=collection_id, content=f"document {i}" * 50,
+                            h_metadata={"index": i}, created_at=now)
+            for i in range(PAGE_SIZE)
+        ],
+    }
+
+
+def response_model_path(schema, items):
+    params = Params(page=1, size=PAGE_SIZE)
+    page = Page[schema].create(items, params, total=len(items))
+    adapter = TypeAdapter(Page[schema])
+    validated = adapter.validate_python(page, from_attributes=True)
+    return codec.dumps(jsonable_encoder(adapter.dump_python(validated, mode="json")))
+
+
+def serializer_path(serialize, items):
+    body = {"items": [serialize(row) for row in items], "total": len(items), "page": 1, "size": PAGE_SIZE, "pages": 1}
+    return codec.dumps(body)
+
+
+def main():
+    number = 500
+    data = rows()
+    cases = [
+        ("session", schemas.Session, serializers.session),
+        ("message", schemas.Message, serializers.message),
+        ("document", schemas.Document, serializers.document),
+    ]
+    print(f"{PAGE_SIZE} item pages, codec backend {codec.BACKEND}")
+    for name, schema, serialize in cases:
+        items = data[name]
+        before = timeit.timeit(lambda: response_model_path(schema, items), number=number) / number
+        after = timeit.timeit(lambda: serializer_path(serialize, items), number=number) / number
+        print(f"  {name:<9} response_model {before * 1e6:8.1f} us  serializers {after * 1e6:8.1f} us  {before / after:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Cold archival of inactive sessions: python -m src.archive
+
+Sessions that were deleted (made inactive) more than ARCHIVE_AFTER_DAYS
+days ago are moved out of the sessions, messages and
+metamessages tables into session_archives, one zlib compressed JSON
+document per session holding the same dicts the API returns. The hot
+tables and their indexes then only hold sessions still in use.
+
+Archived sessions are read only. The GET routes for a session, its
+messages and its metamessages fall back to the archive when the hot tables
+have nothing, so clients see no difference apart from writes answering 404.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session, defer
+
+from . import codec, models, serializers
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+
+
+class ArchivedSession:
+    """The contents of a session_archives row
+
+    The data is decompressed on first use and kept, so answering with an
+    ETag alone never reads it and every later use shares one copy.
+    """
+    __slots__ = ("id", "archived_at", "_row", "_data")
+
+    def __init__(self, row: models.SessionArchive):
+        self.id = row.id
+        self.archived_at = row.archived_at
+        self._row: Optional[models.SessionArchive] = row
+        self._data: Optional[Dict[str, Any]] = None
+
+    def _contents(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = codec.loads(zlib.decompress(self._row.data))
+            self._row = None
+            # Archived before messages had seqs, they were stored in created_at order
+            for seq, message in enumerate(self._data["messages"], 1):
+                message.setdefault("seq", seq)
+        return self._data
+
+    @property
+    def session(self) -> Dict[str, Any]:
+        return self._contents()["session"]
+
+    @property
+    def messages(self) -> List[Dict[str, Any]]:
+        return self._contents()["messages"]
+
+    @property
+    def metamessages(self) -> List[Dict[str, Any]]:
+        return self._contents()["metamessages"]
+
+    def messages_after(self, after_seq: Optional[int] = None) -> List[Dict[str, Any]]:
+        return [message for message in self.messages if after_seq is None or message["seq"] > after_seq]
+
+    def message(self, message_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        return next((message for message in self.messages if message["id"] == str(message_id)), None)
+
+    def find_metamessages(
+        self, message_id: Optional[uuid.UUID] = None, metamessage_type: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        return [
+            metamessage for metamessage in self.metamessages
+            if (message_id is None or metamessage["message_id"] == str(message_id))
+            and (metamessage_type is None or metamessage["metamessage_type"] == metamessage_type)
+        ]
+
+
+def load(db: Session, app_id: str, user_id: str, session_id: uuid.UUID) -> Optional[ArchivedSession]:
+    """The archived session of a user, or None if the session is not archived
+
+    The compressed data is only fetched when the contents are first read.
+    """
+    row = db.scalars(
+        select(models.SessionArchive)
+        .options(defer(models.SessionArchive.data))
+        .where(models.SessionArchive.id == session_id)
+        .where(models.SessionArchive.app_id == app_id)
+        .where(models.SessionArchive.user_id == user_id)
+    ).one_or_none()
+    return ArchivedSession(row) if row is not None else None
+
+
+def compress(session: models.Session, messages: List[models.Message], metamessages: List[models.Metamessage]) -> bytes:
+    return zlib.compress(codec.dumps({
+        "session": serializers.session(session),
+        "messages": [serializers.message(message) for message in messages],
+        "metamessages": [serializers.metamessage(metamessage) for metamessage in metamessages],
+    }), 6)
+
+
+def archive_batch(db: Session, cutoff: datetime.datetime, batch_size: int = BATCH_SIZE) -> List[Tuple[str, str, uuid.UUID]]:
+    """Archive up to batch_size sessions deleted before cutoff in one transaction
+
+    Returns:
+        list[tuple]: The app ID, user ID and ID of each archived session
+    """
+    sessions = db.scalars(
+        select(models.Session)
+        .where(models.Session.is_active.is_(False))
+        .where(models.Session.deactivated_at < cutoff)
+        .order_by(models.Session.deactivated_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not sessions:
+        return []
+    ids = [session.id for session in sessions]
+    keys = [(session.app_id, session.user_id, session.id) for session in sessions]
+
+    messages: Dict[uuid.UUID, List[models.Message]] = {session_id: [] for session_id in ids}
+    for message in db.scalars(
+        select(models.Message).where(models.Message.session_id.in_(ids)).order_by(models.Message.session_id, models.Message.seq)
+    ):
+        messages[message.session_id].append(message)
+    metamessages: Dict[uuid.UUID, List[models.Metamessage]] = {session_id: [] for session_id in ids}
+    for metamessage, session_id in db.execute(
+        select(models.Metamessage, models.Message.session_id)
+        .join(models.Message, models.Message.id == models.Metamessage.message_id)
+        .where(models.Message.session_id.in_(ids))
+        .order_by(models.Metamessage.created_at)
+    ):
+        metamessages[session_id].append(metamessage)
+
+    db.add_all(
+        models.SessionArchive(
+            id=session.id,
+            app_id=session.app_id,
+            user_id=session.user_id,
+            location_id=session.location_id,
+            created_at=session.created_at,
+            data=compress(session, messages[session.id], metamessages[session.id]),
+        )
+        for session in sessions
+    )
+    message_ids = select(models.Message.id).where(models.Message.session_id.in_(ids))
+    db.execute(delete(models.Metamessage).where(models.Metamessage.message_id.in_(message_ids)), execution_options={"synchronize_session": False})
+    db.execute(delete(models.Message).where(models.Message.session_id.in_(ids)), execution_options={"synchronize_session": False})
+    db.execute(delete(models.Session).where(models.Session.id.in_(ids)), execution_options={"synchronize_session": False})
+    db.commit()
+    return keys
+
+
+def archive_inactive(days: float, batch_size: int = BATCH_SIZE) -> int:
+    """Archive every session deleted more than days ago, returning how many were archived"""
+    from .crud import _invalidate_session
+    from .db import SessionLocal
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    archived = 0
+    while True:
+        with SessionLocal() as db:
+            keys = archive_batch(db, cutoff, batch_size)
+        for app_id, user_id, session_id in keys:
+            _invalidate_session(app_id, user_id, session_id)
+        if not keys:
+            return archived
+        archived += len(keys)
+        logger.info("Archived %d sessions", archived)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.archive", description="Archive inactive sessions")
+    parser.add_argument("--days", type=float, default=float(os.getenv("ARCHIVE_AFTER_DAYS", 90)),
+                        help="Archive sessions deleted more than this many days ago")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Sessions archived per transaction")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    logger.info("Archived %d sessions in total", archive_inactive(args.days, args.batch_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
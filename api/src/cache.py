@@ -0,0 +1,195 @@
+"""Cache for the session and collection lookups made on almost every request
+
+Rows are cached as pickled dicts of their column values under keys built from
+(app_id, user_id, id or name) and rebuilt as detached model instances, so a
+cached row can be read and serialized but never flushed. Code that modifies a
+row must load it with the uncached query and invalidate it once committed.
+
+Backends only store bytes under string keys so a shared store can replace
+the in-process one. The SQLite backend stands in for one such store and is
+shared by every worker on a host; the memory backend is private to a worker
+and relies on the TTL to bound how stale other workers' copies can be.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+from sqlalchemy import inspect
+
+T = TypeVar("T")
+
+
+class MemoryBackend:
+    """LRU of bytes with a time to live, private to the process"""
+
+    name = "memory"
+
+    def __init__(self, capacity: int = 10000, ttl: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteBackend:
+    """Key value table in a SQLite file shared by every worker on the host"""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, capacity: int = 10000, ttl: float = 30.0, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS lookup_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM lookup_cache WHERE key = ? AND expires_at > ?", (key, self.clock())
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO lookup_cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, self.clock() + self.ttl),
+        )
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._prune(connection)
+
+    def _prune(self, connection: sqlite3.Connection) -> None:
+        """Drop expired entries then the ones closest to expiring beyond capacity"""
+        connection.execute("DELETE FROM lookup_cache WHERE expires_at <= ?", (self.clock(),))
+        connection.execute(
+            "DELETE FROM lookup_cache WHERE key IN "
+            "(SELECT key FROM lookup_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.capacity,),
+        )
+
+    def delete(self, *keys: str) -> None:
+        self._connection().executemany("DELETE FROM lookup_cache WHERE key = ?", [(key,) for key in keys])
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM lookup_cache")
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT count(*) FROM lookup_cache").fetchone()[0]
+
+
+class LookupCache:
+    """Caches model rows by key and counts hits, misses and invalidations"""
+
+    def __init__(self, backend: Optional[Any]):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(kind: str, app_id: str, user_id: Optional[str], identifier: Any) -> str:
+        return "\x1f".join((kind, app_id, user_id or "", str(identifier)))
+
+    def get_or_load(self, model: Type[T], key: str, load: Callable[[], Optional[T]], store: bool = True) -> Optional[T]:
+        """Return the cached row for key or load it and cache it if it exists
+
+        Pass store=False when load reads a replica, a lagging replica could
+        otherwise put a row back in the cache just after it was invalidated.
+        """
+        if self.backend is None:
+            return load()
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return model(**pickle.loads(value))
+        self.misses += 1
+        row = load()
+        if row is not None and store:
+            columns = {attr.key: getattr(row, attr.key) for attr in inspect(model).column_attrs}
+            self.backend.set(key, pickle.dumps(columns, protocol=pickle.HIGHEST_PROTOCOL))
+        return row
+
+    def invalidate(self, *keys: str) -> None:
+        if self.backend is None:
+            return
+        self.invalidations += 1
+        self.backend.delete(*keys)
+
+    def clear(self) -> None:
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": None if self.backend is None else self.backend.name,
+            "size": 0 if self.backend is None else len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def from_env() -> LookupCache:
+    """Build the cache configured by the LOOKUP_CACHE_* environment variables"""
+    backend = os.getenv("LOOKUP_CACHE_BACKEND", "memory")
+    capacity = int(os.getenv("LOOKUP_CACHE_SIZE", 10000))
+    ttl = float(os.getenv("LOOKUP_CACHE_TTL", 30))
+    if backend == "memory":
+        return LookupCache(MemoryBackend(capacity, ttl))
+    if backend == "sqlite":
+        return LookupCache(SQLiteBackend(os.getenv("LOOKUP_CACHE_PATH", "/tmp/honcho-lookup-cache.db"), capacity, ttl))
+    if backend == "none":
+        return LookupCache(None)
+    raise ValueError(f"Unknown LOOKUP_CACHE_BACKEND {backend}")
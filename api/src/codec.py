@@ -0,0 +1,57 @@
+"""JSON encoding for API responses
+
+Uses orjson or msgspec when one of them is installed and falls back to the
+standard library otherwise.
+"""
+import datetime
+import json
+import uuid
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+from . import tracing
+
+
+def _default(obj: Any):
+    """Encode the types the fast codecs support natively"""
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+        dumps = _encoder.encode
+        loads = _decoder.decode
+    except ImportError:
+        BACKEND = "json"
+
+        def dumps(obj: Any) -> bytes:
+            return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        loads = json.loads
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the fastest available codec"""
+
+    def render(self, content: Any) -> bytes:
+        with tracing.span("serialize"):
+            return dumps(content)
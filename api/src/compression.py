@@ -0,0 +1,218 @@
+"""Response compression negotiation and compressed request bodies
+
+Responses at least `minimum_size` bytes long are compressed with zstd or gzip
+depending on the client's Accept-Encoding. zstd is only offered when the
+optional `zstandard` package is installed. Request bodies sent with a gzip or
+zstd Content-Encoding are decompressed before they reach the routes.
+"""
+import io
+import zlib
+from typing import Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+# Decompressed request bodies larger than this are rejected to guard against
+# compression bombs. Documents are at most 64 KB so this leaves ample room
+MAX_REQUEST_BODY_SIZE = 16 * 1024 * 1024
+
+# Content types that are already compressed or must reach the client unbuffered
+EXCLUDED_CONTENT_TYPES = ("text/event-stream", "application/gzip", "application/zstd")
+
+
+def supported_encodings() -> List[str]:
+    """Encodings the server can produce in order of preference"""
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Pick the preferred supported encoding the client accepts
+
+    Args:
+        accept_encoding (str): The value of the Accept-Encoding header
+
+    Returns:
+        str | None: The encoding to use or None to send the body as is
+    """
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding] = quality
+    wildcard = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _Compressor:
+    """Streaming compressor for a single response"""
+
+    def __init__(self, encoding: str, level: int):
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def decompress(body: bytes, encoding: str, limit: int = MAX_REQUEST_BODY_SIZE) -> bytes:
+    """Decompress a request body
+
+    Raises:
+        ValueError: If the encoding is unsupported, the data is corrupt or it exceeds limit once decompressed
+    """
+    try:
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            data = decompressor.decompress(body, limit + 1)
+            if not decompressor.eof and len(data) <= limit:
+                raise ValueError("Truncated gzip body")
+        elif encoding == "zstd" and zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                data = reader.read(limit + 1)
+        else:
+            raise ValueError(f"Unsupported Content-Encoding {encoding}")
+    except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+        raise ValueError("Corrupt request body") from e
+    if len(data) > limit:
+        raise ValueError("Request body too large")
+    return data
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses and decompressing request bodies"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, zstd_level: int = 3) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "zstd": zstd_level}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        request_encoding = headers.get("content-encoding", "").strip().lower()
+        if request_encoding not in ("", "identity"):
+            chunks = []
+            more_body = True
+            while more_body:
+                message = await receive()
+                chunks.append(message.get("body", b""))
+                more_body = message.get("more_body", False)
+            try:
+                body = decompress(b"".join(chunks), request_encoding)
+            except ValueError as e:
+                status = 413 if "too large" in str(e) else 415 if "Unsupported" in str(e) else 400
+                await PlainTextResponse(str(e), status_code=status)(scope, receive, send)
+                return
+            scope = dict(scope)
+            scope["headers"] = [
+                (key, value) for key, value in scope["headers"]
+                if key not in (b"content-encoding", b"content-length")
+            ] + [(b"content-length", str(len(body)).encode())]
+            receive = _replay(body, receive)
+
+        encoding = negotiate(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(self.app, encoding, self.levels[encoding], self.minimum_size)
+        await responder(scope, receive, send)
+
+
+def _replay(body: bytes, receive: Receive) -> Receive:
+    """Receive callable returning an already read body then deferring to the original"""
+    sent = False
+
+    async def replay() -> Message:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, level: int, minimum_size: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.send: Optional[Send] = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+        self.compressor: Optional[_Compressor] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Hold the headers back until the first body chunk shows whether to compress
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            self.passthrough = "content-encoding" in headers or headers.get("content-type", "").startswith(EXCLUDED_CONTENT_TYPES)
+            return
+        if message_type != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            if self.passthrough or (len(body) < self.minimum_size and not more_body):
+                self.passthrough = True
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+            self.compressor = _Compressor(self.encoding, self.level)
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            compressed = self.compressor.compress(body)
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                compressed += self.compressor.finish()
+                headers["Content-Length"] = str(len(compressed))
+            await self.send(self.initial_message)
+            await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+            return
+
+        if self.passthrough:
+            await self.send(message)
+            return
+        compressed = self.compressor.compress(body)
+        if not more_body:
+            compressed += self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
@@ -1,40 +1,105 @@
 import uuid
 import datetime
+import threading
 from typing import Optional, Sequence
 
 from openai import OpenAI
 
-from sqlalchemy import select, Select
+from sqlalchemy import bindparam, func, insert, select, tuple_, Select
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 
-from . import models, schemas
+from . import cache, deletion, events, metrics, models, partitioning, replicas, schemas, search, stats, tracing
 
-openai_client = OpenAI()
+_openai_client: Optional[OpenAI] = None
+_openai_lock = threading.Lock()
 
-def get_session(db: Session, app_id: str, session_id: uuid.UUID, user_id: Optional[str] = None) -> Optional[models.Session]:
+def openai_client() -> OpenAI:
+    """The OpenAI client, created on first use so importing the app has no side effects"""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_lock:
+            if _openai_client is None:
+                _openai_client = OpenAI()
+    return _openai_client
+
+def close_openai_client() -> None:
+    """Close the OpenAI client's connections if it was created"""
+    global _openai_client
+    with _openai_lock:
+        client, _openai_client = _openai_client, None
+    if client is not None:
+        client.close()
+
+# Sessions and collections are looked up on almost every request
+lookup_cache = cache.from_env()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+def embed(text: str) -> list[float]:
+    """Embed text with the embedding provider, recording latency and errors"""
+    try:
+        with tracing.span("embeddings.create", tracing.CLIENT, {"gen_ai.request.model": EMBEDDING_MODEL}), \
+                metrics.embedding_duration.time(EMBEDDING_MODEL):
+            response = openai_client().embeddings.create(input=text, model=EMBEDDING_MODEL)
+    except Exception as e:
+        metrics.embedding_errors.inc(EMBEDDING_MODEL, type(e).__name__)
+        raise
+    return response.data[0].embedding
+
+def _select_session(db: Session, app_id: str, session_id: uuid.UUID, user_id: Optional[str] = None) -> Optional[models.Session]:
     stmt = select(models.Session).where(models.Session.app_id == app_id).where(models.Session.id == session_id)
     if user_id is not None:
         stmt = stmt.where(models.Session.user_id == user_id)
     session = db.scalars(stmt).one_or_none()
     return session
 
+@tracing.traced
+def get_session(
+    db: Session, app_id: str, session_id: uuid.UUID, user_id: Optional[str] = None, cached: bool = True
+) -> Optional[models.Session]:
+    """Get a session through the lookup cache. The result is detached when cached so it must not be modified
+
+    Pass cached=False for an up to date message_count and last_message_at,
+    which change with every message without invalidating the cache.
+    """
+    if not cached:
+        return _select_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
+    key = lookup_cache.key("session", app_id, user_id, session_id)
+    return lookup_cache.get_or_load(
+        models.Session, key, lambda: _select_session(db, app_id=app_id, session_id=session_id, user_id=user_id),
+        store=not replicas.is_replica(db),
+    )
+
+def _invalidate_session(app_id: str, user_id: str, session_id: uuid.UUID):
+    lookup_cache.invalidate(
+        lookup_cache.key("session", app_id, user_id, session_id),
+        lookup_cache.key("session", app_id, None, session_id),
+    )
+
+@tracing.traced
 def get_sessions(
-        db: Session, app_id: str, user_id: str, location_id: str | None = None
+        db: Session, app_id: str, user_id: str, location_id: str | None = None, order_by: str = "created_at"
 ) -> Select:
+    """Active sessions oldest first, or with order_by="last_activity" the most recently active first"""
     stmt = (
         select(models.Session)
         .where(models.Session.app_id == app_id)
         .where(models.Session.user_id == user_id)
         .where(models.Session.is_active.is_(True))
-        .order_by(models.Session.created_at)
     )
+    if order_by == "last_activity":
+        # Served by ix_sessions_active_app_user_activity
+        stmt = stmt.order_by(func.coalesce(models.Session.last_message_at, models.Session.created_at).desc())
+    else:
+        stmt = stmt.order_by(models.Session.created_at)
 
     if location_id is not None:
         stmt = stmt.where(models.Session.location_id == location_id)
 
     return stmt
 
+@tracing.traced
 def create_session(
     db: Session, session: schemas.SessionCreate, app_id: str, user_id: str
 ) -> models.Session:
@@ -50,18 +115,56 @@ def create_session(
     return honcho_session
 
 
+@tracing.traced
+def resolve_session(
+    db: Session, session: schemas.SessionCreate, app_id: str, user_id: str
+) -> models.Session:
+    """Get the newest active session for a location or create one if there is none"""
+    stmt = (
+        select(models.Session)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+        .where(models.Session.location_id == session.location_id)
+        .where(models.Session.is_active.is_(True))
+        .order_by(models.Session.created_at.desc())
+        .limit(1)
+    )
+    honcho_session = db.scalars(stmt).first()
+    if honcho_session is not None:
+        return honcho_session
+    honcho_session = models.Session(
+        app_id=app_id,
+        user_id=user_id,
+        location_id=session.location_id,
+        h_metadata=session.metadata,
+        resolved=True,
+    )
+    try:
+        db.add(honcho_session)
+        db.commit()
+    except IntegrityError:
+        # A concurrent request created the session first
+        db.rollback()
+        return db.scalars(stmt).one()
+    db.refresh(honcho_session)
+    return honcho_session
+
+
+@tracing.traced
 def update_session(
     db: Session, session: schemas.SessionUpdate, app_id: str, user_id: str, session_id: uuid.UUID
 ) -> bool:
-    honcho_session = get_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
+    honcho_session = _select_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
     if honcho_session is None:
         raise ValueError("Session not found or does not belong to user")
     if session.metadata is not None: # Need to explicitly be there won't make it empty by default
         honcho_session.h_metadata = session.metadata
     db.commit()
+    _invalidate_session(app_id, user_id, session_id)
     db.refresh(honcho_session)
     return honcho_session
 
+@tracing.traced
 def delete_session(db: Session, app_id: str, user_id: str, session_id: uuid.UUID) -> bool:
     stmt = (
         select(models.Session)
@@ -73,39 +176,185 @@ def delete_session(db: Session, app_id: str, user_id: str, session_id: uuid.UUID
     if honcho_session is None:
         return False
     honcho_session.is_active = False
+    honcho_session.deactivated_at = datetime.datetime.utcnow()
     db.commit()
+    _invalidate_session(app_id, user_id, session_id)
+    return True
+
+def _session_exists(db: Session, app_id: str, user_id: str, session_id: uuid.UUID) -> bool:
+    """Whether the user has the session, in the hot tables or archived"""
+    if _select_session(db, app_id=app_id, session_id=session_id, user_id=user_id) is not None:
+        return True
+    stmt = (
+        select(models.SessionArchive.id)
+        .where(models.SessionArchive.id == session_id)
+        .where(models.SessionArchive.app_id == app_id)
+        .where(models.SessionArchive.user_id == user_id)
+    )
+    return db.scalars(stmt).first() is not None
+
+@tracing.traced
+def hard_delete_session(db: Session, app_id: str, user_id: str, session_id: uuid.UUID) -> bool:
+    """Delete a session with its messages and metamessages for good, in batches of set based DELETEs"""
+    if not _session_exists(db, app_id, user_id, session_id):
+        return False
+    deletion.delete_session(db, session_id)
     return True
 
+@tracing.traced
+def create_deletion_job(
+    db: Session, app_id: str, user_id: str, kind: str, target_id: uuid.UUID
+) -> Optional[models.DeletionJob]:
+    """Record a job deleting a user's session or collection, None if the user has no such thing
+
+    A session is made inactive straight away so it leaves the session list
+    while the job runs.
+    """
+    if kind == "session":
+        if not _session_exists(db, app_id, user_id, target_id):
+            return None
+        delete_session(db, app_id, user_id, target_id)
+    elif _select_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=target_id) is None:
+        return None
+    return deletion.create_job(db, app_id, user_id, kind, target_id)
+
+@tracing.traced
+def get_deletion_job(db: Session, app_id: str, user_id: str, job_id: uuid.UUID) -> Optional[models.DeletionJob]:
+    stmt = (
+        select(models.DeletionJob)
+        .where(models.DeletionJob.id == job_id)
+        .where(models.DeletionJob.app_id == app_id)
+        .where(models.DeletionJob.user_id == user_id)
+    )
+    return db.scalars(stmt).one_or_none()
+
+class MessageIdConflict(ValueError):
+    """A client supplied message ID is taken by a message of another session, or repeated in a batch"""
+
+def _stored_messages(db: Session, session_id: uuid.UUID, ids: Sequence[uuid.UUID]) -> dict[uuid.UUID, models.Message]:
+    """The messages of a session already stored under client supplied IDs
+
+    Raises:
+        MessageIdConflict: If one of the IDs belongs to a message of another session
+    """
+    if not ids:
+        return {}
+    stored = {}
+    for row in db.scalars(select(models.Message).where(models.Message.id.in_(ids))):
+        if row.session_id != session_id:
+            raise MessageIdConflict(f"Message ID {row.id} is already taken")
+        stored[row.id] = row
+    return stored
+
+@tracing.traced
 def create_message(
         db: Session, message: schemas.MessageCreate, app_id: str, user_id: str, session_id: uuid.UUID
 ) -> models.Message:
+    """Add a message to a session
+
+    Sending a message again with the same client supplied ID returns the
+    stored message instead of adding another, so requests can be retried.
+
+    Raises:
+        ValueError: If the session is not found
+        MessageIdConflict: If the ID is taken by a message of another session
+    """
+    return create_messages(db, [message], app_id=app_id, user_id=user_id, session_id=session_id)[0]
+
+@tracing.traced
+def create_messages(
+        db: Session, messages: Sequence[schemas.MessageCreate], app_id: str, user_id: str, session_id: uuid.UUID,
+        retry: bool = True,
+) -> list[models.Message]:
+    """Add a batch of messages to a session in a single transaction preserving their order
+
+    Messages whose client supplied ID is already stored in the session are
+    returned as stored rather than added again, so a batch whose response
+    was lost can be retried.
+
+    Raises:
+        ValueError: If the session is not found
+        MessageIdConflict: If an ID is taken by a message of another session or repeated in the batch
+    """
     honcho_session = get_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
     if honcho_session is None:
         raise ValueError("Session not found or does not belong to user")
 
-    honcho_message = models.Message(
-        session_id=session_id,
-        is_user=message.is_user,
-        content=message.content,
-    )
-    db.add(honcho_message)
+    ids = [message.id for message in messages if message.id is not None]
+    if len(set(ids)) != len(ids):
+        raise MessageIdConflict("Message IDs are repeated in the batch")
+    stored = _stored_messages(db, session_id, ids)
+
+    # Stagger created_at so messages in the same batch never tie when ordered
+    now = datetime.datetime.utcnow()
+    honcho_messages = [
+        stored.get(message.id) or models.Message(
+            id=message.id,
+            session_id=session_id,
+            is_user=message.is_user,
+            content=message.content,
+            created_at=now + datetime.timedelta(microseconds=i),
+        )
+        for i, message in enumerate(messages)
+    ]
+    new_messages = [honcho_message for honcho_message in honcho_messages if honcho_message.id not in stored]
+    if new_messages:
+        last_seq = stats.record_messages(db, session_id, len(new_messages), new_messages[-1].created_at)
+        if last_seq is None:
+            db.rollback()
+            _invalidate_session(app_id, user_id, session_id)
+            raise ValueError("Session not found or does not belong to user")
+        for seq, honcho_message in enumerate(new_messages, last_seq - len(new_messages) + 1):
+            honcho_message.seq = seq
+    db.add_all(new_messages)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        if not retry:
+            raise MessageIdConflict("Message IDs are already taken")
+        # A concurrent retry of the same messages committed first, this attempt now finds them stored
+        return create_messages(db, messages, app_id=app_id, user_id=user_id, session_id=session_id, retry=False)
+    new_events = [events.message_event(honcho_message) for honcho_message in new_messages]
+    events.notify(db, new_events)
     db.commit()
-    db.refresh(honcho_message)
-    return honcho_message
+    for honcho_message in new_messages:
+        db.refresh(honcho_message)
+    events.publish(new_events)
+    return honcho_messages
 
+def _created_since(db: Session, app_id: str, user_id: str, session_id: uuid.UUID) -> Optional[datetime.datetime]:
+    """Lower bound on the created_at of a session's rows when messages are range partitioned
+
+    Postgres can only skip partitions the query's own predicates rule out,
+    and a session's rows are never older than the session.
+    """
+    if partitioning.layout() != "range":
+        return None
+    honcho_session = get_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
+    return partitioning.lower_bound(honcho_session.created_at) if honcho_session is not None else None
+
+@tracing.traced
 def get_messages(
-    db: Session, app_id: str, user_id: str, session_id: uuid.UUID
+    db: Session, app_id: str, user_id: str, session_id: uuid.UUID, after_seq: Optional[int] = None
 ) -> Select:
+    """A session's messages in seq order, only those after after_seq if given"""
     stmt = (
         select(models.Message)
         .join(models.Session, models.Session.id == models.Message.session_id)
         .where(models.Session.app_id == app_id)
         .where(models.Session.user_id == user_id)
         .where(models.Message.session_id == session_id)
-        .order_by(models.Message.created_at)
+        .order_by(models.Message.seq)
     )
+    if after_seq is not None:
+        stmt = stmt.where(models.Message.seq > after_seq)
+    since = _created_since(db, app_id, user_id, session_id)
+    if since is not None:
+        stmt = stmt.where(models.Message.created_at >= since)
     return stmt
 
+@tracing.traced
 def get_message(
         db: Session, app_id: str, user_id: str, session_id: uuid.UUID, message_id: uuid.UUID     
 ) -> Optional[models.Message]:
@@ -118,12 +367,16 @@ def get_message(
         .where(models.Message.id == message_id)
 
     )
+    since = _created_since(db, app_id, user_id, session_id)
+    if since is not None:
+        stmt = stmt.where(models.Message.created_at >= since)
     return db.scalars(stmt).one_or_none()
 
 ########################################################
 # metamessage methods
 ########################################################
 
+@tracing.traced
 def get_metamessages(db: Session, app_id: str, user_id: str, session_id: uuid.UUID, message_id: Optional[uuid.UUID], metamessage_type: Optional[str] = None) -> Select:
     stmt = (
         select(models.Metamessage)
@@ -138,8 +391,51 @@ def get_metamessages(db: Session, app_id: str, user_id: str, session_id: uuid.UU
         stmt = stmt.where(models.Metamessage.message_id == message_id)
     if metamessage_type is not None:
         stmt = stmt.where(models.Metamessage.metamessage_type == metamessage_type)
+    since = _created_since(db, app_id, user_id, session_id)
+    if since is not None:
+        stmt = stmt.where(models.Message.created_at >= since).where(models.Metamessage.created_at >= since)
     return stmt
 
+@tracing.traced
+def get_user_metamessages(
+    db: Session, app_id: str, user_id: str, metamessage_type: Optional[str] = None,
+    since: Optional[datetime.datetime] = None, after: Optional[tuple[datetime.datetime, uuid.UUID]] = None,
+) -> Select:
+    """A user's metamessages across every session, oldest first, with the session ID of each
+
+    after is the (created_at, id) of the last metamessage already seen.
+    Archived sessions are not included.
+    """
+    stmt = (
+        select(models.Metamessage, models.Message.session_id)
+        .join(models.Message, models.Message.id == models.Metamessage.message_id)
+        .join(models.Session, models.Message.session_id == models.Session.id)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+        .order_by(models.Metamessage.created_at, models.Metamessage.id)
+    )
+    if metamessage_type is not None:
+        stmt = stmt.where(models.Metamessage.metamessage_type == metamessage_type)
+    if since is not None:
+        stmt = stmt.where(models.Metamessage.created_at >= since)
+    if after is not None:
+        stmt = stmt.where(tuple_(models.Metamessage.created_at, models.Metamessage.id) > tuple_(*after))
+    return stmt
+
+@tracing.traced
+def search_messages(
+    db: Session, app_id: str, user_id: str, query: str, session_id: Optional[uuid.UUID] = None,
+    location_id: Optional[str] = None, after: Optional[tuple[float, uuid.UUID]] = None,
+) -> Select:
+    """A user's messages matching a full text query, best first, see search.search
+
+    Archived sessions are not included.
+    """
+    return search.search(
+        db, app_id=app_id, user_id=user_id, query=query, session_id=session_id, location_id=location_id, after=after
+    )
+
+@tracing.traced
 def get_metamessage(
         db: Session, app_id: str, user_id: str, session_id: uuid.UUID, message_id: uuid.UUID, metamessage_id: uuid.UUID
 ) -> Optional[models.Metamessage]: 
@@ -154,8 +450,12 @@ def get_metamessage(
         .where(models.Metamessage.id == metamessage_id)
        
     )
+    since = _created_since(db, app_id, user_id, session_id)
+    if since is not None:
+        stmt = stmt.where(models.Message.created_at >= since).where(models.Metamessage.created_at >= since)
     return db.scalars(stmt).one_or_none()
 
+@tracing.traced
 def create_metamessage(
     db: Session,
     metamessage: schemas.MetamessageCreate,
@@ -171,11 +471,21 @@ def create_metamessage(
         message_id=metamessage.message_id,
         metamessage_type=metamessage.metamessage_type,
         content=metamessage.content,
+        created_at=datetime.datetime.utcnow(),
+        seq=stats.record_metamessage(db, session_id),
     )
+    if honcho_metamessage.seq is None:
+        db.rollback()
+        _invalidate_session(app_id, user_id, session_id)
+        raise ValueError("Session not found or does not belong to user")
 
     db.add(honcho_metamessage)
+    db.flush()
+    new_events = [events.metamessage_event(honcho_metamessage, session_id)]
+    events.notify(db, new_events)
     db.commit()
     db.refresh(honcho_metamessage)
+    events.publish(new_events)
     return honcho_metamessage
 
 ########################################################
@@ -184,6 +494,7 @@ def create_metamessage(
 
 # Should be very similar to the session methods
 
+@tracing.traced
 def get_collections(db: Session, app_id: str, user_id: str) -> Select:
     """Get a distinct list of the names of collections associated with a user"""
     stmt = (
@@ -194,7 +505,7 @@ def get_collections(db: Session, app_id: str, user_id: str) -> Select:
     )
     return stmt
 
-def get_collection_by_id(db: Session, app_id: str, user_id: str, collection_id: uuid.UUID) -> Optional[models.Collection]:
+def _select_collection_by_id(db: Session, app_id: str, user_id: str, collection_id: uuid.UUID) -> Optional[models.Collection]:
     stmt = ( 
         select(models.Collection)
         .where(models.Collection.app_id == app_id)
@@ -204,16 +515,36 @@ def get_collection_by_id(db: Session, app_id: str, user_id: str, collection_id:
     collection = db.scalars(stmt).one_or_none()
     return collection
 
+@tracing.traced
+def get_collection_by_id(db: Session, app_id: str, user_id: str, collection_id: uuid.UUID) -> Optional[models.Collection]:
+    """Get a collection through the lookup cache. The result is detached when cached so it must not be modified"""
+    key = lookup_cache.key("collection", app_id, user_id, collection_id)
+    return lookup_cache.get_or_load(
+        models.Collection, key, lambda: _select_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=collection_id),
+        store=not replicas.is_replica(db),
+    )
+
+@tracing.traced
 def get_collection_by_name(db: Session, app_id: str, user_id: str, name: str) -> Optional[models.Collection]:
+    """Get a collection through the lookup cache. The result is detached when cached so it must not be modified"""
     stmt = ( 
         select(models.Collection)
         .where(models.Collection.app_id == app_id)
         .where(models.Collection.user_id == user_id)
         .where(models.Collection.name == name)
     )
-    collection = db.scalars(stmt).one_or_none()
-    return collection
+    key = lookup_cache.key("collection_name", app_id, user_id, name)
+    return lookup_cache.get_or_load(
+        models.Collection, key, lambda: db.scalars(stmt).one_or_none(), store=not replicas.is_replica(db)
+    )
+
+def _invalidate_collection(app_id: str, user_id: str, collection_id: uuid.UUID, name: str):
+    lookup_cache.invalidate(
+        lookup_cache.key("collection", app_id, user_id, collection_id),
+        lookup_cache.key("collection_name", app_id, user_id, name),
+    )
 
+@tracing.traced
 def create_collection(
     db: Session, collection: schemas.CollectionCreate, app_id: str, user_id: str
 ) -> models.Collection:
@@ -231,39 +562,36 @@ def create_collection(
     db.refresh(honcho_collection)
     return honcho_collection
 
+@tracing.traced
 def update_collection(
         db: Session, collection: schemas.CollectionUpdate, app_id: str, user_id: str, collection_id: uuid.UUID
 ) -> models.Collection:
-    honcho_collection = get_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=collection_id)
+    honcho_collection = _select_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=collection_id)
     if honcho_collection is None:
         raise ValueError("collection not found or does not belong to user")
+    old_name = honcho_collection.name
     try:
         honcho_collection.name = collection.name
         db.commit()
     except IntegrityError:
         db.rollback()
         raise ValueError("Collection already exists")
+    _invalidate_collection(app_id, user_id, collection_id, old_name)
     db.refresh(honcho_collection)
     return honcho_collection
 
+@tracing.traced
 def delete_collection(
     db: Session, app_id: str, user_id: str, collection_id: uuid.UUID
 ) -> bool:
     """
-    Delete a Collection and all documents associated with it. Takes advantage of
-    the orm cascade feature
+    Delete a Collection and all documents associated with it, in batches of
+    set based DELETEs
     """
-    stmt = (
-        select(models.Collection)
-        .where(models.Collection.id == collection_id)
-        .where(models.Collection.app_id == app_id)
-        .where(models.Collection.user_id == user_id)
-    )
-    honcho_collection = db.scalars(stmt).one_or_none()
+    honcho_collection = _select_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=collection_id)
     if honcho_collection is None:
         return False
-    db.delete(honcho_collection)
-    db.commit()
+    deletion.delete_collection(db, collection_id)
     return True
 
 ########################################################
@@ -272,6 +600,7 @@ def delete_collection(
 
 # Should be similar to the messages methods outside of query
 
+@tracing.traced
 def get_documents(
     db: Session, app_id: str, user_id: str, collection_id: uuid.UUID
 ) -> Select:
@@ -285,6 +614,7 @@ def get_documents(
     )
     return stmt
 
+@tracing.traced
 def get_document(
         db: Session, app_id: str, user_id: str, collection_id: uuid.UUID, document_id: uuid.UUID 
 ) -> Optional[models.Document]:
@@ -301,12 +631,9 @@ def get_document(
     return document
 
 
+@tracing.traced
 def query_documents(db: Session, app_id: str, user_id: str, collection_id: uuid.UUID, query: str, top_k: int = 5) -> Sequence[models.Document]:
-    response = openai_client.embeddings.create(
-        input=query,
-        model="text-embedding-3-small"
-    )
-    embedding_query = response.data[0].embedding
+    embedding_query = embed(query)
     stmt = (
             select(models.Document)
             .join(models.Collection, models.Collection.id == models.Document.collection_id)
@@ -320,6 +647,7 @@ def query_documents(db: Session, app_id: str, user_id: str, collection_id: uuid.
         # stmt = stmt.where(models.Document.h_metadata.contains(metadata))
     return db.scalars(stmt).all()
 
+@tracing.traced
 def create_document(
         db: Session, document: schemas.DocumentCreate, app_id: str, user_id: str, collection_id: uuid.UUID
 ) -> models.Document:
@@ -328,24 +656,34 @@ def create_document(
     if collection is None:
         raise ValueError("Session not found or does not belong to user")
 
-    response = openai_client.embeddings.create(
-            input=document.content, 
-            model="text-embedding-3-small"
-    )
-
-    embedding = response.data[0].embedding
-
-    honcho_document = models.Document(
-        collection_id=collection_id,
-        content=document.content,
-        h_metadata=document.metadata,
-        embedding=embedding
+    embedding = embed(document.content)
+
+    # Insert from the collection's row so a collection deleted since it was
+    # cached is caught here, as no row, rather than by the foreign key
+    documents = models.Document.__table__
+    document_id = uuid.uuid4()
+    values = (
+        select(
+            bindparam("id", document_id, type_=documents.c.id.type),
+            models.Collection.id,
+            bindparam("content", document.content, type_=documents.c.content.type),
+            bindparam("metadata", document.metadata, type_=documents.c.metadata.type),
+            bindparam("embedding", embedding, type_=documents.c.embedding.type),
+            bindparam("created_at", datetime.datetime.utcnow(), type_=documents.c.created_at.type),
+        )
+        .where(models.Collection.id == collection_id)
+        .where(models.Collection.app_id == app_id)
+        .where(models.Collection.user_id == user_id)
     )
-    db.add(honcho_document)
+    columns = ["id", "collection_id", "content", "metadata", "embedding", "created_at"]
+    if db.execute(insert(documents).from_select(columns, values)).rowcount == 0:
+        db.rollback()
+        _invalidate_collection(app_id, user_id, collection_id, collection.name)
+        raise ValueError("Session not found or does not belong to user")
     db.commit()
-    db.refresh(honcho_document)
-    return honcho_document
+    return db.get(models.Document, document_id)
 
+@tracing.traced
 def update_document(
         db: Session, document: schemas.DocumentUpdate, app_id: str, user_id: str, collection_id: uuid.UUID, document_id: uuid.UUID
 ) -> bool:
@@ -354,12 +692,7 @@ def update_document(
         raise ValueError("Session not found or does not belong to user")
     if document.content is not None:
         honcho_document.content = document.content
-        response = openai_client.embeddings.create(
-                    input=document.content, 
-                    model="text-embedding-3-small"
-            )
-        embedding = response.data[0].embedding
-        honcho_document.embedding = embedding
+        honcho_document.embedding = embed(document.content)
         honcho_document.created_at = datetime.datetime.now()
 
     if document.metadata is not None:
@@ -368,6 +701,7 @@ def update_document(
     db.refresh(honcho_document)
     return honcho_document
 
+@tracing.traced
 def delete_document(db: Session, app_id: str, user_id: str, collection_id: uuid.UUID, document_id: uuid.UUID) -> bool:
     stmt = (
         select(models.Document)
@@ -384,3 +718,33 @@ def delete_document(db: Session, app_id: str, user_id: str, collection_id: uuid.
     db.commit()
     return True
 
+
+########################################################
+# retention methods
+########################################################
+
+@tracing.traced
+def get_retention_policy(
+    db: Session, app_id: str
+) -> tuple[Optional[models.RetentionPolicy], Sequence[models.RetentionCheckpoint]]:
+    """The retention policy of an app and the progress of its purges"""
+    policy = db.get(models.RetentionPolicy, app_id)
+    checkpoints = db.scalars(
+        select(models.RetentionCheckpoint)
+        .where(models.RetentionCheckpoint.app_id == app_id)
+        .order_by(models.RetentionCheckpoint.kind)
+    ).all()
+    return policy, checkpoints
+
+@tracing.traced
+def set_retention_policy(db: Session, app_id: str, policy: schemas.RetentionPolicyUpdate) -> models.RetentionPolicy:
+    honcho_policy = db.get(models.RetentionPolicy, app_id)
+    if honcho_policy is None:
+        honcho_policy = models.RetentionPolicy(app_id=app_id)
+        db.add(honcho_policy)
+    honcho_policy.message_days = policy.message_days
+    honcho_policy.document_days = policy.document_days
+    honcho_policy.updated_at = datetime.datetime.utcnow()
+    db.commit()
+    db.refresh(honcho_policy)
+    return honcho_policy
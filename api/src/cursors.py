@@ -0,0 +1,67 @@
+"""Opaque cursors for keyset pagination
+
+Routes that page with cursors rather than page numbers select one row more
+than the page size, in a fixed order. If that row exists, the sort key of
+the last row on the page goes into next_cursor. The next request passes it
+back and continues after that key through an index. Nothing is skipped or
+repeated when rows are added meanwhile, and deep pages cost no more than
+the first. Clients should treat cursors as opaque strings.
+"""
+import base64
+import datetime
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from . import codec
+
+
+def encode(*values: Any) -> str:
+    return base64.urlsafe_b64encode(codec.dumps(list(values))).decode().rstrip("=")
+
+
+def decode(cursor: str, count: int) -> List[Any]:
+    """The values encode was called with
+
+    Raises:
+        ValueError: If cursor was not made by encode with count values
+    """
+    try:
+        values = codec.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception as e: # binascii.Error or the JSON backend's decode error
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list) or len(values) != count:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def decode_created_id(cursor: str) -> Tuple[datetime.datetime, uuid.UUID]:
+    """The (created_at, id) key of a cursor made by encode(created_at, id)
+
+    Raises:
+        ValueError: If cursor is not such a cursor
+    """
+    created_at, row_id = decode(cursor, 2)
+    if not isinstance(created_at, str) or not isinstance(row_id, str):
+        raise ValueError("Invalid cursor")
+    return datetime.datetime.fromisoformat(created_at), uuid.UUID(row_id)
+
+
+def decode_score_id(cursor: str) -> Tuple[float, uuid.UUID]:
+    """The (score, id) key of a cursor made by encode(score, id)
+
+    Raises:
+        ValueError: If cursor is not such a cursor
+    """
+    score, row_id = decode(cursor, 2)
+    if not isinstance(score, (int, float)) or isinstance(score, bool) or not isinstance(row_id, str):
+        raise ValueError("Invalid cursor")
+    return float(score), uuid.UUID(row_id)
+
+
+def page(
+    rows: Sequence[Any], size: int, serialize: Callable[[Any], Dict[str, Any]], key: Callable[[Any], Tuple]
+) -> Dict[str, Any]:
+    """Build a page body from up to size + 1 rows, the extra row only telling that there are more"""
+    items = rows[:size]
+    next_cursor: Optional[str] = encode(*key(items[-1])) if len(rows) > size else None
+    return {"items": [serialize(row) for row in items], "next_cursor": next_cursor}
@@ -7,14 +7,55 @@ import os
 load_dotenv()
 
 
+def worker_count() -> int:
+    """Worker processes serving the API, from WEB_CONCURRENCY"""
+    return max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+
+
+def pool_options(budget_variable: str = "DATABASE_MAX_CONNECTIONS", reserved: int = 0) -> dict:
+    """Per worker pool size derived from a connection budget
+
+    The budget is the number of connections every worker together may
+    open. Each worker gets an equal share, less reserved connections held
+    outside the pool. Without a budget the SQLAlchemy defaults apply.
+    """
+    budget = int(os.getenv(budget_variable, 0))
+    if not budget:
+        return {}
+    share = budget // worker_count() - reserved
+    if share < 1:
+        raise ValueError(f"{budget_variable}={budget} is too small for {worker_count()} workers")
+    return {
+        "pool_size": share,
+        "max_overflow": 0,
+        "pool_timeout": float(os.getenv("DATABASE_POOL_TIMEOUT", 30)),
+        "pool_pre_ping": True,
+    }
+
+
 connect_args = {}
+pool_args = {}
+echo = os.getenv("DATABASE_ECHO", "false").lower() == "true"
 
 if os.environ["DATABASE_TYPE"] == "sqlite": # https://fastapi.tiangolo.com/tutorial/sql-databases/#note
     connect_args = {"check_same_thread": False}
+else:
+    # The event listener holds a connection outside the pool
+    pool_args = pool_options(reserved=1 if os.getenv("EVENTS_BUS", "auto") != "memory" else 0)
 
 engine = create_engine(
-    os.environ["CONNECTION_URI"], connect_args=connect_args, echo=True
+    os.environ["CONNECTION_URI"],
+    connect_args=connect_args,
+    echo=echo,
+    **pool_args,
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Read replicas for GET requests, see replicas.py. Each has its own connection budget
+replica_engines = [
+    create_engine(uri.strip(), echo=echo, **pool_options("DATABASE_REPLICA_MAX_CONNECTIONS"))
+    for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",")
+    if uri.strip()
+]
 Base = declarative_base()
@@ -0,0 +1,211 @@
+"""Set based deletion of sessions and collections: python -m src.deletion resume
+
+A session's messages and metamessages and a collection's documents are
+deleted by primary key in batches, one short transaction per batch, with
+plain DELETE statements. Rows are never loaded, so a collection's
+embeddings never pass through memory. The session or collection itself
+goes last, in a transaction that locks its row first so that rows added
+meanwhile are deleted with it instead of being left behind.
+
+Large deletes can run as jobs recorded in deletion_jobs. The API starts a
+job in the worker that accepted the request, after responding, and the job
+adds to its deleted count with every batch so any worker can report its
+progress. Deleting is idempotent, so jobs left unfinished by a worker that
+died are safely run again by `python -m src.deletion resume`.
+"""
+import argparse
+import datetime
+import logging
+import sys
+import uuid
+from typing import Callable, List, Optional
+
+from sqlalchemy import Select, delete, func, select
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# Unfinished jobs not updated for this long are assumed abandoned by their worker
+STALE_AFTER = datetime.timedelta(minutes=5)
+
+KINDS = ("session", "collection")
+
+_UNSYNCHRONIZED = {"synchronize_session": False}
+
+
+def _in_batches(
+    db: Session, ids: Select, delete_ids: Callable[[List[uuid.UUID]], int], batch_size: int,
+    progress: Optional[Callable[[int], None]],
+) -> int:
+    """Delete the rows ids selects batch by batch, returning how many delete_ids reported"""
+    deleted = 0
+    while True:
+        batch = list(db.scalars(ids.limit(batch_size)))
+        if not batch:
+            return deleted
+        rows = delete_ids(batch)
+        if progress is not None:
+            progress(rows)
+        db.commit()
+        deleted += rows
+        if len(batch) < batch_size:
+            return deleted
+
+
+def _delete_messages(db: Session, ids: List[uuid.UUID]) -> int:
+    db.execute(delete(models.Metamessage).where(models.Metamessage.message_id.in_(ids)), execution_options=_UNSYNCHRONIZED)
+    return db.execute(delete(models.Message).where(models.Message.id.in_(ids)), execution_options=_UNSYNCHRONIZED).rowcount
+
+
+def delete_session(
+    db: Session, session_id: uuid.UUID, batch_size: int = BATCH_SIZE, progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """Delete a session with its messages and metamessages, or its archive
+
+    Args:
+        db (Session): The database session
+        session_id (uuid.UUID): The session to delete, its owner must already be checked
+        batch_size (int, optional): Messages deleted per transaction
+        progress (Callable, optional): Called with the messages deleted by each
+            transaction before it commits
+
+    Returns:
+        int: The number of messages deleted
+    """
+    from .crud import _invalidate_session
+
+    message_ids = select(models.Message.id).where(models.Message.session_id == session_id)
+    deleted = _in_batches(db, message_ids, lambda ids: _delete_messages(db, ids), batch_size, progress)
+
+    owner = db.execute(
+        select(models.Session.app_id, models.Session.user_id).where(models.Session.id == session_id).with_for_update()
+    ).one_or_none()
+    rows = _delete_messages(db, list(db.scalars(message_ids)))
+    db.execute(delete(models.Session).where(models.Session.id == session_id), execution_options=_UNSYNCHRONIZED)
+    db.execute(delete(models.SessionArchive).where(models.SessionArchive.id == session_id), execution_options=_UNSYNCHRONIZED)
+    if progress is not None:
+        progress(rows)
+    db.commit()
+    if owner is not None:
+        _invalidate_session(owner.app_id, owner.user_id, session_id)
+    return deleted + rows
+
+
+def delete_collection(
+    db: Session, collection_id: uuid.UUID, batch_size: int = BATCH_SIZE, progress: Optional[Callable[[int], None]] = None
+) -> int:
+    """Delete a collection with its documents
+
+    Args:
+        db (Session): The database session
+        collection_id (uuid.UUID): The collection to delete, its owner must already be checked
+        batch_size (int, optional): Documents deleted per transaction
+        progress (Callable, optional): Called with the documents deleted by each
+            transaction before it commits
+
+    Returns:
+        int: The number of documents deleted
+    """
+    from .crud import _invalidate_collection
+
+    def delete_documents(ids: List[uuid.UUID]) -> int:
+        return db.execute(delete(models.Document).where(models.Document.id.in_(ids)), execution_options=_UNSYNCHRONIZED).rowcount
+
+    document_ids = select(models.Document.id).where(models.Document.collection_id == collection_id)
+    deleted = _in_batches(db, document_ids, delete_documents, batch_size, progress)
+
+    collection = db.execute(
+        select(models.Collection.app_id, models.Collection.user_id, models.Collection.name)
+        .where(models.Collection.id == collection_id)
+        .with_for_update()
+    ).one_or_none()
+    rows = db.execute(
+        delete(models.Document).where(models.Document.collection_id == collection_id), execution_options=_UNSYNCHRONIZED
+    ).rowcount
+    db.execute(delete(models.Collection).where(models.Collection.id == collection_id), execution_options=_UNSYNCHRONIZED)
+    if progress is not None:
+        progress(rows)
+    db.commit()
+    if collection is not None:
+        _invalidate_collection(collection.app_id, collection.user_id, collection_id, collection.name)
+    return deleted + rows
+
+
+def create_job(db: Session, app_id: str, user_id: str, kind: str, target_id: uuid.UUID) -> models.DeletionJob:
+    """Record a pending job, with the number of rows it is expected to delete"""
+    if kind == "session":
+        total = db.scalar(select(models.Session.message_count).where(models.Session.id == target_id))
+    else:
+        total = db.scalar(select(func.count()).where(models.Document.collection_id == target_id))
+    job = models.DeletionJob(app_id=app_id, user_id=user_id, kind=kind, target_id=target_id, total=total)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def run(job_id: uuid.UUID, batch_size: int = BATCH_SIZE) -> None:
+    """Carry out a job with its own database session, recording progress and the outcome"""
+    from .db import SessionLocal
+
+    with SessionLocal() as db:
+        job = db.get(models.DeletionJob, job_id)
+        if job is None or job.status == "done":
+            return
+        job.status = "running"
+        job.updated_at = datetime.datetime.utcnow()
+        db.commit()
+
+        def progress(rows: int) -> None:
+            job.deleted += rows
+            job.updated_at = datetime.datetime.utcnow()
+
+        delete_target = delete_session if job.kind == "session" else delete_collection
+        try:
+            delete_target(db, job.target_id, batch_size, progress)
+        except Exception as e:
+            logger.exception("Deletion job %s failed", job_id)
+            db.rollback()
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+        else:
+            job.status = "done"
+        job.finished_at = job.updated_at = datetime.datetime.utcnow()
+        db.commit()
+
+
+def resume(batch_size: int = BATCH_SIZE) -> int:
+    """Run every unfinished job that has not made progress for STALE_AFTER, returning how many ran"""
+    from .db import SessionLocal
+
+    with SessionLocal() as db:
+        stale = datetime.datetime.utcnow() - STALE_AFTER
+        job_ids = list(db.scalars(
+            select(models.DeletionJob.id)
+            .where(models.DeletionJob.status.in_(("pending", "running")))
+            .where(models.DeletionJob.updated_at < stale)
+            .order_by(models.DeletionJob.updated_at)
+        ))
+    for job_id in job_ids:
+        logger.info("Resuming deletion job %s", job_id)
+        run(job_id, batch_size)
+    return len(job_ids)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.deletion", description="Finish abandoned deletion jobs")
+    parser.add_argument("command", choices=["resume"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows deleted per transaction")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    logger.info("Resumed %d deletion jobs", resume(args.batch_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""Weak ETags for conditional GETs
+
+Tags are derived from cheap summaries of the data (row count and newest
+created_at for append only tables, the mutable fields of a single row) so a
+matching If-None-Match can be answered with a 304 before any rows are
+loaded or serialized.
+"""
+import hashlib
+from typing import Any, Optional
+
+from fastapi import Request, Response
+from sqlalchemy import Select, func, select
+from sqlalchemy.orm import Session
+
+from . import codec
+
+
+def make(*parts: Any) -> str:
+    """Build a weak ETag from the values that identify a version of a resource"""
+    digest = hashlib.blake2b(codec.dumps([str(part) for part in parts]), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def for_query(db: Session, stmt: Select, *parts: Any) -> tuple[str, int]:
+    """Build a weak ETag for an append only query from its row count and newest created_at
+
+    Args:
+        db (Session): The database session
+        stmt (Select): The query whose results the tag describes. Must select a created_at column
+        *parts: Anything else that changes the response such as page parameters
+
+    Returns:
+        tuple[str, int]: The ETag and the total number of rows
+    """
+    subquery = stmt.order_by(None).subquery()
+    total, newest = db.execute(select(func.count(), func.max(subquery.c.created_at))).one()
+    return make(total, newest, *parts), total
+
+
+def matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match already names etag, using weak comparison"""
+    header: Optional[str] = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
@@ -0,0 +1,376 @@
+"""Message and metamessage creation events streamed to clients as Server-Sent Events
+
+crud sends a NOTIFY for each new message or metamessage inside the
+transaction that creates it, so other workers hear of it only once it is
+committed and never of rows rolled back. After the commit it publishes the
+events to the streams of the same session in this worker, and on Postgres
+the other workers' listeners deliver the notifications to theirs. Without
+Postgres the bus only reaches the worker that created the row, which is all
+a single worker deployment needs.
+
+Messages and metamessages are numbered per session by seq, allocated under
+the session's row lock, so seqs follow commit order. Event ids are the
+stream's position `<message seq>.<metamessage seq>` after the event, so a
+client reconnecting with Last-Event-ID receives every event committed after
+the last one it saw, however late it was published. A live event that
+skips a seq makes the stream read the events in between from the database.
+Use `0` to replay the whole session. Delivery is at least once.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import select as select_module
+import threading
+import uuid
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import codec, models, serializers
+from .db import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "honcho_events"
+
+# A stream's position, the message seq and metamessage seq it has reached
+Cursor = Tuple[int, int]
+
+# Seconds between keepalive comments on an idle stream
+HEARTBEAT_INTERVAL = 15.0
+
+# Events a slow stream may fall behind by before it is closed. The client
+# reconnects with its Last-Event-ID and catches up from the database
+MAX_PENDING_EVENTS = 1000
+
+REPLAY_CHUNK_SIZE = 500
+
+
+class Event(NamedTuple):
+    session_id: uuid.UUID
+    type: str
+    seq: int
+    data: dict
+
+    def encode(self, cursor: Cursor) -> bytes:
+        return f"id: {format_id(cursor)}\nevent: {self.type}\ndata: ".encode() + codec.dumps(self.data) + b"\n\n"
+
+
+def format_id(cursor: Cursor) -> str:
+    return f"{cursor[0]}.{cursor[1]}"
+
+
+def parse_id(event_id: str) -> Cursor:
+    """The stream position an event id stands for, 0 for the start of the session
+
+    Raises:
+        ValueError: If event_id is not an event id
+    """
+    event_id = event_id.strip()
+    if event_id == "0":
+        return 0, 0
+    message_seq, dot, metamessage_seq = event_id.partition(".")
+    if not dot or not message_seq.isdigit() or not metamessage_seq.isdigit():
+        raise ValueError(f"Invalid event id {event_id}")
+    return int(message_seq), int(metamessage_seq)
+
+
+def position(cursor: Cursor, event: Event) -> int:
+    """The seq of event's kind the stream at cursor has reached"""
+    return cursor[0] if event.type == "message" else cursor[1]
+
+
+def advance(cursor: Cursor, event: Event) -> Cursor:
+    if event.type == "message":
+        return max(cursor[0], event.seq), cursor[1]
+    return cursor[0], max(cursor[1], event.seq)
+
+
+def message_event(row: models.Message) -> Event:
+    return Event(row.session_id, "message", row.seq, serializers.message(row))
+
+
+def metamessage_event(row: models.Metamessage, session_id: uuid.UUID) -> Event:
+    return Event(session_id, "metamessage", row.seq, {**serializers.metamessage(row), "seq": row.seq})
+
+
+class Subscription:
+    """Events for one stream, delivered to its event loop from any thread"""
+
+    def __init__(self, session_id: uuid.UUID):
+        self.session_id = session_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: "asyncio.Queue[Optional[Event]]" = asyncio.Queue()
+        self.overflowed = False
+
+    def deliver(self, event: Event) -> None:
+        """Runs on the subscriber's loop"""
+        if self.overflowed:
+            return
+        if self.queue.qsize() >= MAX_PENDING_EVENTS:
+            self.overflowed = True
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(event)
+
+
+class InProcessBus:
+    """Fans events out to the subscriptions of this worker"""
+
+    def __init__(self):
+        self.subscriptions: Dict[uuid.UUID, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, session_id: uuid.UUID) -> Subscription:
+        subscription = Subscription(session_id)
+        with self._lock:
+            self.subscriptions.setdefault(session_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self.subscriptions.get(subscription.session_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.session_id]
+
+    def has_subscribers(self, session_id: uuid.UUID) -> bool:
+        return session_id in self.subscriptions
+
+    def deliver(self, events: List[Event]) -> None:
+        """Hand events to the local subscriptions of their sessions"""
+        with self._lock:
+            targets = [(event, list(self.subscriptions.get(event.session_id, ()))) for event in events]
+        for event, subscriptions in targets:
+            for subscription in subscriptions:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+                except RuntimeError:
+                    # The subscriber's loop has closed
+                    self.unsubscribe(subscription)
+
+    def notify(self, db: Session, events: List[Event]) -> None:
+        """Tell the other workers about events in the transaction creating their rows"""
+
+
+class PostgresBus(InProcessBus):
+    """Also relays events between workers with LISTEN/NOTIFY
+
+    Notifications only carry the event type and the row's id, created_at
+    and, for a metamessage, message_id, because payloads are limited to
+    8000 bytes. A worker loads
+    the row by its partition keys when it has a stream for the session.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.origin = uuid.uuid4().hex
+        self._listener: Optional[threading.Thread] = None
+
+    def subscribe(self, session_id: uuid.UUID) -> Subscription:
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(target=self._listen, name="honcho-events-listener", daemon=True)
+                    self._listener.start()
+        return super().subscribe(session_id)
+
+    def notify(self, db: Session, events: List[Event]) -> None:
+        # A savepoint so a failed NOTIFY does not abort the caller's transaction
+        with db.begin_nested():
+            for event in events:
+                payload = {
+                    "origin": self.origin, "session_id": str(event.session_id), "type": event.type,
+                    "id": str(event.data["id"]), "created_at": event.data["created_at"].isoformat(),
+                }
+                if event.type == "metamessage":
+                    # The hash layout partitions metamessages by message_id
+                    payload["message_id"] = str(event.data["message_id"])
+                db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": json.dumps(payload)})
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                logger.exception("Event listener lost its connection, reconnecting")
+                threading.Event().wait(1.0)
+
+    def _listen_once(self) -> None:
+        fairy = engine.raw_connection()
+        fairy.detach()  # Held for the life of the listener so keep it out of the pool
+        connection = fairy.dbapi_connection
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                if select_module.select([connection], [], [], 5.0) == ([], [], []):
+                    continue
+                connection.poll()
+                notifications, connection.notifies[:] = list(connection.notifies), []
+                self._relay([json.loads(notification.payload) for notification in notifications])
+        finally:
+            connection.close()
+
+    def _relay(self, payloads: List[dict]) -> None:
+        """Load and deliver events other workers published for sessions streamed here"""
+        wanted = [
+            payload for payload in payloads
+            if payload["origin"] != self.origin and self.has_subscribers(uuid.UUID(payload["session_id"]))
+        ]
+        if not wanted:
+            return
+        with SessionLocal() as db:
+            events = []
+            for payload in wanted:
+                session_id = uuid.UUID(payload["session_id"])
+                # Filter on the partition keys too so partitioned tables are pruned
+                row_id = uuid.UUID(payload["id"])
+                created_at = datetime.datetime.fromisoformat(payload["created_at"])
+                if payload["type"] == "message":
+                    row = db.scalars(
+                        select(models.Message)
+                        .where(models.Message.id == row_id)
+                        .where(models.Message.session_id == session_id)
+                        .where(models.Message.created_at == created_at)
+                    ).one_or_none()
+                    if row is not None:
+                        events.append(message_event(row))
+                else:
+                    row = db.scalars(
+                        select(models.Metamessage)
+                        .where(models.Metamessage.id == row_id)
+                        .where(models.Metamessage.message_id == uuid.UUID(payload["message_id"]))
+                        .where(models.Metamessage.created_at == created_at)
+                    ).one_or_none()
+                    if row is not None:
+                        events.append(metamessage_event(row, session_id))
+        self.deliver(events)
+
+
+def from_env() -> InProcessBus:
+    """Build the bus configured by EVENTS_BUS, by default listen/notify on Postgres"""
+    name = os.getenv("EVENTS_BUS", "auto")
+    if name == "auto":
+        name = "postgres" if engine.dialect.name == "postgresql" else "memory"
+    if name == "postgres":
+        return PostgresBus()
+    if name == "memory":
+        return InProcessBus()
+    raise ValueError(f"Unknown EVENTS_BUS {name}")
+
+
+bus = from_env()
+
+
+def notify(db: Session, events: List[Event]) -> None:
+    """Tell other workers about events for rows db is about to commit, logging rather than raising on failure"""
+    try:
+        bus.notify(db, events)
+    except Exception:
+        logger.exception("Failed to notify %d events", len(events))
+
+
+def publish(events: List[Event]) -> None:
+    """Deliver events for rows just committed to the streams of this worker"""
+    try:
+        bus.deliver(events)
+    except Exception:
+        logger.exception("Failed to publish %d events", len(events))
+
+
+def replay(db: Session, session_id: uuid.UUID, after: Cursor, limit: int = REPLAY_CHUNK_SIZE) -> List[Event]:
+    """Up to limit events of a session past the stream position after
+
+    Each kind comes in seq order, so every event up to the position of the
+    last one returned is included, and the two are merged by created_at.
+    """
+    messages = db.scalars(
+        select(models.Message)
+        .where(models.Message.session_id == session_id)
+        .where(models.Message.seq > after[0])
+        .order_by(models.Message.seq)
+        .limit(limit)
+    )
+    metamessages = db.scalars(
+        select(models.Metamessage)
+        .join(models.Message, models.Message.id == models.Metamessage.message_id)
+        .where(models.Message.session_id == session_id)
+        .where(models.Metamessage.seq > after[1])
+        .order_by(models.Metamessage.seq)
+        .limit(limit)
+    )
+    merged = heapq.merge(
+        [message_event(row) for row in messages],
+        [metamessage_event(row, session_id) for row in metamessages],
+        key=lambda event: event.data["created_at"],
+    )
+    return list(itertools.islice(merged, limit))
+
+
+def current_position(db: Session, session_id: uuid.UUID) -> Cursor:
+    """The stream position of everything committed in a session so far"""
+    row = db.execute(
+        select(models.Session.last_seq, models.Session.last_metamessage_seq).where(models.Session.id == session_id)
+    ).one_or_none()
+    return (row.last_seq, row.last_metamessage_seq) if row is not None else (0, 0)
+
+
+async def stream(session_id: uuid.UUID, last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    """Server-Sent Events for a session, replaying those after last_event_id first"""
+    subscription = bus.subscribe(session_id)
+
+    async def catch_up(cursor: Cursor) -> AsyncIterator[Tuple[Cursor, bytes]]:
+        while True:
+            def load(after=cursor):
+                with SessionLocal() as db:
+                    return replay(db, session_id, after)
+            events = await run_in_threadpool(load)
+            for event in events:
+                cursor = advance(cursor, event)
+                yield cursor, event.encode(cursor)
+            if len(events) < REPLAY_CHUNK_SIZE:
+                return
+
+    try:
+        # Subscribe before reading the position so no event falls between the two
+        if last_event_id is None:
+            def load_position():
+                with SessionLocal() as db:
+                    return current_position(db, session_id)
+            cursor = await run_in_threadpool(load_position)
+        else:
+            cursor = parse_id(last_event_id)
+            async for cursor, chunk in catch_up(cursor):
+                yield chunk
+        yield b"retry: 3000\n\n"
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if event is None:
+                # Fell too far behind, the client resumes from its last event
+                return
+            seen = position(cursor, event)
+            if event.seq <= seen:
+                continue
+            if event.seq == seen + 1:
+                cursor = advance(cursor, event)
+                yield event.encode(cursor)
+                continue
+            # Events committed before this one have not been published yet, read them from the database
+            async for cursor, chunk in catch_up(cursor):
+                yield chunk
+    finally:
+        bus.unsubscribe(subscription)
@@ -0,0 +1,124 @@
+"""Streaming export of everything stored for a user as NDJSON
+
+Each line is a JSON object with a `type` (session, message, metamessage,
+collection or document) and the same `data` the API returns for that
+object. Rows are read with server side cursors in batches of YIELD_PER so
+memory stays constant however much a user has stored.
+"""
+import zlib
+from typing import Iterable, Iterator
+
+from sqlalchemy import Select, select
+
+from . import archive, codec, models, serializers
+from .db import SessionLocal
+
+YIELD_PER = 500
+
+# Lines are sent in chunks of about this many bytes
+CHUNK_SIZE = 64 * 1024
+
+
+def _statements(app_id: str, user_id: str):
+    sessions = (
+        select(models.Session)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+    )
+    messages = (
+        select(models.Message)
+        .join(models.Session, models.Session.id == models.Message.session_id)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+    )
+    metamessages = (
+        select(models.Metamessage, models.Message.session_id)
+        .join(models.Message, models.Message.id == models.Metamessage.message_id)
+        .join(models.Session, models.Session.id == models.Message.session_id)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+    )
+    collections = (
+        select(models.Collection)
+        .where(models.Collection.app_id == app_id)
+        .where(models.Collection.user_id == user_id)
+    )
+    documents = (
+        select(models.Document)
+        .join(models.Collection, models.Collection.id == models.Document.collection_id)
+        .where(models.Collection.app_id == app_id)
+        .where(models.Collection.user_id == user_id)
+    )
+    return sessions, messages, metamessages, collections, documents
+
+
+def _document(row: models.Document, include_embeddings: bool) -> dict:
+    data = serializers.document(row)
+    if include_embeddings and row.embedding is not None:
+        data["embedding"] = [float(value) for value in row.embedding]
+    return data
+
+
+def _archived(db, app_id: str, user_id: str) -> Iterator[archive.ArchivedSession]:
+    stmt = (
+        select(models.SessionArchive)
+        .where(models.SessionArchive.app_id == app_id)
+        .where(models.SessionArchive.user_id == user_id)
+    )
+    return (archive.ArchivedSession(row) for row in _rows(db, stmt))
+
+
+def _rows(db, stmt: Select, scalars: bool = True) -> Iterator:
+    result = db.execute(stmt.execution_options(stream_results=True, yield_per=YIELD_PER))
+    return result.scalars() if scalars else result
+
+
+def records(app_id: str, user_id: str, include_embeddings: bool = False) -> Iterator[bytes]:
+    """NDJSON lines for every object of a user, in chunks of about CHUNK_SIZE bytes"""
+    sessions, messages, metamessages, collections, documents = _statements(app_id, user_id)
+    with SessionLocal() as db:
+        buffer = bytearray()
+
+        def line(kind: str, data: dict) -> None:
+            buffer.extend(codec.dumps({"type": kind, "data": data}))
+            buffer.extend(b"\n")
+
+        groups = (
+            ("session", sessions, True, serializers.session),
+            ("message", messages, True, serializers.message),
+            ("metamessage", metamessages, False, lambda row: {**serializers.metamessage(row[0]), "session_id": row[1]}),
+            ("collection", collections, True, serializers.collection),
+            ("document", documents, True, lambda row: _document(row, include_embeddings)),
+        )
+        for kind, stmt, scalars, serialize in groups:
+            for row in _rows(db, stmt, scalars):
+                line(kind, serialize(row))
+                if len(buffer) >= CHUNK_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+                    # Rows already sent are not needed again, keep the identity map from growing
+                    db.expunge_all()
+            if kind == "metamessage":
+                # Archived sessions are exported like the others, right after the live ones
+                for archived in _archived(db, app_id, user_id):
+                    line("session", archived.session)
+                    for message in archived.messages:
+                        line("message", message)
+                    for metamessage in archived.metamessages:
+                        line("metamessage", {**metamessage, "session_id": archived.id})
+                    if len(buffer) >= CHUNK_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+                        db.expunge_all()
+        if buffer:
+            yield bytes(buffer)
+
+
+def gzipped(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compress a stream of chunks into a single gzip file"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
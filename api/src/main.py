@@ -1,38 +1,68 @@
+import datetime
+import os
 import uuid
-from fastapi import Depends, FastAPI, HTTPException, APIRouter, Request
-from typing import Optional, Sequence
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, APIRouter, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Literal, Optional, Sequence
 from sqlalchemy.orm import Session
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.middleware import SlowAPIMiddleware
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
 from fastapi_pagination import Page, add_pagination
-from fastapi_pagination.ext.sqlalchemy import paginate
+from fastapi_pagination.api import resolve_params
 
-from . import crud, models, schemas
+from . import archive, crud, cursors, deletion, etags, events, export, metrics, migrate, models, ratelimit, replicas, schemas, serializers, tracing
+from .codec import FastJSONResponse
+from .compression import CompressionMiddleware
 from .db import SessionLocal, engine
 
-models.Base.metadata.create_all(bind=engine) # Scaffold Database if not already done
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Migrate the schema unless the runner already has, and release connections on shutdown"""
+    if os.getenv("MIGRATE_ON_STARTUP", "true").lower() == "true":
+        await run_in_threadpool(migrate.upgrade, engine)
+    if replicas.replica_set:
+        replicas.replica_set.start()
+    yield
+    crud.close_openai_client()
+    engine.dispose()
+    replicas.replica_set.dispose()
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 router = APIRouter(prefix="/apps/{app_id}/users/{user_id}")
 
-# Create a Limiter instance
-limiter = Limiter(key_func=get_remote_address, default_limits=["100/minute"])
+# Spans for requests, SQL statements, crud functions and embedding calls
+app.add_middleware(tracing.TracingMiddleware)
+tracing.instrument_engine(engine)
 
-# Add SlowAPI middleware to the application
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-app.add_middleware(SlowAPIMiddleware)
+# Request counts and latencies. Added first so it sees the matched route
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.registry.register(metrics.pool_gauge(engine.pool))
+metrics.registry.register(metrics.lookup_cache_gauge(crud.lookup_cache))
 
+# Compress large responses and accept compressed request bodies
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MINIMUM_SIZE", 1024)))
+
+# Rate limit per app (or app and user) and route class. Added last so it runs first
+app.add_middleware(
+    ratelimit.RateLimitMiddleware,
+    store=ratelimit.from_env(),
+    limits=ratelimit.limits_from_env(),
+    per_user=os.getenv("RATE_LIMIT_PER_USER", "false").lower() == "true",
+)
+
+# Route reads to replicas without losing the client's own writes. Outermost, the token is read before anything runs
+if replicas.replica_set:
+    app.add_middleware(replicas.ConsistencyMiddleware)
 
 add_pagination(app)
 
-def get_db():
-    """FastAPI Dependency Generator for Database"""
-    db = SessionLocal()
+MAX_BATCH_SIZE = 100
+
+def get_db(request: Request):
+    """FastAPI Dependency Generator for Database, reading from a replica for GET requests when there is one"""
+    db = replicas.session(request.method)
     try:
         yield db
     finally:
@@ -48,6 +78,7 @@ def get_sessions(
     app_id: str,
     user_id: str,
     location_id: Optional[str] = None,
+    order_by: Literal["created_at", "last_activity"] = "created_at",
     db: Session = Depends(get_db)
 ):
     """Get All Sessions for a User
@@ -56,12 +87,14 @@ def get_sessions(
         app_id (str): The ID of the app representing the client application using honcho
         user_id (str): The User ID representing the user, managed by the user
         location_id (str, optional): Optional Location ID representing the location of a session
+        order_by (str, optional): created_at for oldest first, or last_activity for the most recently active first
 
     Returns:
         list[schemas.Session]: List of Session objects 
 
     """
-    return paginate(db, crud.get_sessions(db, app_id=app_id, user_id=user_id, location_id=location_id))
+    stmt = crud.get_sessions(db, app_id=app_id, user_id=user_id, location_id=location_id, order_by=order_by)
+    return FastJSONResponse(serializers.page(db, stmt, serializers.session))
 
 
 @router.post("/sessions", response_model=schemas.Session)
@@ -80,7 +113,24 @@ def create_session(
         
     """
     value = crud.create_session(db, app_id=app_id, user_id=user_id, session=session)
-    return value
+    return FastJSONResponse(serializers.session(value))
+
+@router.post("/sessions/resolve", response_model=schemas.Session)
+def resolve_session(
+        request: Request, app_id: str, user_id: str, session: schemas.SessionCreate, db: Session = Depends(get_db)
+):
+    """Get the newest active Session for a User at a location, creating one if there is none
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        session (schemas.SessionCreate): The location ID to resolve and the metadata to use if a Session is created
+
+    Returns:
+        schemas.Session: The existing or newly created Session
+
+    """
+    return FastJSONResponse(serializers.session(crud.resolve_session(db, app_id=app_id, user_id=user_id, session=session)))
 
 @router.put("/sessions/{session_id}", response_model=schemas.Session)
 def update_session(
@@ -106,7 +156,7 @@ def update_session(
     if session.metadata is None:
         raise HTTPException(status_code=400, detail="Session metadata cannot be empty") # TODO TEST if I can set the metadata to be blank with this 
     try:
-        return crud.update_session(db, app_id=app_id, user_id=user_id, session_id=session_id, session=session) 
+        return FastJSONResponse(serializers.session(crud.update_session(db, app_id=app_id, user_id=user_id, session_id=session_id, session=session)))
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -116,23 +166,37 @@ def delete_session(
     app_id: str,
     user_id: str,
     session_id: uuid.UUID,
+    background_tasks: BackgroundTasks,
+    hard: bool = False,
+    background: bool = False,
     db: Session = Depends(get_db),
     ):
-    """Delete a session by marking it as inactive
+    """Delete a session by marking it as inactive, or for good with its messages
 
     Args:
         app_id (str): The ID of the app representing the client application using honcho
         user_id (str): The User ID representing the user, managed by the user
         session_id (int): The ID of the Session to delete
+        hard (bool, optional): Delete the session, its messages and metamessages instead of marking it inactive
+        background (bool, optional): With hard, answer 202 with a deletion job straight away and delete afterwards
 
     Returns:
-        dict: A message indicating that the session was deleted
+        dict: A message indicating that the session was deleted, or the deletion job
 
     Raises:
         HTTPException: If the session is not found
 
     """
-    response = crud.delete_session(db, app_id=app_id, user_id=user_id, session_id=session_id)
+    if hard and background:
+        job = crud.create_deletion_job(db, app_id=app_id, user_id=user_id, kind="session", target_id=session_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        background_tasks.add_task(deletion.run, job.id)
+        return FastJSONResponse(serializers.deletion_job(job), status_code=202)
+    if hard:
+        response = crud.hard_delete_session(db, app_id=app_id, user_id=user_id, session_id=session_id)
+    else:
+        response = crud.delete_session(db, app_id=app_id, user_id=user_id, session_id=session_id)
     if response:
         return {"message": "Session deleted successfully"}
     else:
@@ -153,10 +217,62 @@ def get_session(request: Request, app_id: str, user_id: str, session_id: uuid.UU
     Raises:
         HTTPException: If the session is not found
     """
-    honcho_session = crud.get_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
+    honcho_session = crud.get_session(db, app_id=app_id, session_id=session_id, user_id=user_id, cached=False)
     if honcho_session is None:
+        archived = archive.load(db, app_id=app_id, user_id=user_id, session_id=session_id)
+        if archived is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        etag = etags.make(archived.id, archived.archived_at)
+        if etags.matches(request, etag):
+            return etags.not_modified(etag)
+        return FastJSONResponse(archived.session, headers={"ETag": etag})
+    etag = etags.make(
+        honcho_session.id, honcho_session.is_active, honcho_session.location_id, honcho_session.h_metadata,
+        honcho_session.message_count, honcho_session.last_message_at,
+    )
+    if etags.matches(request, etag):
+        return etags.not_modified(etag)
+    return FastJSONResponse(serializers.session(honcho_session), headers={"ETag": etag})
+
+@router.get("/sessions/{session_id}/events")
+async def stream_session_events(
+    request: Request,
+    app_id: str,
+    user_id: str,
+    session_id: uuid.UUID,
+    last_event_id: Optional[str] = None,
+):
+    """Stream the messages and metamessages created in a session as Server-Sent Events
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        session_id (uuid.UUID): The ID of the Session to stream
+        last_event_id (str, optional): Replay the events after this one first. The Last-Event-ID header takes precedence. 0 replays the whole session
+
+    Returns:
+        StreamingResponse: text/event-stream of message and metamessage events
+
+    Raises:
+        HTTPException: If the session is not found or last_event_id is invalid
+    """
+    def get_session():
+        with SessionLocal() as db:
+            return crud.get_session(db, app_id=app_id, session_id=session_id, user_id=user_id)
+
+    if await run_in_threadpool(get_session) is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return honcho_session
+    last_event_id = request.headers.get("last-event-id", last_event_id)
+    if last_event_id is not None:
+        try:
+            events.parse_id(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    return StreamingResponse(
+        events.stream(session_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 ########################################################
 # Message Routes
@@ -186,13 +302,53 @@ def create_message_for_session(
         schemas.Message: The Message object of the added message
 
     Raises:
-        HTTPException: If the session is not found
+        HTTPException: If the session is not found, or 409 if the message ID is taken by another session
+
+    """
+    try:
+        return FastJSONResponse(serializers.message(crud.create_message(db, message=message, app_id=app_id, user_id=user_id, session_id=session_id)))
+    except crud.MessageIdConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+@router.post(
+    "/sessions/{session_id}/messages/batch",
+    response_model=Sequence[schemas.Message]
+)
+def create_messages_for_session(
+    request: Request,
+    app_id: str,
+    user_id: str,
+    session_id: uuid.UUID,
+    messages: list[schemas.MessageCreate],
+    db: Session = Depends(get_db),
+):
+    """Adds a batch of messages to a session in order
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        session_id (uuid.UUID): The ID of the Session to add the messages to
+        messages (list[schemas.MessageCreate]): The Message objects to add in order, at most 100
+
+    Returns:
+        list[schemas.Message]: The Message objects of the added messages
+
+    Raises:
+        HTTPException: If the session is not found or the batch is too large, or 409 if a message ID is
+            taken by another session or repeated
 
     """
+    if len(messages) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {MAX_BATCH_SIZE} messages")
     try:
-        return crud.create_message(db, message=message, app_id=app_id, user_id=user_id, session_id=session_id)
+        honcho_messages = crud.create_messages(db, messages=messages, app_id=app_id, user_id=user_id, session_id=session_id)
+    except crud.MessageIdConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
+    return FastJSONResponse([serializers.message(honcho_message) for honcho_message in honcho_messages])
 
 @router.get(
     "/sessions/{session_id}/messages", 
@@ -203,6 +359,7 @@ def get_messages_for_session(
     app_id: str,
     user_id: str,
     session_id: uuid.UUID,
+    after_seq: Optional[int] = None,
     db: Session = Depends(get_db),
 ):
     """Get all messages for a session
@@ -211,6 +368,7 @@ def get_messages_for_session(
         app_id (str): The ID of the app representing the client application using honcho
         user_id (str): The User ID representing the user, managed by the user
         session_id (int): The ID of the Session to retrieve
+        after_seq (int, optional): Only return messages with a greater seq, for fetching what is new
 
     Returns:
         list[schemas.Message]: List of Message objects
@@ -220,7 +378,19 @@ def get_messages_for_session(
 
     """
     try: 
-        return paginate(db, crud.get_messages(db, app_id=app_id, user_id=user_id, session_id=session_id))
+        stmt = crud.get_messages(db, app_id=app_id, user_id=user_id, session_id=session_id, after_seq=after_seq)
+        params = resolve_params()
+        etag, total = etags.for_query(db, stmt, params.page, params.size, after_seq)
+        if total == 0:
+            archived = archive.load(db, app_id=app_id, user_id=user_id, session_id=session_id)
+            if archived is not None:
+                etag = etags.make(archived.id, archived.archived_at, params.page, params.size, after_seq)
+                if etags.matches(request, etag):
+                    return etags.not_modified(etag)
+                return FastJSONResponse(serializers.page_of(archived.messages_after(after_seq)), headers={"ETag": etag})
+        if etags.matches(request, etag):
+            return etags.not_modified(etag)
+        return FastJSONResponse(serializers.page(db, stmt, serializers.message, total=total), headers={"ETag": etag})
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -241,8 +411,12 @@ def get_message(
     """
     honcho_message = crud.get_message(db, app_id=app_id, session_id=session_id, user_id=user_id, message_id=message_id)
     if honcho_message is None:
-        raise HTTPException(status_code=404, detail="Session not found")
-    return honcho_message
+        archived = archive.load(db, app_id=app_id, user_id=user_id, session_id=session_id)
+        archived_message = archived.message(message_id) if archived is not None else None
+        if archived_message is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return FastJSONResponse(archived_message)
+    return FastJSONResponse(serializers.message(honcho_message))
 
 ########################################################
 # metamessage routes
@@ -276,7 +450,7 @@ def create_metamessage(
 
     """
     try:
-        return crud.create_metamessage(db, metamessage=metamessage, app_id=app_id, user_id=user_id, session_id=session_id)
+        return FastJSONResponse(serializers.metamessage(crud.create_metamessage(db, metamessage=metamessage, app_id=app_id, user_id=user_id, session_id=session_id)))
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -308,7 +482,20 @@ def get_metamessages(
 
     """
     try: 
-        return paginate(db, crud.get_metamessages(db, app_id=app_id, user_id=user_id, session_id=session_id, message_id=message_id, metamessage_type=metamessage_type))
+        stmt = crud.get_metamessages(db, app_id=app_id, user_id=user_id, session_id=session_id, message_id=message_id, metamessage_type=metamessage_type)
+        params = resolve_params()
+        etag, total = etags.for_query(db, stmt, params.page, params.size)
+        if total == 0:
+            archived = archive.load(db, app_id=app_id, user_id=user_id, session_id=session_id)
+            if archived is not None:
+                etag = etags.make(archived.id, archived.archived_at, message_id, metamessage_type, params.page, params.size)
+                if etags.matches(request, etag):
+                    return etags.not_modified(etag)
+                metamessages = archived.find_metamessages(message_id=message_id, metamessage_type=metamessage_type)
+                return FastJSONResponse(serializers.page_of(metamessages), headers={"ETag": etag})
+        if etags.matches(request, etag):
+            return etags.not_modified(etag)
+        return FastJSONResponse(serializers.page(db, stmt, serializers.metamessage, total=total), headers={"ETag": etag})
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -329,8 +516,100 @@ def get_metamessage(request: Request, app_id: str, user_id: str, session_id: uui
     """
     honcho_metamessage = crud.get_metamessage(db, app_id=app_id, session_id=session_id, user_id=user_id, message_id=message_id, metamessage_id=metamessage_id)
     if honcho_metamessage is None:
-        raise HTTPException(status_code=404, detail="Session not found")
-    return honcho_metamessage
+        archived = archive.load(db, app_id=app_id, user_id=user_id, session_id=session_id)
+        matches = archived.find_metamessages(message_id=message_id) if archived is not None else []
+        archived_metamessage = next((item for item in matches if item["id"] == str(metamessage_id)), None)
+        if archived_metamessage is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return FastJSONResponse(archived_metamessage)
+    return FastJSONResponse(serializers.metamessage(honcho_metamessage))
+
+@router.get("/metamessages", response_model=schemas.CursorPage[schemas.UserMetamessage])
+def get_user_metamessages(
+    request: Request,
+    app_id: str,
+    user_id: str,
+    metamessage_type: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+    size: int = Query(50, ge=1, le=100),
+    db: Session = Depends(get_db),
+):
+    """Get a user's metamessages across all of their sessions, oldest first
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        metamessage_type (str, optional): Only metamessages of this type
+        since (datetime, optional): Only metamessages created at or after this time
+        cursor (str, optional): The next_cursor of the previous page
+        size (int, optional): The number of results per page
+
+    Returns:
+        schemas.CursorPage[schemas.UserMetamessage]: A page of metamessages with their session IDs
+
+    Raises:
+        HTTPException: If the cursor is invalid
+    """
+    try:
+        after = cursors.decode_created_id(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if since is not None and since.tzinfo is not None:
+        # created_at is stored as naive UTC
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    stmt = crud.get_user_metamessages(
+        db, app_id=app_id, user_id=user_id, metamessage_type=metamessage_type, since=since, after=after
+    )
+    rows = db.execute(stmt.limit(size + 1)).all()
+    return FastJSONResponse(cursors.page(
+        rows, size,
+        lambda row: serializers.user_metamessage(row.Metamessage, row.session_id),
+        key=lambda row: (row.Metamessage.created_at, row.Metamessage.id),
+    ))
+
+@router.get("/messages/search", response_model=schemas.CursorPage[schemas.SearchHit])
+def search_messages(
+    request: Request,
+    app_id: str,
+    user_id: str,
+    q: str = Query(..., min_length=1, max_length=1000),
+    session_id: Optional[uuid.UUID] = None,
+    location_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    size: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+):
+    """Search a user's messages by keyword, best matches first
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        q (str): The words to search for
+        session_id (uuid.UUID, optional): Only messages of this session
+        location_id (str, optional): Only messages of sessions at this location
+        cursor (str, optional): The next_cursor of the previous page
+        size (int, optional): The number of results per page
+
+    Returns:
+        schemas.CursorPage[schemas.SearchHit]: A page of matching messages with snippets and ranks
+
+    Raises:
+        HTTPException: If the cursor is invalid
+    """
+    try:
+        after = cursors.decode_score_id(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    stmt = crud.search_messages(
+        db, app_id=app_id, user_id=user_id, query=q, session_id=session_id, location_id=location_id, after=after
+    )
+    rows = db.execute(stmt.limit(size + 1)).all()
+    return FastJSONResponse(cursors.page(
+        rows, size,
+        lambda row: serializers.search_hit(row.Message, row.snippet, row.rank),
+        key=lambda row: (row.score, row.Message.id),
+    ))
 
 ########################################################
 # collection routes
@@ -343,7 +622,7 @@ def get_collections(
     user_id: str,
     db: Session = Depends(get_db),
 ):
-    return paginate(db, crud.get_collections(db, app_id=app_id, user_id=user_id))
+    return FastJSONResponse(serializers.page(db, crud.get_collections(db, app_id=app_id, user_id=user_id), serializers.collection))
 
 @router.get("/collections/id/{collection_id}", response_model=schemas.Collection)
 def get_collection_by_id(
@@ -356,7 +635,7 @@ def get_collection_by_id(
     honcho_collection = crud.get_collection_by_id(db, app_id=app_id, user_id=user_id, collection_id=collection_id)
     if honcho_collection is None:
         raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
-    return honcho_collection
+    return FastJSONResponse(serializers.collection(honcho_collection))
 
 @router.get("/collections/name/{name}", response_model=schemas.Collection)
 def get_collection_by_name(
@@ -369,7 +648,7 @@ def get_collection_by_name(
     honcho_collection = crud.get_collection_by_name(db, app_id=app_id, user_id=user_id, name=name)
     if honcho_collection is None:
         raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
-    return honcho_collection
+    return FastJSONResponse(serializers.collection(honcho_collection))
 
 @router.post("/collections", response_model=schemas.Collection)
 def create_collection(
@@ -380,7 +659,7 @@ def create_collection(
     db: Session = Depends(get_db)
 ):
     try:
-        return crud.create_collection(db, collection=collection, app_id=app_id, user_id=user_id)
+        return FastJSONResponse(serializers.collection(crud.create_collection(db, collection=collection, app_id=app_id, user_id=user_id)))
     except ValueError:
         raise HTTPException(status_code=406, detail="Error invalid collection configuration - name may already exist")
 
@@ -399,7 +678,7 @@ def update_collection(
         honcho_collection = crud.update_collection(db, collection=collection, app_id=app_id, user_id=user_id, collection_id=collection_id)
     except ValueError:
         raise HTTPException(status_code=406, detail="Error invalid collection configuration - name may already exist")
-    return honcho_collection
+    return FastJSONResponse(serializers.collection(honcho_collection))
 
 @router.delete("/collections/{collection_id}")
 def delete_collection(
@@ -407,14 +686,56 @@ def delete_collection(
     app_id: str,
     user_id: str,
     collection_id: uuid.UUID,
+    background_tasks: BackgroundTasks,
+    background: bool = False,
     db: Session = Depends(get_db)
 ):
+    """Delete a collection and its documents
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        collection_id (uuid.UUID): The ID of the Collection to delete
+        background (bool, optional): Answer 202 with a deletion job straight away and delete afterwards
+
+    Returns:
+        dict: A message indicating that the collection was deleted, or the deletion job
+
+    Raises:
+        HTTPException: If the collection is not found
+    """
+    if background:
+        job = crud.create_deletion_job(db, app_id=app_id, user_id=user_id, kind="collection", target_id=collection_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
+        background_tasks.add_task(deletion.run, job.id)
+        return FastJSONResponse(serializers.deletion_job(job), status_code=202)
     response = crud.delete_collection(db, app_id=app_id, user_id=user_id, collection_id=collection_id)
     if response:
         return {"message": "Collection deleted successfully"}
     else:
         raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
 
+@router.get("/deletions/{job_id}", response_model=schemas.DeletionJob)
+def get_deletion_job(request: Request, app_id: str, user_id: str, job_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Get the progress of a background deletion
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        job_id (uuid.UUID): The ID returned when the deletion was accepted
+
+    Returns:
+        schemas.DeletionJob: The job, deleted counts messages for sessions and documents for collections
+
+    Raises:
+        HTTPException: If the job is not found
+    """
+    job = crud.get_deletion_job(db, app_id=app_id, user_id=user_id, job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Deletion job not found")
+    return FastJSONResponse(serializers.deletion_job(job))
+
 ########################################################
 # Document routes
 ########################################################
@@ -428,7 +749,7 @@ def get_documents(
     db: Session = Depends(get_db)
 ):
     try:
-        return paginate(db, crud.get_documents(db, app_id=app_id, user_id=user_id, collection_id=collection_id))
+        return FastJSONResponse(serializers.page(db, crud.get_documents(db, app_id=app_id, user_id=user_id, collection_id=collection_id), serializers.document))
     except ValueError: # TODO can probably remove this exception ok to return empty here
         raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
 
@@ -444,7 +765,7 @@ def get_document(
     honcho_document = crud.get_document(db, app_id=app_id, user_id=user_id, collection_id=collection_id, document_id=document_id)
     if honcho_document is None:
         raise HTTPException(status_code=404, detail="document not found or does not belong to user")
-    return honcho_document
+    return FastJSONResponse(serializers.document(honcho_document))
 
 
 @router.get("/collections/{collection_id}/query", response_model=Sequence[schemas.Document])
@@ -459,7 +780,8 @@ def query_documents(
 ):
     if top_k is not None and top_k > 50:
         top_k = 50 # TODO see if we need to paginate this 
-    return crud.query_documents(db=db, app_id=app_id, user_id=user_id, collection_id=collection_id, query=query, top_k=top_k)
+    documents = crud.query_documents(db=db, app_id=app_id, user_id=user_id, collection_id=collection_id, query=query, top_k=top_k)
+    return FastJSONResponse([serializers.document(document) for document in documents])
 
 @router.post("/collections/{collection_id}/documents", response_model=schemas.Document)
 def create_document(
@@ -471,7 +793,7 @@ def create_document(
     db: Session = Depends(get_db)
 ):
     try:
-        return crud.create_document(db, document=document, app_id=app_id, user_id=user_id, collection_id=collection_id)
+        return FastJSONResponse(serializers.document(crud.create_document(db, document=document, app_id=app_id, user_id=user_id, collection_id=collection_id)))
     except ValueError:
         raise HTTPException(status_code=404, detail="collection not found or does not belong to user")
 
@@ -487,7 +809,7 @@ def update_document(
 ):
    if document.content is None and document.metadata is None:
         raise HTTPException(status_code=400, detail="content and metadata cannot both be None")
-   return crud.update_document(db, document=document, app_id=app_id, user_id=user_id, collection_id=collection_id, document_id=document_id) 
+   return FastJSONResponse(serializers.document(crud.update_document(db, document=document, app_id=app_id, user_id=user_id, collection_id=collection_id, document_id=document_id)))
 
 @router.delete("/collections/{collection_id}/documents/{document_id}")
 def delete_document(
@@ -504,4 +826,93 @@ def delete_document(
     else:
         raise HTTPException(status_code=404, detail="document not found or does not belong to user")
 
+########################################################
+# export routes
+########################################################
+
+@router.get("/export")
+def export_user(
+    request: Request,
+    app_id: str,
+    user_id: str,
+    gzip: bool = False,
+    include_embeddings: bool = False,
+):
+    """Stream every session, message, metamessage, collection and document of a user as NDJSON
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        user_id (str): The User ID representing the user, managed by the user
+        gzip (bool, optional): Send a gzip file instead of plain NDJSON
+        include_embeddings (bool, optional): Whether to include document embeddings
+
+    Returns:
+        StreamingResponse: One {"type": ..., "data": ...} object per line
+    """
+    records = export.records(app_id, user_id, include_embeddings=include_embeddings)
+    filename = "honcho-export.ndjson"
+    if gzip:
+        return StreamingResponse(
+            export.gzipped(records),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'},
+        )
+    return StreamingResponse(
+        records,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+########################################################
+# retention routes
+########################################################
+
+@app.get("/apps/{app_id}/retention", response_model=schemas.RetentionPolicy)
+def get_retention_policy(request: Request, app_id: str, db: Session = Depends(get_db)):
+    """Get the retention policy of an app and how many rows its last purges deleted
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+
+    Returns:
+        schemas.RetentionPolicy: The policy, with the progress of each kind of purge
+
+    Raises:
+        HTTPException: If the app has no retention policy
+    """
+    policy, checkpoints = crud.get_retention_policy(db, app_id=app_id)
+    if policy is None:
+        raise HTTPException(status_code=404, detail="Retention policy not found")
+    return FastJSONResponse(serializers.retention_policy(policy, checkpoints))
+
+@app.put("/apps/{app_id}/retention", response_model=schemas.RetentionPolicy)
+def set_retention_policy(request: Request, app_id: str, policy: schemas.RetentionPolicyUpdate, db: Session = Depends(get_db)):
+    """Set how many days an app keeps messages and documents, null keeps them forever
+
+    Args:
+        app_id (str): The ID of the app representing the client application using honcho
+        policy (schemas.RetentionPolicyUpdate): Days to keep messages (with their metamessages) and documents
+
+    Returns:
+        schemas.RetentionPolicy: The updated policy
+    """
+    honcho_policy = crud.set_retention_policy(db, app_id=app_id, policy=policy)
+    _, checkpoints = crud.get_retention_policy(db, app_id=app_id)
+    return FastJSONResponse(serializers.retention_policy(honcho_policy, checkpoints))
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus metrics of this worker"""
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/replicas")
+def get_replicas():
+    """Health and lag of the read replicas as last checked by this worker"""
+    return replicas.replica_set.stats()
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """Hit ratio and size of the session and collection lookup cache of this worker"""
+    return crud.lookup_cache.stats()
+
 app.include_router(router)
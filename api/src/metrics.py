@@ -0,0 +1,263 @@
+"""Prometheus metrics in the text exposition format
+
+A small registry of counters, gauges and histograms kept in plain dicts so
+recording a request costs a few dict lookups. Values are per worker process;
+run one worker per instance or aggregate by instance when scraping several.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Request latencies from a cached lookup up to a slow embedding call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self.values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from callback when rendered"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.callback = callback
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self.values[labels] = value
+
+    def render(self) -> List[str]:
+        if self.callback is None:
+            with self._lock:
+                items = list(self.values.items())
+        else:
+            items = list(self.callback().items())
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count for each bucket plus +Inf, then the sum
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        bounds = self.buckets + (float("inf"),)
+        # Copied under the lock so no label set is read half updated
+        with self._lock:
+            items = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in items:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """Context manager observing the time its block took"""
+
+    def __init__(self, histogram: Histogram, labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "honcho_http_requests_total", "HTTP requests by route template and status code", ("method", "route", "status")
+))
+http_request_duration = registry.register(Histogram(
+    "honcho_http_request_duration_seconds", "Time to handle HTTP requests by route template", ("method", "route")
+))
+http_requests_in_progress = registry.register(Gauge(
+    "honcho_http_requests_in_progress", "HTTP requests being handled", ("method",)
+))
+embedding_duration = registry.register(Histogram(
+    "honcho_embedding_request_duration_seconds", "Time taken by embedding provider calls", ("model",)
+))
+embedding_errors = registry.register(Counter(
+    "honcho_embedding_errors_total", "Embedding provider calls that raised", ("model", "error")
+))
+rate_limited = registry.register(Counter(
+    "honcho_rate_limited_total", "Requests rejected by the rate limiter", ("route_class",)
+))
+
+
+def pool_gauge(pool) -> Gauge:
+    """Gauge of a SQLAlchemy connection pool's connections by state, read when scraped"""
+    def read() -> Dict[Tuple[str, ...], float]:
+        states = {"size": "size", "checked_out": "checkedout", "checked_in": "checkedin", "overflow": "overflow"}
+        return {(state,): getattr(pool, method)() for state, method in states.items() if hasattr(pool, method)}
+
+    return Gauge("honcho_db_pool_connections", "Database connection pool connections by state", ("state",), callback=read)
+
+
+def lookup_cache_gauge(cache) -> Gauge:
+    """Gauge of the lookup cache's counters, read when scraped"""
+    def read() -> Dict[Tuple[str, ...], float]:
+        stats = cache.stats()
+        return {(name,): stats[name] for name in ("size", "hits", "misses", "invalidations")}
+
+    return Gauge("honcho_lookup_cache", "Session and collection lookup cache size and counters", ("stat",), callback=read)
+
+
+_templates: Dict[Callable, str] = {}
+
+
+def route_template(scope: Scope) -> str:
+    """The path template of the route that handled a request, or unmatched
+
+    Only known once the router has updated the scope, so middleware must call
+    it after the request and sit inside any middleware that copies the scope.
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    template = _templates.get(endpoint)
+    if template is None:
+        for route in scope["app"].router.routes:
+            if getattr(route, "endpoint", None) is not None:
+                _templates[route.endpoint] = route.path
+        template = _templates.setdefault(endpoint, "unmatched")
+    return template
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, latencies and requests in flight
+
+    Requests are labelled with the route template rather than the path so ids
+    do not create a series each. Add it first so it sits inside the other
+    middleware, where the router's scope updates are visible.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_progress.dec(method)
+            route = route_template(scope)
+            http_request_duration.observe(elapsed, method, route)
+            http_requests.inc(method, route, str(status))
@@ -0,0 +1,76 @@
+"""Apply pending schema migrations: python -m src.migrate
+
+On Postgres an advisory lock makes concurrent runs (several machines
+starting at once) wait for each other instead of racing, so the schema is
+migrated exactly once.
+"""
+import datetime
+import logging
+import sys
+from typing import List
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, insert, select, text
+from sqlalchemy.engine import Engine
+
+from . import migrations
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key shared by every process running migrations
+ADVISORY_LOCK_KEY = 7_246_051_301
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", String(16), primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """Apply every migration the database has not seen, returning their versions"""
+    applied = []
+    with engine.connect() as connection:
+        postgres = engine.dialect.name == "postgresql"
+        if postgres:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            connection.commit()
+        try:
+            with connection.begin():
+                schema_migrations.create(connection, checkfirst=True)
+            done = set(connection.scalars(select(schema_migrations.c.version)))
+            connection.commit()
+            for version, module in migrations.discover():
+                if version in done:
+                    continue
+                name = module.__name__.rpartition(".")[2]
+                logger.info("Applying migration %s", name)
+                with connection.begin():
+                    module.upgrade(connection)
+                    connection.execute(
+                        insert(schema_migrations).values(version=version, name=name, applied_at=datetime.datetime.utcnow())
+                    )
+                applied.append(version)
+        finally:
+            if postgres:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+                connection.commit()
+    return applied
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from .db import engine
+
+    applied = upgrade(engine)
+    if applied:
+        logger.info("Applied %d migrations", len(applied))
+    else:
+        logger.info("Schema is up to date")
+    engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
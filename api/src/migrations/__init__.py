@@ -0,0 +1,46 @@
+"""Schema migrations, applied in order by `python -m src.migrate`
+
+Each migration is a module named `m<number>_<name>` with an
+`upgrade(connection)` function. Applied versions are recorded in the
+`schema_migrations` table. Migrations must tolerate running against a
+schema that already has their changes, because the first migration creates
+missing tables from the current models.
+"""
+import importlib
+import pkgutil
+from types import ModuleType
+from typing import Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import Table
+
+
+def discover() -> List[Tuple[str, ModuleType]]:
+    """Every migration as (version, module), oldest first"""
+    migrations = []
+    for info in pkgutil.iter_modules(__path__):
+        if info.name.startswith("m") and info.name[1:5].isdigit():
+            migrations.append((info.name[1:5], importlib.import_module(f"{__name__}.{info.name}")))
+    return sorted(migrations, key=lambda migration: migration[0])
+
+
+def has_column(connection: Connection, table: str, column: str) -> bool:
+    return any(existing["name"] == column for existing in inspect(connection).get_columns(table))
+
+
+def index_names(connection: Connection, table: str) -> Set[str]:
+    if connection.dialect.name == "sqlite":
+        # SQLite reflection skips expression indexes
+        return set(connection.scalars(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"), {"table": table}
+        ))
+    return {index["name"] for index in inspect(connection).get_indexes(table)}
+
+
+def create_missing_indexes(connection: Connection, table: Table, names: Optional[Iterable[str]] = None) -> None:
+    """Create the indexes of a model's table, or only those named, that the database does not have yet"""
+    existing = index_names(connection, table.name)
+    for index in table.indexes:
+        if index.name not in existing and (names is None or index.name in names):
+            index.create(connection)
@@ -0,0 +1,15 @@
+"""Create missing tables, and bring databases made by create_all up to date"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes, has_column
+from .. import models
+
+
+def upgrade(connection: Connection) -> None:
+    models.Base.metadata.create_all(connection)
+
+    # Added with POST /sessions/resolve
+    if not has_column(connection, "sessions", "resolved"):
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN resolved BOOLEAN NOT NULL DEFAULT false"))
+    create_missing_indexes(connection, models.Session.__table__, ["uq_sessions_resolved_location"])
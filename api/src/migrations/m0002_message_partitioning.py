@@ -0,0 +1,23 @@
+"""Partition the messages and metamessages tables of a new Postgres database
+
+Only applies when MESSAGE_PARTITIONING is set and the tables are still
+empty. Tables that already hold rows are partitioned online with
+`python -m src.partitioning migrate`.
+"""
+import logging
+
+from sqlalchemy.engine import Connection
+
+from .. import partitioning
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade(connection: Connection) -> None:
+    kind = partitioning.layout()
+    if connection.dialect.name != "postgresql" or kind == "none":
+        return
+    if partitioning.is_partitioned(connection, "messages"):
+        return
+    if not partitioning.partition_empty_tables(connection, kind):
+        logger.warning("messages already has rows, partition it with python -m src.partitioning migrate")
@@ -0,0 +1,17 @@
+"""Add session_archives and make the session list indexes partial on is_active"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes
+from .. import models
+
+
+def upgrade(connection: Connection) -> None:
+    models.SessionArchive.__table__.create(connection, checkfirst=True)
+    # Replaced by ix_sessions_active_app_user_location_created
+    connection.execute(text("DROP INDEX IF EXISTS ix_sessions_app_user_location_created"))
+    create_missing_indexes(connection, models.Session.__table__, [
+        "ix_sessions_active_app_user_created",
+        "ix_sessions_active_app_user_location_created",
+        "ix_sessions_inactive_created",
+    ])
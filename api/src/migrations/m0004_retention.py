@@ -0,0 +1,15 @@
+"""Add retention policies and the indexes the purge walks"""
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes
+from .. import models, partitioning
+
+
+def upgrade(connection: Connection) -> None:
+    models.RetentionPolicy.__table__.create(connection, checkfirst=True)
+    models.RetentionCheckpoint.__table__.create(connection, checkfirst=True)
+    # Partitioned tables are created with their own equivalents of these
+    if connection.dialect.name != "postgresql" or not partitioning.is_partitioned(connection, "messages"):
+        create_missing_indexes(connection, models.Message.__table__, ["ix_messages_created_id"])
+        create_missing_indexes(connection, models.Metamessage.__table__, ["ix_metamessages_message_created"])
+    create_missing_indexes(connection, models.Document.__table__, ["ix_documents_created_id"])
@@ -0,0 +1,19 @@
+"""Add message_count and last_message_at to sessions and the index for listing by activity"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes, has_column
+from .. import models
+
+
+def upgrade(connection: Connection) -> None:
+    if not has_column(connection, "sessions", "message_count"):
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN last_message_at TIMESTAMP"))
+        # Sessions that already have messages
+        connection.execute(text(
+            "UPDATE sessions SET "
+            "message_count = (SELECT count(*) FROM messages WHERE messages.session_id = sessions.id), "
+            "last_message_at = (SELECT max(created_at) FROM messages WHERE messages.session_id = sessions.id)"
+        ))
+    create_missing_indexes(connection, models.Session.__table__, ["ix_sessions_active_app_user_activity"])
@@ -0,0 +1,30 @@
+"""Number each session's messages with seq and keep the last one on sessions"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes, has_column
+from .. import models, partitioning
+
+
+def upgrade(connection: Connection) -> None:
+    postgres = connection.dialect.name == "postgresql"
+    if not has_column(connection, "sessions", "last_seq"):
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN last_seq BIGINT NOT NULL DEFAULT 0"))
+    if not has_column(connection, "messages", "seq"):
+        connection.execute(text("ALTER TABLE messages ADD COLUMN seq BIGINT NOT NULL DEFAULT 0"))
+        # Existing messages keep the order they were listed in
+        connection.execute(text(
+            "UPDATE messages SET seq = numbered.seq FROM ("
+            "SELECT id, row_number() OVER (PARTITION BY session_id ORDER BY created_at, id) AS seq FROM messages"
+            ") AS numbered WHERE messages.id = numbered.id"
+        ))
+        if postgres:
+            connection.execute(text("ALTER TABLE messages ALTER COLUMN seq DROP DEFAULT"))
+        connection.execute(text(
+            "UPDATE sessions SET last_seq = (SELECT coalesce(max(seq), 0) FROM messages WHERE messages.session_id = sessions.id)"
+        ))
+    if postgres and partitioning.is_partitioned(connection, "messages"):
+        unique = "UNIQUE " if partitioning.layout() == "hash" else ""
+        connection.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS messages_part_session_seq_idx ON messages (session_id, seq)"))
+    else:
+        create_missing_indexes(connection, models.Message.__table__, ["uq_messages_session_seq"])
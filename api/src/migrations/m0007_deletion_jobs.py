@@ -0,0 +1,10 @@
+"""Add deletion_jobs and the index for deleting a collection's documents in batches"""
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes
+from .. import models
+
+
+def upgrade(connection: Connection) -> None:
+    models.DeletionJob.__table__.create(connection, checkfirst=True)
+    create_missing_indexes(connection, models.Document.__table__, ["ix_documents_collection_id"])
@@ -0,0 +1,15 @@
+"""Add the (metamessage_type, created_at, id) index for listing a user's metamessages across sessions"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes
+from .. import models, partitioning
+
+
+def upgrade(connection: Connection) -> None:
+    if connection.dialect.name == "postgresql" and partitioning.is_partitioned(connection, "metamessages"):
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS metamessages_part_type_created_idx ON metamessages (metamessage_type, created_at, id)"
+        ))
+    else:
+        create_missing_indexes(connection, models.Metamessage.__table__, ["ix_metamessages_type_created_id"])
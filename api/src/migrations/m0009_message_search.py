@@ -0,0 +1,17 @@
+"""Index message content for full text search, see src/search.py"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes
+from .. import models, partitioning, search
+
+
+def upgrade(connection: Connection) -> None:
+    if connection.dialect.name == "sqlite":
+        search.create_sqlite_index(connection)
+    elif partitioning.is_partitioned(connection, "messages"):
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS messages_part_search_idx ON messages USING gin (to_tsvector('english', content))"
+        ))
+    else:
+        create_missing_indexes(connection, models.Message.__table__, ["ix_messages_content_search"])
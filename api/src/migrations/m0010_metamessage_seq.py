@@ -0,0 +1,27 @@
+"""Number each session's metamessages with seq and keep the last one on sessions, for resuming event streams"""
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import has_column
+
+
+def upgrade(connection: Connection) -> None:
+    if not has_column(connection, "sessions", "last_metamessage_seq"):
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN last_metamessage_seq BIGINT NOT NULL DEFAULT 0"))
+    if not has_column(connection, "metamessages", "seq"):
+        connection.execute(text("ALTER TABLE metamessages ADD COLUMN seq BIGINT NOT NULL DEFAULT 0"))
+        # Existing metamessages keep the order they were streamed in
+        connection.execute(text(
+            "UPDATE metamessages SET seq = numbered.seq FROM ("
+            "SELECT metamessages.id, row_number() OVER ("
+            "PARTITION BY messages.session_id ORDER BY metamessages.created_at, metamessages.id"
+            ") AS seq FROM metamessages JOIN messages ON messages.id = metamessages.message_id"
+            ") AS numbered WHERE metamessages.id = numbered.id"
+        ))
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("ALTER TABLE metamessages ALTER COLUMN seq DROP DEFAULT"))
+        connection.execute(text(
+            "UPDATE sessions SET last_metamessage_seq = ("
+            "SELECT coalesce(max(metamessages.seq), 0) FROM metamessages "
+            "JOIN messages ON messages.id = metamessages.message_id WHERE messages.session_id = sessions.id)"
+        ))
@@ -0,0 +1,21 @@
+"""Record when sessions were deleted and index inactive sessions by it, for archival"""
+import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from . import create_missing_indexes, has_column
+from .. import models
+
+
+def upgrade(connection: Connection) -> None:
+    if not has_column(connection, "sessions", "deactivated_at"):
+        connection.execute(text("ALTER TABLE sessions ADD COLUMN deactivated_at TIMESTAMP"))
+        # When sessions deleted so far were deleted is unknown, so they wait the full period from now
+        connection.execute(
+            text("UPDATE sessions SET deactivated_at = :now WHERE NOT is_active"),
+            {"now": datetime.datetime.utcnow()},
+        )
+    # Replaced by ix_sessions_inactive_deactivated
+    connection.execute(text("DROP INDEX IF EXISTS ix_sessions_inactive_created"))
+    create_missing_indexes(connection, models.Session.__table__, ["ix_sessions_inactive_deactivated"])
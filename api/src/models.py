@@ -1,10 +1,11 @@
 import datetime
 import os
 import uuid
+from typing import Optional
 
 from dotenv import load_dotenv
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import JSON, Column, ForeignKey, String, UniqueConstraint, Uuid
+from sqlalchemy import JSON, BigInteger, Column, ForeignKey, Index, LargeBinary, String, UniqueConstraint, Uuid, text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -23,13 +24,59 @@ class Session(Base):
     user_id: Mapped[str] = mapped_column(String(512), index=True)
     location_id: Mapped[str] = mapped_column(String(512), index=True)
     is_active: Mapped[bool] = mapped_column(default=True)
+    resolved: Mapped[bool] = mapped_column(default=False) # created by resolve_session, at most one active per location
     h_metadata: Mapped[dict] = mapped_column("metadata", ColumnType, default={}) 
     created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    # Kept up to date by create_message and create_messages, see stats.py for repairing drift
+    message_count: Mapped[int] = mapped_column(default=0, server_default=text("0"))
+    last_message_at: Mapped[Optional[datetime.datetime]]
+    # Set by delete_session, archive.py archives sessions by how long ago they were deleted
+    deactivated_at: Mapped[Optional[datetime.datetime]]
+    # The seq of the newest message ever added, never decreases
+    last_seq: Mapped[int] = mapped_column(BigInteger, default=0, server_default=text("0"))
+    # The seq of the newest metamessage ever added to the session's messages
+    last_metamessage_seq: Mapped[int] = mapped_column(BigInteger, default=0, server_default=text("0"))
     messages = relationship("Message", back_populates="session")
 
+    __table_args__ = (
+        # Listing and resolving only ever reads active sessions, so inactive ones stay out of these
+        Index("ix_sessions_active_app_user_created", "app_id", "user_id", "created_at",
+              postgresql_where=text("is_active"), sqlite_where=text("is_active")),
+        Index("ix_sessions_active_app_user_location_created", "app_id", "user_id", "location_id", "created_at",
+              postgresql_where=text("is_active"), sqlite_where=text("is_active")),
+        # Listing by last activity, the expression must match the ORDER BY in crud.get_sessions
+        Index("ix_sessions_active_app_user_activity", "app_id", "user_id", text("coalesce(last_message_at, created_at)"),
+              postgresql_where=text("is_active"), sqlite_where=text("is_active")),
+        # Candidates for archival
+        Index("ix_sessions_inactive_deactivated", "deactivated_at",
+              postgresql_where=text("NOT is_active"), sqlite_where=text("NOT is_active")),
+        # Guards against concurrent resolve_session calls both creating a session
+        Index(
+            "uq_sessions_resolved_location", "app_id", "user_id", "location_id",
+            unique=True,
+            postgresql_where=text("is_active AND resolved"),
+            sqlite_where=text("is_active AND resolved"),
+        ),
+    )
+
     def __repr__(self) -> str:
         return f"Session(id={self.id}, app_id={self.app_id}, user_id={self.user_id}, location_id={self.location_id}, is_active={self.is_active}, created_at={self.created_at}, h_metadata={self.h_metadata})"
 
+class SessionArchive(Base):
+    """An inactive session moved out of the hot tables with its messages and metamessages, see archive.py"""
+    __tablename__ = "session_archives"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True)
+    app_id: Mapped[str] = mapped_column(String(512))
+    user_id: Mapped[str] = mapped_column(String(512))
+    location_id: Mapped[str] = mapped_column(String(512))
+    created_at: Mapped[datetime.datetime]
+    archived_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    data: Mapped[bytes] = mapped_column(LargeBinary) # zlib compressed JSON
+
+    __table_args__ = (
+        Index("ix_session_archives_app_user", "app_id", "user_id"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True, index=True, default=uuid.uuid4)
@@ -38,8 +85,21 @@ class Message(Base):
     content: Mapped[str]  = mapped_column(String(65535)) 
 
     created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    # Position in the session starting at 1, allocated from sessions.last_seq
+    seq: Mapped[int] = mapped_column(BigInteger)
     session = relationship("Session", back_populates="messages")
     metamessages = relationship("Metamessage", back_populates="message")
+
+    __table_args__ = (
+        # Retention purges walk messages oldest first
+        Index("ix_messages_created_id", "created_at", "id"),
+        # Orders a session's messages and serves after_seq reads
+        Index("uq_messages_session_seq", "session_id", "seq", unique=True),
+        # Full text search, SQLite searches the messages_fts table of src/search.py instead
+        Index("ix_messages_content_search", text("to_tsvector('english', content)"),
+              postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
+
     def __repr__(self) -> str:
         return f"Message(id={self.id}, session_id={self.session_id}, is_user={self.is_user}, content={self.content[10:]})"
 
@@ -52,6 +112,14 @@ class Metamessage(Base):
 
     message = relationship("Message", back_populates="metamessages")
     created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    # Position among the metamessages of the session starting at 1, allocated from sessions.last_metamessage_seq
+    seq: Mapped[int] = mapped_column(BigInteger)
+
+    __table_args__ = (
+        Index("ix_metamessages_message_created", "message_id", "created_at"),
+        # Listing a user's metamessages of one type across sessions, in keyset order
+        Index("ix_metamessages_type_created_id", "metamessage_type", "created_at", "id"),
+    )
 
     def __repr__(self) -> str:
         return f"Metamessages(id={self.id}, message_id={self.message_id}, metamessage_type={self.metamessage_type}, content={self.content[10:]})"
@@ -63,7 +131,8 @@ class Collection(Base):
     app_id: Mapped[str] = mapped_column(String(512), index=True)
     user_id: Mapped[str] = mapped_column(String(512), index=True)
     created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
-    documents = relationship("Document", back_populates="collection", cascade="all, delete, delete-orphan")
+    # Deleted with set based statements in deletion.py, not by cascading through loaded objects
+    documents = relationship("Document", back_populates="collection")
 
     __table_args__ = (
         UniqueConstraint('name', 'app_id', 'user_id', name="unique_name_app_user"),
@@ -79,3 +148,52 @@ class Document(Base):
     
     collection_id = Column(Uuid, ForeignKey("collections.id"))
     collection = relationship("Collection", back_populates="documents")
+
+    __table_args__ = (
+        Index("ix_documents_created_id", "created_at", "id"),
+        # Finds a collection's documents to delete in batches
+        Index("ix_documents_collection_id", "collection_id", "id"),
+    )
+
+class RetentionPolicy(Base):
+    """How long an app keeps its messages (with their metamessages) and documents, forever when None"""
+    __tablename__ = "retention_policies"
+    app_id: Mapped[str] = mapped_column(String(512), primary_key=True)
+    message_days: Mapped[Optional[int]]
+    document_days: Mapped[Optional[int]]
+    updated_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class RetentionCheckpoint(Base):
+    """Progress of the retention purge of one kind of row for an app, see retention.py"""
+    __tablename__ = "retention_checkpoints"
+    app_id: Mapped[str] = mapped_column(String(512), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32), primary_key=True)
+    # Key of the newest row deleted by an unfinished run, where the next run resumes
+    last_created_at: Mapped[Optional[datetime.datetime]]
+    last_id: Mapped[Optional[uuid.UUID]]
+    purged: Mapped[int] = mapped_column(default=0)
+    started_at: Mapped[Optional[datetime.datetime]]
+    finished_at: Mapped[Optional[datetime.datetime]]
+
+class DeletionJob(Base):
+    """A session or collection being deleted in the background, see deletion.py"""
+    __tablename__ = "deletion_jobs"
+    id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    app_id: Mapped[str] = mapped_column(String(512))
+    user_id: Mapped[str] = mapped_column(String(512))
+    kind: Mapped[str] = mapped_column(String(32)) # session or collection
+    target_id: Mapped[uuid.UUID]
+    status: Mapped[str] = mapped_column(String(32), default="pending") # pending, running, done or failed
+    deleted: Mapped[int] = mapped_column(default=0)
+    total: Mapped[Optional[int]] # Rows expected to be deleted, estimated when the job starts
+    error: Mapped[Optional[str]] = mapped_column(String(65535))
+    created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    updated_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    finished_at: Mapped[Optional[datetime.datetime]]
+
+    __table_args__ = (
+        # Unfinished jobs for the resume command
+        Index("ix_deletion_jobs_unfinished", "updated_at",
+              postgresql_where=text("status IN ('pending', 'running')"),
+              sqlite_where=text("status IN ('pending', 'running')")),
+    )
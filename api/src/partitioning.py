@@ -0,0 +1,353 @@
+"""Optional Postgres declarative partitioning of messages and metamessages
+
+MESSAGE_PARTITIONING selects the layout:
+    none: Plain tables (the default, and the only option on SQLite)
+    hash: messages by HASH(session_id) and metamessages by HASH(message_id)
+        into MESSAGE_PARTITIONS partitions each
+    range: Both by RANGE(created_at) in monthly partitions, with a default
+        partition catching rows no monthly partition covers yet
+
+Postgres requires the partition key in every unique constraint, so the
+primary keys become (id, <partition key>) and the foreign key from
+metamessages to messages is dropped. crud already checks the message
+exists before creating a metamessage. For the same reason (session_id, seq)
+is only a unique index with the hash layout, with the range layout its
+uniqueness rests on seqs being allocated under the session's row lock.
+
+A new database gets the layout from the m0002 migration. Existing data is
+moved online with
+
+    python -m src.partitioning migrate
+
+which builds partitioned copies of the tables, mirrors writes into them
+with triggers while it copies rows over in batches, then swaps the tables
+in one short transaction. The old tables are kept as *_unpartitioned
+until dropped with `python -m src.partitioning drop-old`. With the range
+layout run `python -m src.partitioning maintain` daily to create the
+coming months' partitions.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ("none", "hash", "range")
+
+TABLES = ("messages", "metamessages")
+
+# Monthly partitions created ahead of the current month
+PREMAKE_MONTHS = 3
+
+# Rows copied per transaction by the online migration
+BATCH_SIZE = 5000
+
+# Lower bounds on created_at derived from a session's created_at are widened
+# by this much, created_at is set by the API process and clocks can drift
+CLOCK_SLACK = datetime.timedelta(days=1)
+
+PARTITION_KEYS = {
+    "hash": {"messages": "session_id", "metamessages": "message_id"},
+    "range": {"messages": "created_at", "metamessages": "created_at"},
+}
+
+COLUMNS = {
+    "messages": """
+        id UUID NOT NULL,
+        session_id UUID NOT NULL REFERENCES sessions (id),
+        is_user BOOLEAN NOT NULL,
+        content VARCHAR(65535) NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        seq BIGINT NOT NULL""",
+    "metamessages": """
+        id UUID NOT NULL,
+        metamessage_type VARCHAR(512) NOT NULL,
+        content VARCHAR(65535) NOT NULL,
+        message_id UUID NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        seq BIGINT NOT NULL""",
+}
+
+# Postgres only allows unique indexes that contain the partition key
+UNIQUE_INDEXES = {
+    "hash": {"messages_part_session_seq_idx"},
+    "range": set(),
+}
+
+# Served by the same queries as the plain tables' full text index
+GIN_INDEXES = {"messages_part_search_idx"}
+
+# Index names are global in a schema, these must differ from the plain tables' ix_* indexes
+INDEXES = {
+    "messages": [
+        ("messages_part_id_idx", "id"),
+        ("messages_part_session_created_idx", "session_id, created_at"),
+        ("messages_part_created_idx", "created_at, id"),
+        ("messages_part_session_seq_idx", "session_id, seq"),
+        ("messages_part_search_idx", "to_tsvector('english', content)"),
+    ],
+    "metamessages": [
+        ("metamessages_part_id_idx", "id"),
+        ("metamessages_part_message_created_idx", "message_id, created_at"),
+        ("metamessages_part_type_idx", "metamessage_type"),
+        ("metamessages_part_type_created_idx", "metamessage_type, created_at, id"),
+    ],
+}
+
+
+def layout() -> str:
+    """The layout configured by MESSAGE_PARTITIONING"""
+    name = os.getenv("MESSAGE_PARTITIONING", "none")
+    if name not in LAYOUTS:
+        raise ValueError(f"Unknown MESSAGE_PARTITIONING {name}, expected one of {', '.join(LAYOUTS)}")
+    return name
+
+
+def partition_count() -> int:
+    return int(os.getenv("MESSAGE_PARTITIONS", 16))
+
+
+def lower_bound(session_created_at: datetime.datetime) -> Optional[datetime.datetime]:
+    """The earliest created_at a message or metamessage of a session can have
+
+    Adding `created_at >= lower_bound` to a range partitioned query lets
+    Postgres skip every partition from before the session existed. None
+    when the layout has nothing to gain from it.
+    """
+    if layout() != "range":
+        return None
+    return session_created_at - CLOCK_SLACK
+
+
+def is_partitioned(connection: Connection, table: str) -> bool:
+    return connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table)"),
+        {"table": table},
+    ).scalar()
+
+
+def _exists(connection: Connection, table: str) -> bool:
+    return connection.execute(text("SELECT to_regclass(:table) IS NOT NULL"), {"table": table}).scalar()
+
+
+def _month(day: datetime.date, offset: int = 0) -> datetime.date:
+    months = day.year * 12 + day.month - 1 + offset
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+
+def create_table(connection: Connection, table: str, name: str, kind: str) -> None:
+    """Create a partitioned table with the columns of table under name, with its partitions and indexes"""
+    key = PARTITION_KEYS[kind][table]
+    connection.execute(text(
+        f"CREATE TABLE {name} ({COLUMNS[table]},\n"
+        f"        CONSTRAINT {table}_part_pkey PRIMARY KEY (id, {key})\n"
+        f"    ) PARTITION BY {kind.upper()} ({key})"
+    ))
+    if kind == "hash":
+        count = partition_count()
+        for remainder in range(count):
+            connection.execute(text(
+                f"CREATE TABLE {table}_p{remainder} PARTITION OF {name} FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})"
+            ))
+    else:
+        connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {name} DEFAULT"))
+        first = connection.execute(text(f"SELECT min(created_at) FROM {table}")).scalar() if _exists(connection, table) else None
+        create_range_partitions(connection, table, name, since=first.date() if first else None)
+    for index, columns in INDEXES[table]:
+        unique = "UNIQUE " if index in UNIQUE_INDEXES[kind] else ""
+        using = " USING gin" if index in GIN_INDEXES else ""
+        connection.execute(text(f"CREATE {unique}INDEX {index} ON {name}{using} ({columns})"))
+
+
+def create_range_partitions(
+    connection: Connection, table: str, name: Optional[str] = None, since: Optional[datetime.date] = None
+) -> List[str]:
+    """Create the monthly partitions from since (or this month) to PREMAKE_MONTHS ahead that are missing"""
+    name = name or table
+    today = datetime.datetime.utcnow().date()
+    month = _month(min(since or today, today))
+    last = _month(today, PREMAKE_MONTHS)
+    created = []
+    while month <= last:
+        partition = f"{table}_y{month.year}m{month.month:02d}"
+        if not _exists(connection, partition):
+            connection.execute(text(
+                f"CREATE TABLE {partition} PARTITION OF {name} FOR VALUES FROM ('{month.isoformat()}') TO ('{_month(month, 1).isoformat()}')"
+            ))
+            created.append(partition)
+        month = _month(month, 1)
+    return created
+
+
+def partition_empty_tables(connection: Connection, kind: str) -> bool:
+    """Replace the plain tables with partitioned ones if they hold no rows, for new databases"""
+    if any(connection.execute(text(f"SELECT EXISTS (SELECT 1 FROM {table})")).scalar() for table in TABLES):
+        return False
+    connection.execute(text("DROP TABLE metamessages"))
+    connection.execute(text("DROP TABLE messages"))
+    for table in TABLES:
+        create_table(connection, table, table, kind)
+    return True
+
+
+########################################################
+# Online migration of existing tables
+########################################################
+
+MIRROR_FUNCTION = """
+CREATE OR REPLACE FUNCTION {table}_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {table}_partitioned WHERE id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {table}_partitioned SELECT NEW.* ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def _column_list(connection: Connection, table: str) -> str:
+    columns = connection.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_name = :table ORDER BY ordinal_position"),
+        {"table": table},
+    ).scalars()
+    return ", ".join(columns)
+
+
+def prepare(engine: Engine, kind: str) -> None:
+    """Create the partitioned copies and start mirroring writes into them"""
+    with engine.begin() as connection:
+        for table in TABLES:
+            if is_partitioned(connection, table):
+                raise RuntimeError(f"{table} is already partitioned")
+            if _exists(connection, f"{table}_partitioned"):
+                continue
+            create_table(connection, table, f"{table}_partitioned", kind)
+            # The copy's columns must come in the same order for NEW.* to line up
+            if _column_list(connection, table) != _column_list(connection, f"{table}_partitioned"):
+                raise RuntimeError(f"{table} has columns the partitioned layout does not know about")
+            connection.execute(text(MIRROR_FUNCTION.format(table=table)))
+            connection.execute(text(
+                f"CREATE TRIGGER {table}_mirror AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION {table}_mirror()"
+            ))
+
+
+def backfill(engine: Engine, table: str, batch_size: int = BATCH_SIZE, pause: float = 0.0) -> int:
+    """Copy the rows of table into its partitioned copy in keyset ordered batches, returning the rows copied
+
+    Each batch locks the rows it copies with FOR SHARE. A concurrent update or
+    delete of one of them waits for the batch to commit, so its mirror
+    trigger finds the copy and removes it. A row deleted before its batch
+    locks it is skipped. Without the lock a purged row could be copied after
+    its trigger ran and survive the swap.
+    """
+    copied = 0
+    after = None
+    while True:
+        with engine.begin() as connection:
+            where = "WHERE (created_at, id) > (:created_at, :id)" if after else ""
+            keys = connection.execute(
+                text(f"SELECT created_at, id FROM {table} {where} ORDER BY created_at, id LIMIT :limit"),
+                {"created_at": after[0], "id": after[1], "limit": batch_size} if after else {"limit": batch_size},
+            ).all()
+            if not keys:
+                return copied
+            result = connection.execute(
+                text(
+                    f"INSERT INTO {table}_partitioned SELECT * FROM {table} "
+                    f"WHERE (created_at, id) >= (:first_created_at, :first_id) AND (created_at, id) <= (:last_created_at, :last_id) "
+                    f"FOR SHARE ON CONFLICT DO NOTHING"
+                ),
+                {
+                    "first_created_at": keys[0].created_at, "first_id": keys[0].id,
+                    "last_created_at": keys[-1].created_at, "last_id": keys[-1].id,
+                },
+            )
+            copied += result.rowcount
+        after = (keys[-1].created_at, keys[-1].id)
+        logger.info("Copied %d rows of %s", copied, table)
+        if pause:
+            time.sleep(pause)
+
+
+def swap(engine: Engine) -> None:
+    """Put the partitioned tables in place of the plain ones
+
+    Takes an exclusive lock on both tables for as long as a few renames
+    take. The triggers kept the copies current so nothing is copied here.
+    """
+    with engine.begin() as connection:
+        connection.execute(text("SET LOCAL lock_timeout = '10s'"))
+        connection.execute(text("LOCK TABLE messages, metamessages IN ACCESS EXCLUSIVE MODE"))
+        for table in TABLES:
+            connection.execute(text(f"DROP TRIGGER {table}_mirror ON {table}"))
+            connection.execute(text(f"DROP FUNCTION {table}_mirror()"))
+            connection.execute(text(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned"))
+            connection.execute(text(f"ALTER TABLE {table}_partitioned RENAME TO {table}"))
+
+
+def drop_old(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS metamessages_unpartitioned"))
+        connection.execute(text("DROP TABLE IF EXISTS messages_unpartitioned"))
+
+
+def migrate(engine: Engine, kind: str, batch_size: int = BATCH_SIZE, pause: float = 0.0) -> None:
+    """Move messages and metamessages into partitioned tables while the API keeps serving"""
+    prepare(engine, kind)
+    for table in TABLES:
+        backfill(engine, table, batch_size, pause)
+    swap(engine)
+
+
+def maintain(engine: Engine) -> List[str]:
+    """Create the coming months' partitions of range partitioned tables"""
+    created = []
+    with engine.begin() as connection:
+        for table in TABLES:
+            if is_partitioned(connection, table) and layout() == "range":
+                created.extend(create_range_partitions(connection, table))
+    return created
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.partitioning", description="Partition messages and metamessages")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="Move existing rows into the MESSAGE_PARTITIONING layout online")
+    migrate_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    migrate_parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    commands.add_parser("maintain", help="Create upcoming monthly partitions")
+    commands.add_parser("drop-old", help="Drop the tables left behind by migrate")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from .db import engine
+
+    if engine.dialect.name != "postgresql":
+        logger.error("Partitioning needs Postgres")
+        return 1
+    if args.command == "migrate":
+        if layout() == "none":
+            logger.error("Set MESSAGE_PARTITIONING to hash or range")
+            return 1
+        migrate(engine, layout(), args.batch_size, args.pause)
+    elif args.command == "maintain":
+        logger.info("Created partitions: %s", ", ".join(maintain(engine)) or "none")
+    else:
+        drop_old(engine)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""Token bucket rate limiting keyed by tenant
+
+Every request under /apps/{app_id} takes a token from a bucket for its app
+(or app and user) and route class. Buckets hold up to `limit` tokens and
+refill continuously at limit / period, so a tenant can burst up to its limit
+and is then paced to the average rate. Requests outside /apps are not limited.
+
+Bucket state lives in a store. The memory store is private to a worker, the
+SQLite store is shared by every worker on a host and the Redis store by every
+host. Responses carry X-RateLimit-Limit, X-RateLimit-Remaining and
+X-RateLimit-Reset (seconds until the bucket is full again) and a 429 adds
+Retry-After with the seconds until the next token.
+"""
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import metrics
+from .codec import FastJSONResponse
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - optional dependency
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+TENANT_PATH = re.compile(r"^/apps/(?P<app_id>[^/]+)(?:/users/(?P<user_id>[^/]+))?(?P<rest>/.*)?$")
+
+
+class Limit(NamedTuple):
+    limit: int
+    period: float
+
+    @classmethod
+    def parse(cls, value: str) -> "Limit":
+        """Parse a limit written like 100/minute"""
+        count, _, period = value.strip().partition("/")
+        if period not in PERIODS:
+            raise ValueError(f"Invalid rate limit {value}, expected <count>/<second|minute|hour|day>")
+        return cls(int(count), PERIODS[period])
+
+    @property
+    def rate(self) -> float:
+        """Tokens added per second"""
+        return self.limit / self.period
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    remaining: int
+    retry_after: float
+    reset_after: float
+
+
+def decide(allowed: bool, tokens: float, limit: Limit) -> Decision:
+    """The decision for a bucket left with tokens after a request was allowed or not"""
+    retry_after = 0.0 if allowed else (1 - tokens) / limit.rate
+    return Decision(allowed, int(tokens), retry_after, (limit.limit - tokens) / limit.rate)
+
+
+def take(tokens: float, updated_at: float, now: float, limit: Limit) -> Tuple[float, Decision]:
+    """Refill a bucket to now and take a token if there is one
+
+    Returns:
+        Tuple[float, Decision]: The tokens left in the bucket and the decision
+    """
+    tokens = min(limit.limit, tokens + max(0.0, now - updated_at) * limit.rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    return tokens, decide(allowed, tokens, limit)
+
+
+class MemoryStore:
+    """Buckets held by the worker process"""
+
+    name = "memory"
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, limit: Limit) -> Decision:
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at = self.buckets.get(key, (limit.limit, now))
+            tokens, decision = take(tokens, updated_at, now, limit)
+            self.buckets[key] = (tokens, now)
+            # Buckets idle for an hour are full again for per hour limits, drop them to bound memory
+            if len(self.buckets) > 100000:
+                self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < 3600}
+            return decision
+
+
+# Refills the stored bucket to :now, as take does, for SQLITE_TAKE
+_REFILLED = "min(:limit, tokens + max(0, :now - updated_at) * :rate)"
+_LEFT = f"({_REFILLED} - ({_REFILLED} >= 1))"
+
+# One statement, so the bucket is read and written atomically without holding a transaction open
+SQLITE_TAKE = f"""
+INSERT INTO rate_limit_buckets (key, tokens, updated_at, full_at, allowed)
+VALUES (:key, max(:limit - 1, 0), :now, :now + min(:limit, 1) / :rate, :limit >= 1)
+ON CONFLICT (key) DO UPDATE SET
+    allowed = {_REFILLED} >= 1,
+    tokens = {_LEFT},
+    updated_at = :now,
+    full_at = :now + (:limit - {_LEFT}) / :rate
+RETURNING allowed, tokens
+"""
+
+# Seconds between deletions of buckets that have refilled, which are the same as no bucket
+PURGE_INTERVAL = 60.0
+
+
+class SQLiteStore:
+    """Buckets in a SQLite file shared by every worker on the host
+
+    Buckets are taken from with a single upsert in a worker thread, so a
+    worker waiting for another's write never blocks its event loop. If the
+    file stays locked past the busy timeout the request is denied rather
+    than let through unlimited.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time, busy_timeout: float = 1.0):
+        self.path = path
+        self.clock = clock
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._purged_at = 0.0
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL, allowed INTEGER NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_rate_limit_buckets_full_at ON rate_limit_buckets (full_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def _take(self, key: str, limit: Limit) -> Decision:
+        connection = self._connection()
+        now = self.clock()
+        try:
+            allowed, tokens = connection.execute(
+                SQLITE_TAKE, {"key": key, "limit": limit.limit, "rate": limit.rate, "now": now}
+            ).fetchone()
+            if now - self._purged_at > PURGE_INTERVAL:
+                self._purged_at = now
+                connection.execute("DELETE FROM rate_limit_buckets WHERE full_at < ?", (now,))
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            logger.warning("Rate limit store %s stayed locked, denying request", self.path)
+            return Decision(False, 0, 1.0, limit.period)
+        return decide(bool(allowed), tokens, limit)
+
+    async def acquire(self, key: str, limit: Limit) -> Decision:
+        return await run_in_threadpool(self._take, key, limit)
+
+
+# Runs atomically on the server so concurrent workers see a consistent bucket
+REDIS_TAKE = """
+local limit = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or limit
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(limit, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(limit / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisStore:
+    """Buckets in Redis shared by every worker on every host"""
+
+    name = "redis"
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise ValueError("The redis rate limit store requires the redis package")
+        self.client = aioredis.Redis.from_url(url)
+        self.script = self.client.register_script(REDIS_TAKE)
+
+    async def acquire(self, key: str, limit: Limit) -> Decision:
+        allowed, tokens = await self.script(keys=[f"ratelimit:{key}"], args=[limit.limit, limit.rate])
+        return decide(bool(allowed), float(tokens), limit)
+
+
+def route_class(method: str, path: str) -> str:
+    """Classify a request below /apps/{app_id}/users/{user_id} as read, write or embed
+
+    Creating or updating documents and querying a collection call the
+    embeddings API so they get their own, usually lower, limit.
+    """
+    if path.endswith("/query") or (method in ("POST", "PUT") and "/documents" in path):
+        return "embed"
+    if method in ("GET", "HEAD", "OPTIONS"):
+        return "read"
+    return "write"
+
+
+class RateLimitMiddleware:
+    """ASGI middleware applying a token bucket per tenant and route class"""
+
+    def __init__(self, app: ASGIApp, store, limits: Dict[str, Limit], per_user: bool = False) -> None:
+        self.app = app
+        self.store = store
+        self.limits = limits
+        self.per_user = per_user
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        match = TENANT_PATH.match(scope.get("path", "")) if scope["type"] == "http" else None
+        if match is None:
+            await self.app(scope, receive, send)
+            return
+
+        kind = route_class(scope["method"], match.group("rest") or "")
+        limit = self.limits[kind]
+        tenant = match.group("app_id")
+        if self.per_user and match.group("user_id"):
+            tenant = f"{tenant}:{match.group('user_id')}"
+        try:
+            decision: Optional[Decision] = await self.store.acquire(f"{kind}:{tenant}", limit)
+        except Exception:
+            # A store outage should not take the API down with it
+            logger.exception("Rate limit store %s failed, allowing request", self.store.name)
+            decision = None
+
+        if decision is None:
+            await self.app(scope, receive, send)
+            return
+        headers = {
+            "X-RateLimit-Limit": str(limit.limit),
+            "X-RateLimit-Remaining": str(decision.remaining),
+            "X-RateLimit-Reset": str(math.ceil(decision.reset_after)),
+        }
+        if not decision.allowed:
+            metrics.rate_limited.inc(kind)
+            headers["Retry-After"] = str(math.ceil(decision.retry_after))
+            response = FastJSONResponse(
+                {"error": f"Rate limit exceeded: {limit.limit} {kind} requests per {int(limit.period)} seconds"},
+                status_code=429,
+                headers=headers,
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+def from_env():
+    """Build the store configured by RATE_LIMIT_STORE"""
+    store = os.getenv("RATE_LIMIT_STORE", "memory")
+    if store == "memory":
+        return MemoryStore()
+    if store == "sqlite":
+        return SQLiteStore(os.getenv("RATE_LIMIT_PATH", "/tmp/honcho-rate-limits.db"))
+    if store == "redis":
+        return RedisStore(os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"Unknown RATE_LIMIT_STORE {store}")
+
+
+def limits_from_env() -> Dict[str, Limit]:
+    """Limits per route class from RATE_LIMIT_READ, RATE_LIMIT_WRITE and RATE_LIMIT_EMBED"""
+    return {
+        "read": Limit.parse(os.getenv("RATE_LIMIT_READ", "300/minute")),
+        "write": Limit.parse(os.getenv("RATE_LIMIT_WRITE", "100/minute")),
+        "embed": Limit.parse(os.getenv("RATE_LIMIT_EMBED", "60/minute")),
+    }
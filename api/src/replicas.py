@@ -0,0 +1,229 @@
+"""Routing of GET requests to Postgres read replicas
+
+Replicas are listed in DATABASE_REPLICA_URIS, separated by commas. A
+thread in each worker checks them every REPLICA_CHECK_INTERVAL seconds and
+only routes to those that answered, are streaming from the primary and lag
+it by at most REPLICA_MAX_LAG seconds. Requests other than GET and HEAD,
+and every GET when no replica is healthy, use the primary.
+
+Reads follow writes: when a request commits, the response carries the
+primary's WAL position after the commit in the X-Honcho-Consistency
+header. A client that sends the newest position it received on later
+requests is only served by replicas that have replayed at least that far,
+so it always sees what it wrote. The SDK does this automatically.
+"""
+import contextvars
+import itertools
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .db import SessionLocal, engine, replica_engines
+
+logger = logging.getLogger(__name__)
+
+CONSISTENCY_HEADER = "X-Honcho-Consistency"
+
+READ_METHODS = ("GET", "HEAD")
+
+# A replica that lost its primary has replayed all it received and looks
+# caught up, so it must also still be streaming. Lag is judged against the
+# primary's position taken just before, as an idle primary makes the replay
+# timestamp age without the replica falling behind
+LAG_QUERY = text(
+    "SELECT pg_last_wal_replay_lsn()::text, "
+    "EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'), "
+    "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+)
+
+
+def parse_lsn(value: str) -> int:
+    """Turn a Postgres LSN such as 16/B374D848 into a comparable integer
+
+    Raises:
+        ValueError: If value is not an LSN
+    """
+    high, _, low = value.strip().partition("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def max_lag() -> float:
+    return float(os.getenv("REPLICA_MAX_LAG", 5))
+
+
+class Replica:
+    __slots__ = ("engine", "sessionmaker", "healthy", "lsn", "lag")
+
+    def __init__(self, replica_engine: Engine):
+        self.engine = replica_engine
+        self.sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine, info={"replica": True})
+        self.healthy = False
+        self.lsn = 0
+        self.lag: Optional[float] = None
+
+    def check(self, primary_lsn: Optional[int] = None) -> None:
+        """Record the replica's position and whether it may serve reads
+
+        Args:
+            primary_lsn (int, optional): The primary's WAL position read just
+                before, a replica that has replayed it has no lag
+        """
+        try:
+            with self.engine.connect() as connection:
+                lsn, streaming, lag = connection.execute(LAG_QUERY).one()
+        except Exception:
+            logger.warning("Replica %s is unreachable", self.engine.url.host, exc_info=True)
+            self.healthy = False
+            return
+        if lsn is None:
+            logger.warning("Replica %s is not in recovery", self.engine.url.host)
+            self.healthy = False
+            return
+        self.lsn = parse_lsn(lsn)
+        if primary_lsn is not None and self.lsn >= primary_lsn:
+            self.lag = 0.0
+        else:
+            self.lag = float(lag) if lag is not None else None
+        if not streaming:
+            logger.warning("Replica %s is not streaming from the primary", self.engine.url.host)
+        self.healthy = bool(streaming) and self.lag is not None and self.lag <= max_lag()
+
+
+class ReplicaSet:
+    """The replicas of this worker and their last known health"""
+
+    def __init__(self, engines: List[Engine], interval: float):
+        self.replicas = [Replica(replica_engine) for replica_engine in engines]
+        self.interval = interval
+        self._turn = itertools.count()
+        self._checker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def start(self) -> None:
+        if self._checker is None:
+            with self._lock:
+                if self._checker is None:
+                    self._checker = threading.Thread(target=self._run, name="honcho-replica-checker", daemon=True)
+                    self._checker.start()
+
+    def _run(self) -> None:
+        # Until the first check finishes every request goes to the primary
+        while True:
+            self.check()
+            threading.Event().wait(self.interval)
+
+    def dispose(self) -> None:
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def check(self) -> None:
+        try:
+            primary_lsn: Optional[int] = parse_lsn(current_lsn())
+        except Exception:
+            # Without the primary's position replicas are judged by replay time alone
+            logger.warning("Could not read the primary's WAL position", exc_info=True)
+            primary_lsn = None
+        for replica in self.replicas:
+            replica.check(primary_lsn)
+
+    def choose(self, min_lsn: int = 0) -> Optional[Replica]:
+        """A healthy replica that has replayed min_lsn, taking turns between them"""
+        candidates = [replica for replica in self.replicas if replica.healthy and replica.lsn >= min_lsn]
+        if not candidates:
+            return None
+        return candidates[next(self._turn) % len(candidates)]
+
+    def stats(self) -> List[dict]:
+        return [
+            {"host": replica.engine.url.host, "healthy": replica.healthy, "lag": replica.lag}
+            for replica in self.replicas
+        ]
+
+
+replica_set = ReplicaSet(replica_engines, float(os.getenv("REPLICA_CHECK_INTERVAL", 2)))
+
+
+class _RequestState:
+    __slots__ = ("min_lsn", "wrote")
+
+    def __init__(self, min_lsn: int):
+        self.min_lsn = min_lsn
+        self.wrote = False
+
+
+# Shared with the threads routes run in, they copy the context but see the same state object
+_request: contextvars.ContextVar[Optional[_RequestState]] = contextvars.ContextVar("honcho_replica_request", default=None)
+
+
+def session(method: str) -> Session:
+    """A database session for a request, on a replica for reads when one is fresh enough"""
+    if replica_set and method in READ_METHODS:
+        state = _request.get()
+        replica = replica_set.choose(state.min_lsn if state is not None else 0)
+        if replica is not None:
+            return replica.sessionmaker()
+    return SessionLocal()
+
+
+def is_replica(db: Session) -> bool:
+    """Whether db reads from a replica, whose rows may lag the primary"""
+    return db.info.get("replica", False)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _record_write(db: Session) -> None:
+    state = _request.get()
+    if state is not None:
+        state.wrote = True
+
+
+def current_lsn() -> str:
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+
+
+class ConsistencyMiddleware:
+    """Reads the client's consistency token and returns a new one after writes"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        min_lsn = 0
+        for name, value in scope["headers"]:
+            if name == b"x-honcho-consistency":
+                try:
+                    min_lsn = parse_lsn(value.decode("latin-1"))
+                except ValueError:
+                    pass
+        state = _RequestState(min_lsn)
+        token = _request.set(state)
+
+        async def send_with_token(message: Message) -> None:
+            if message["type"] == "http.response.start" and state.wrote:
+                try:
+                    lsn = await run_in_threadpool(current_lsn)
+                except Exception:
+                    logger.exception("Failed to read the WAL position after a write")
+                else:
+                    MutableHeaders(scope=message).append(CONSISTENCY_HEADER, lsn)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_token)
+        finally:
+            _request.reset(token)
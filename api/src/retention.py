@@ -0,0 +1,178 @@
+"""Per app retention: python -m src.retention
+
+Each app may have a row in retention_policies saying for how many days it
+keeps messages (with their metamessages) and documents. The purge deletes
+older rows oldest first in batches of a few hundred primary keys, found
+through the (created_at, id) indexes, with one short transaction per batch
+and an optional pause between batches. Locks are held only for a batch's
+rows and the WAL is written a little at a time rather than all at once.
+
+Progress is checkpointed in retention_checkpoints after every batch, so a
+purge that is interrupted resumes where it stopped, and each run records
+how many rows it purged. Archived sessions are not purged. Each batch also
+subtracts what it deleted from the message_count of the sessions involved.
+"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Select, delete, select, tuple_
+from sqlalchemy.orm import Session
+
+from . import codec, models, stats
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+KINDS = ("messages", "documents")
+
+
+def _checkpoint(db: Session, app_id: str, kind: str) -> models.RetentionCheckpoint:
+    checkpoint = db.get(models.RetentionCheckpoint, (app_id, kind))
+    if checkpoint is None:
+        checkpoint = models.RetentionCheckpoint(app_id=app_id, kind=kind, purged=0)
+        db.add(checkpoint)
+    return checkpoint
+
+
+def _candidates(kind: str, app_id: str, cutoff: datetime.datetime) -> Select:
+    """Keys of an app's rows older than cutoff, oldest first"""
+    if kind == "messages":
+        return (
+            select(models.Message.created_at, models.Message.id)
+            .join(models.Session, models.Session.id == models.Message.session_id)
+            .where(models.Session.app_id == app_id)
+            .where(models.Message.created_at < cutoff)
+            .order_by(models.Message.created_at, models.Message.id)
+        )
+    return (
+        select(models.Document.created_at, models.Document.id)
+        .join(models.Collection, models.Collection.id == models.Document.collection_id)
+        .where(models.Collection.app_id == app_id)
+        .where(models.Document.created_at < cutoff)
+        .order_by(models.Document.created_at, models.Document.id)
+    )
+
+
+def _delete(db: Session, kind: str, keys: List[Tuple[datetime.datetime, uuid.UUID]]) -> Dict[str, int]:
+    """Delete a batch of rows by key, returning the rows deleted per table"""
+    ids = [key.id for key in keys]
+    if kind == "messages":
+        metamessages = db.execute(delete(models.Metamessage).where(models.Metamessage.message_id.in_(ids))).rowcount
+        # The created_at bound lets Postgres skip newer range partitions
+        deleted = db.execute(
+            delete(models.Message)
+            .where(models.Message.id.in_(ids))
+            .where(models.Message.created_at <= keys[-1].created_at)
+            .returning(models.Message.session_id)
+        ).scalars().all()
+        messages = len(deleted)
+        if deleted:
+            stats.forget_messages(db, Counter(deleted))
+        return {"messages": messages, "metamessages": metamessages}
+    return {"documents": db.execute(delete(models.Document).where(models.Document.id.in_(ids))).rowcount}
+
+
+def purge(
+    db: Session, app_id: str, kind: str, days: int, batch_size: int = BATCH_SIZE, pause: float = 0.0
+) -> Dict[str, int]:
+    """Delete an app's rows of one kind older than days
+
+    Args:
+        db (Session): The database session
+        app_id (str): The app whose rows to delete
+        kind (str): messages, which includes their metamessages, or documents
+        days (int): Age in days past which rows are deleted
+        batch_size (int, optional): Rows deleted per transaction
+        pause (float, optional): Seconds to sleep between batches
+
+    Returns:
+        Dict: The rows deleted per table
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    checkpoint = _checkpoint(db, app_id, kind)
+    if checkpoint.last_id is None:
+        # Starting a new run rather than resuming one
+        checkpoint.purged = 0
+        checkpoint.started_at = datetime.datetime.utcnow()
+        checkpoint.finished_at = None
+        db.commit()
+    purged: Dict[str, int] = {}
+
+    columns = (models.Message.created_at, models.Message.id) if kind == "messages" else (models.Document.created_at, models.Document.id)
+    while True:
+        stmt = _candidates(kind, app_id, cutoff)
+        if checkpoint.last_id is not None:
+            stmt = stmt.where(tuple_(*columns) > tuple_(checkpoint.last_created_at, checkpoint.last_id))
+        keys = db.execute(stmt.limit(batch_size)).all()
+        if not keys:
+            break
+        deleted = _delete(db, kind, keys)
+        checkpoint.last_created_at, checkpoint.last_id = keys[-1].created_at, keys[-1].id
+        checkpoint.purged += sum(deleted.values())
+        db.commit()
+        for table, rows in deleted.items():
+            purged[table] = purged.get(table, 0) + rows
+        if len(keys) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    checkpoint.last_created_at, checkpoint.last_id = None, None
+    checkpoint.finished_at = datetime.datetime.utcnow()
+    db.commit()
+    return purged
+
+
+def run(
+    db: Session, app_id: Optional[str] = None, batch_size: int = BATCH_SIZE, pause: float = 0.0
+) -> Dict[str, Dict[str, int]]:
+    """Apply every retention policy, or only app_id's
+
+    Returns:
+        Dict: Rows purged per app and table
+    """
+    stmt = select(models.RetentionPolicy).order_by(models.RetentionPolicy.app_id)
+    if app_id is not None:
+        stmt = stmt.where(models.RetentionPolicy.app_id == app_id)
+    policies: List[Tuple[str, Optional[int], Optional[int]]] = [
+        (policy.app_id, policy.message_days, policy.document_days) for policy in db.scalars(stmt)
+    ]
+    report = {}
+    for policy_app_id, message_days, document_days in policies:
+        report[policy_app_id] = {}
+        for kind, days in zip(KINDS, (message_days, document_days)):
+            if days is None:
+                continue
+            purged = purge(db, policy_app_id, kind, days, batch_size, pause)
+            report[policy_app_id].update(purged)
+            for table, rows in purged.items():
+                logger.info("Purged %d %s of %s", rows, table, policy_app_id)
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.retention", description="Delete rows past their app's retention")
+    parser.add_argument("--app", help="Only apply this app's policy")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows deleted per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from .db import SessionLocal
+
+    with SessionLocal() as db:
+        report = run(db, args.app, args.batch_size, args.pause)
+    # The rows purged per app and table, for whatever scheduled the run
+    sys.stdout.write(codec.dumps(report).decode() + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,10 @@
-from pydantic import BaseModel, validator
+from pydantic import AliasChoices, BaseModel, Field
+from typing import Generic, TypeVar
 import datetime
 import uuid
 
+T = TypeVar("T")
+
 
 class MessageBase(BaseModel):
     content: str
@@ -9,13 +12,14 @@ class MessageBase(BaseModel):
 
 
 class MessageCreate(MessageBase):
-    pass
+    id: uuid.UUID | None = None
 
 
 class Message(MessageBase):
     session_id: uuid.UUID
     id: uuid.UUID
     created_at: datetime.datetime
+    seq: int
 
     class Config:
         from_attributes = True
@@ -38,21 +42,13 @@ class Session(SessionBase):
     user_id: str
     location_id: str
     app_id: str
-    h_metadata: dict
-    metadata: dict
+    metadata: dict = Field(validation_alias=AliasChoices("h_metadata", "metadata"))
     created_at: datetime.datetime
-
-    @validator('metadata', pre=True, allow_reuse=True)
-    def fetch_h_metadata(cls, value, values):
-        if 'h_metadata' in values:
-            return values['h_metadata']
-        return {}
+    message_count: int = 0
+    last_message_at: datetime.datetime | None = None
 
     class Config:
         from_attributes = True
-        schema_extra = {
-            "exclude": ["h_metadata"]
-        }
 
 
 class MetamessageBase(BaseModel):
@@ -72,6 +68,27 @@ class Metamessage(MetamessageBase):
     class Config:
         orm_mode = True
 
+class UserMetamessage(Metamessage):
+    """A metamessage listed across a user's sessions, with the session it belongs to"""
+    session_id: uuid.UUID
+
+
+class SearchHit(Message):
+    """A message matching a search, higher ranks for better hits
+
+    snippet is an HTML fragment: an excerpt of the content, HTML escaped,
+    with the matching words in <b></b>. It holds no other markup.
+    """
+    snippet: str
+    rank: float
+
+
+class CursorPage(BaseModel, Generic[T]):
+    """A page of results, pass next_cursor back as cursor for the next one. None on the last page"""
+    items: list[T]
+    next_cursor: str | None
+
+
 class CollectionBase(BaseModel):
     pass
 
@@ -104,20 +121,40 @@ class DocumentUpdate(DocumentBase):
 class Document(DocumentBase):
     id: uuid.UUID
     content: str
-    h_metadata: dict
-    metadata: dict
+    metadata: dict = Field(validation_alias=AliasChoices("h_metadata", "metadata"))
     created_at: datetime.datetime
     collection_id: uuid.UUID
 
-    @validator('metadata', pre=True, allow_reuse=True)
-    def fetch_h_metadata(cls, value, values):
-        if 'h_metadata' in values:
-            return values['h_metadata']
-        return {}
-
     class Config:
         from_attributes = True
-        schema_extra = {
-            "exclude": ["h_metadata"]
-        }
 
+
+
+class RetentionPolicyUpdate(BaseModel):
+    message_days: int | None = Field(default=None, ge=1)
+    document_days: int | None = Field(default=None, ge=1)
+
+
+class RetentionRun(BaseModel):
+    kind: str
+    purged: int
+    started_at: datetime.datetime | None
+    finished_at: datetime.datetime | None
+
+
+class RetentionPolicy(RetentionPolicyUpdate):
+    app_id: str
+    updated_at: datetime.datetime
+    runs: list[RetentionRun]
+
+
+class DeletionJob(BaseModel):
+    id: uuid.UUID
+    kind: str
+    target_id: uuid.UUID
+    status: str
+    deleted: int
+    total: int | None
+    error: str | None
+    created_at: datetime.datetime
+    finished_at: datetime.datetime | None
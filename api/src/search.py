@@ -0,0 +1,147 @@
+"""Full text search over a user's messages
+
+On Postgres messages have a GIN index on to_tsvector(CONFIG, content),
+queried with websearch_to_tsquery so users can write "quoted phrases", or
+and -excluded words. Hits are ranked by ts_rank_cd and snippets come from
+ts_headline. The tsvector is an expression index rather than a stored
+column, so the partitioned layouts can copy rows with SELECT * unchanged.
+
+On SQLite messages_fts, an external content FTS5 table kept in step with
+messages by triggers, indexes the same text. Hits are ranked by bm25 and
+every word of the query must match. The FTS5 table refers to messages by
+rowid, which VACUUM may renumber, so run `python -m src.search rebuild`
+after a VACUUM.
+
+The database puts control characters around the matches in snippets.
+highlight then escapes the snippet as HTML and turns only those characters
+into <b></b>, so message text can never add markup of its own.
+
+Both rank so that higher is better. Pages are ordered by rank and then ID,
+and continue from a cursor holding the last hit's score and ID.
+"""
+import argparse
+import html
+import logging
+import sys
+import uuid
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Float, Select, cast, column, false, func, literal_column, select, table, text, tuple_
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+_messages_fts = table("messages_fts", column("rowid"))
+
+# Placed around matches in snippets by the database and replaced by highlight
+START, STOP = "\x02", "\x03"
+
+# Text search configuration of the Postgres index, queries must use the same one to be served by it
+CONFIG = "english"
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='rowid')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content); "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content); END",
+]
+
+
+def create_sqlite_index(connection: Connection) -> None:
+    """Create messages_fts and its triggers if missing and index the existing messages"""
+    for statement in SQLITE_DDL:
+        connection.execute(text(statement))
+    rebuild(connection)
+
+
+def rebuild(connection: Connection) -> None:
+    connection.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+def highlight(snippet: str) -> str:
+    """A snippet as HTML escaped text with the matches in <b></b>"""
+    return html.escape(snippet).replace(START, "<b>").replace(STOP, "</b>")
+
+
+def _sqlite_query(query: str) -> str:
+    """Quote every word so FTS5 syntax in user input is matched literally"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def search(
+    db: Session, app_id: str, user_id: str, query: str, session_id: Optional[uuid.UUID] = None,
+    location_id: Optional[str] = None, after: Optional[Tuple[float, uuid.UUID]] = None,
+) -> Select:
+    """Messages of a user matching query, best first
+
+    Selects (Message, rank, snippet, score) rows where score orders the hits
+    and rank is its negation, higher for better hits. after is the
+    (score, id) of the last hit already seen.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        fts = literal_column("messages_fts")
+        score = func.bm25(fts)
+        snippet = func.snippet(fts, 0, START, STOP, "...", 16)
+        stmt = (
+            select(models.Message, (-score).label("rank"), snippet.label("snippet"), score.label("score"))
+            .select_from(_messages_fts)
+            .join(models.Message, literal_column("messages.rowid") == _messages_fts.c.rowid)
+            .where(fts.op("MATCH")(_sqlite_query(query)))
+        )
+        if not query.split():
+            stmt = stmt.where(false())
+    else:
+        config = literal_column(f"'{CONFIG}'::regconfig")
+        tsquery = func.websearch_to_tsquery(config, query)
+        # ts_rank_cd returns real, widened to double precision so the score in the cursor compares
+        # equal to the one it came from and ties with the last hit are not skipped
+        rank = cast(func.ts_rank_cd(func.to_tsvector(config, models.Message.content), tsquery), Float(53))
+        score = -rank
+        snippet = func.ts_headline(
+            config, models.Message.content, tsquery, f'MaxWords=24, MinWords=8, StartSel="{START}", StopSel="{STOP}"'
+        )
+        stmt = (
+            select(models.Message, rank.label("rank"), snippet.label("snippet"), score.label("score"))
+            .where(func.to_tsvector(config, models.Message.content).op("@@")(tsquery))
+        )
+    stmt = (
+        stmt.join(models.Session, models.Session.id == models.Message.session_id)
+        .where(models.Session.app_id == app_id)
+        .where(models.Session.user_id == user_id)
+        .order_by(score, models.Message.id)
+    )
+    if session_id is not None:
+        stmt = stmt.where(models.Message.session_id == session_id)
+    if location_id is not None:
+        stmt = stmt.where(models.Session.location_id == location_id)
+    if after is not None:
+        stmt = stmt.where(tuple_(score, models.Message.id) > tuple_(*after))
+    return stmt
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.search", description="Maintain the SQLite full text index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from .db import engine
+
+    if engine.dialect.name != "sqlite":
+        logger.info("Postgres keeps its full text index up to date by itself")
+        return 0
+    with engine.begin() as connection:
+        rebuild(connection)
+    logger.info("Rebuilt messages_fts")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Build response bodies straight from ORM rows
+
+Rows read from our own database are already valid so routes return these
+dicts in a FastJSONResponse instead of validating them against the response
+model again. The response models are still declared on the routes for the
+OpenAPI schema and must describe the same fields.
+"""
+import math
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi_pagination.api import resolve_params
+from sqlalchemy import Select, func, select
+from sqlalchemy.orm import Session
+
+from . import models, search
+
+
+def session(row: models.Session) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "is_active": row.is_active,
+        "user_id": row.user_id,
+        "location_id": row.location_id,
+        "app_id": row.app_id,
+        "metadata": row.h_metadata,
+        "created_at": row.created_at,
+        "message_count": row.message_count,
+        "last_message_at": row.last_message_at,
+    }
+
+
+def message(row: models.Message) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "session_id": row.session_id,
+        "is_user": row.is_user,
+        "content": row.content,
+        "created_at": row.created_at,
+        "seq": row.seq,
+    }
+
+
+def metamessage(row: models.Metamessage) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "message_id": row.message_id,
+        "metamessage_type": row.metamessage_type,
+        "content": row.content,
+        "created_at": row.created_at,
+    }
+
+
+def user_metamessage(row: models.Metamessage, session_id: Any) -> Dict[str, Any]:
+    return {**metamessage(row), "session_id": session_id}
+
+
+def search_hit(row: models.Message, snippet: str, rank: float) -> Dict[str, Any]:
+    return {**message(row), "snippet": search.highlight(snippet), "rank": rank}
+
+
+def collection(row: models.Collection) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "name": row.name,
+        "app_id": row.app_id,
+        "user_id": row.user_id,
+        "created_at": row.created_at,
+    }
+
+
+def document(row: models.Document) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "content": row.content,
+        "metadata": row.h_metadata,
+        "created_at": row.created_at,
+        "collection_id": row.collection_id,
+    }
+
+
+def retention_policy(row: models.RetentionPolicy, checkpoints: List[models.RetentionCheckpoint]) -> Dict[str, Any]:
+    return {
+        "app_id": row.app_id,
+        "message_days": row.message_days,
+        "document_days": row.document_days,
+        "updated_at": row.updated_at,
+        "runs": [
+            {
+                "kind": checkpoint.kind,
+                "purged": checkpoint.purged,
+                "started_at": checkpoint.started_at,
+                "finished_at": checkpoint.finished_at,
+            }
+            for checkpoint in checkpoints
+        ],
+    }
+
+
+def deletion_job(row: models.DeletionJob) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "kind": row.kind,
+        "target_id": row.target_id,
+        "status": row.status,
+        "deleted": row.deleted,
+        "total": row.total,
+        "error": row.error,
+        "created_at": row.created_at,
+        "finished_at": row.finished_at,
+    }
+
+
+def page(db: Session, stmt: Select, serialize: Callable[[Any], Dict[str, Any]], total: Optional[int] = None) -> Dict[str, Any]:
+    """Run a paginated query and build a body matching fastapi_pagination's Page
+
+    Args:
+        db (Session): The database session
+        stmt (Select): The query for every row, already ordered
+        serialize (Callable): Builds the dict for a single row
+        total (int, optional): The number of rows if already known, otherwise they are counted
+
+    Returns:
+        Dict: The page of results with total, page, size and pages
+    """
+    params = resolve_params()
+    if total is None:
+        total = db.scalar(select(func.count()).select_from(stmt.order_by(None).subquery()))
+    rows = db.scalars(stmt.limit(params.size).offset((params.page - 1) * params.size)).all()
+    return {
+        "items": [serialize(row) for row in rows],
+        "total": total,
+        "page": params.page,
+        "size": params.size,
+        "pages": math.ceil(total / params.size),
+    }
+
+
+def page_of(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a page like page does from dicts that are already in memory, such as an archived session's"""
+    params = resolve_params()
+    start = (params.page - 1) * params.size
+    return {
+        "items": items[start:start + params.size],
+        "total": len(items),
+        "page": params.page,
+        "size": params.size,
+        "pages": math.ceil(len(items) / params.size),
+    }
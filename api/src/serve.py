@@ -0,0 +1,62 @@
+"""Production entry point: python -m src.serve
+
+Applies pending migrations once, then runs WEB_CONCURRENCY uvicorn worker
+processes under uvicorn's supervisor, which restarts workers that die.
+Workers skip the startup migration and size their connection pools from
+DATABASE_MAX_CONNECTIONS divided between them.
+
+Settings come from the environment:
+    HOST, PORT: Address to listen on, 0.0.0.0:8000 by default
+    WEB_CONCURRENCY: Worker processes, one per CPU by default
+    MIGRATE_ON_STARTUP: Set to false when migrations run as a release step
+    GRACEFUL_SHUTDOWN_TIMEOUT: Seconds to let requests finish on shutdown
+    FORWARDED_ALLOW_IPS: Proxies trusted to set X-Forwarded-* headers
+"""
+import logging
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on, which can be fewer than the machine has"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def main() -> None:
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    workers = int(os.getenv("WEB_CONCURRENCY", cpu_count()))
+
+    if os.getenv("MIGRATE_ON_STARTUP", "true").lower() == "true":
+        from . import migrate
+        from .db import engine
+
+        migrate.upgrade(engine)
+        # Workers are new processes, don't hand them the parent's connections
+        engine.dispose()
+
+    # Inherited by the workers, so they skip migrating and split the connection budget
+    os.environ["MIGRATE_ON_STARTUP"] = "false"
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    logger.info("Starting %d workers", workers)
+    uvicorn.run(
+        "src.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        workers=workers,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", 20)),
+        log_level=os.getenv("LOG_LEVEL", "info"),
+    )
+
+
+if __name__ == "__main__":
+    main()
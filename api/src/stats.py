@@ -0,0 +1,174 @@
+"""Denormalized session activity: python -m src.stats
+
+sessions.message_count and sessions.last_message_at describe a session's
+messages so that sessions can be listed by activity and report their size
+without counting messages. They change in the same transaction as the
+messages they describe: create_message and create_messages add to them and
+the retention purge subtracts what it deletes. The same UPDATE in
+create_message and create_messages advances sessions.last_seq, which hands
+out message seqs, as record_metamessage does sessions.last_metamessage_seq
+for metamessages.
+
+Rows changed outside the API, for example by hand or by a restore, make
+them drift. The reconcile job recounts sessions in batches of primary keys
+and corrects those that differ, one short transaction per batch.
+"""
+import argparse
+import datetime
+import logging
+import sys
+import uuid
+from typing import Dict, List, Optional
+
+from sqlalchemy import Update, bindparam, case, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def record_messages(db: Session, session_id: uuid.UUID, count: int, newest: datetime.datetime) -> Optional[int]:
+    """Add count messages, the newest created at newest, to a session's stats and allocate their seqs
+
+    Runs in the caller's transaction. The UPDATE locks the session's row until
+    the commit, so concurrent writers to one session apply their changes in
+    turn and never get overlapping seqs. It only matches an active session,
+    which confirms the session inside the write even when the caller found
+    it in another worker's stale cache.
+
+    Returns:
+        int | None: The seq of the last of the messages, the first is this
+        minus count plus one. None if the session does not exist or is inactive
+    """
+    return db.execute(
+        update(models.Session)
+        .where(models.Session.id == session_id)
+        .where(models.Session.is_active)
+        .values(
+            message_count=models.Session.message_count + count,
+            last_message_at=case(
+                (or_(models.Session.last_message_at.is_(None), models.Session.last_message_at < newest), newest),
+                else_=models.Session.last_message_at,
+            ),
+            last_seq=models.Session.last_seq + count,
+        )
+        .returning(models.Session.last_seq),
+        execution_options={"synchronize_session": False},
+    ).scalar_one_or_none()
+
+
+def record_metamessage(db: Session, session_id: uuid.UUID) -> Optional[int]:
+    """Allocate the seq of a metamessage added to a session's messages, in the caller's transaction
+
+    Like record_messages the UPDATE locks the session's row until the
+    commit, so seqs are handed out in commit order, and only matches an
+    active session.
+
+    Returns:
+        int | None: The seq, None if the session does not exist or is inactive
+    """
+    return db.execute(
+        update(models.Session)
+        .where(models.Session.id == session_id)
+        .where(models.Session.is_active)
+        .values(last_metamessage_seq=models.Session.last_metamessage_seq + 1)
+        .returning(models.Session.last_metamessage_seq),
+        execution_options={"synchronize_session": False},
+    ).scalar_one_or_none()
+
+
+def forget_messages(db: Session, counts: Dict[uuid.UUID, int]) -> None:
+    """Subtract deleted messages from their sessions' stats in the caller's transaction
+
+    Only for deleting a session's oldest messages, which leaves the newest in
+    place unless none are left.
+    """
+    sessions = models.Session.__table__
+    remaining = sessions.c.message_count - bindparam("deleted")
+    stmt = (
+        update(sessions)
+        .where(sessions.c.id == bindparam("session_id"))
+        .values(
+            message_count=remaining,
+            last_message_at=case((remaining <= 0, None), else_=sessions.c.last_message_at),
+        )
+    )
+    # Sorted so concurrent purges lock sessions in the same order
+    db.execute(stmt, [{"session_id": session_id, "deleted": counts[session_id]} for session_id in sorted(counts)])
+
+
+def recount() -> Update:
+    """An UPDATE correcting the stats of every session it matches that has drifted"""
+    count = (
+        select(func.count(models.Message.id))
+        .where(models.Message.session_id == models.Session.id)
+        .scalar_subquery()
+    )
+    newest = (
+        select(func.max(models.Message.created_at))
+        .where(models.Message.session_id == models.Session.id)
+        .scalar_subquery()
+    )
+    top = (
+        select(func.max(models.Message.seq))
+        .where(models.Message.session_id == models.Session.id)
+        .scalar_subquery()
+    )
+    return (
+        update(models.Session)
+        .where(or_(
+            models.Session.message_count != count,
+            models.Session.last_message_at.is_distinct_from(newest),
+            # Seqs are never reused, so last_seq only ever needs raising
+            top > models.Session.last_seq,
+        ))
+        .values(
+            message_count=count,
+            last_message_at=newest,
+            last_seq=case((top > models.Session.last_seq, top), else_=models.Session.last_seq),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reconcile(db: Session, batch_size: int = BATCH_SIZE) -> int:
+    """Recount the messages of every session, returning how many sessions were corrected"""
+    repaired = 0
+    last_id: Optional[uuid.UUID] = None
+    while True:
+        stmt = select(models.Session.id).order_by(models.Session.id).limit(batch_size)
+        if last_id is not None:
+            stmt = stmt.where(models.Session.id > last_id)
+        ids: List[uuid.UUID] = list(db.scalars(stmt))
+        if not ids:
+            break
+        rows = db.execute(recount().where(models.Session.id.in_(ids))).rowcount
+        db.commit()
+        if rows:
+            logger.info("Corrected the stats of %d sessions", rows)
+        repaired += rows
+        last_id = ids[-1]
+        if len(ids) < batch_size:
+            break
+    return repaired
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.stats", description="Repair drifted session activity stats")
+    parser.add_argument("command", choices=["reconcile"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Sessions recounted per transaction")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    from .db import SessionLocal
+
+    with SessionLocal() as db:
+        logger.info("Corrected the stats of %d sessions in total", reconcile(db, args.batch_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
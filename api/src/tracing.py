@@ -0,0 +1,314 @@
+"""Request tracing with W3C trace context and OpenTelemetry compatible output
+
+Each request gets a server span continuing the trace of an incoming
+traceparent header. Spans are added around crud functions, SQL statements
+(through engine events), embedding calls and response serialization so the
+time of a slow request can be attributed.
+
+Spans of a request are exported together once it finishes. The stdout
+exporter prints a line per span and the otlp-file exporter appends OTLP/JSON
+export requests to a file that an OpenTelemetry collector can ingest with its
+otlpjsonfile receiver. Tracing is off unless TRACING_EXPORTER is set.
+"""
+import contextlib
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .metrics import route_template
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "honcho")
+
+# Longest SQL statement recorded on a span
+MAX_STATEMENT_LENGTH = 2048
+
+
+class Span:
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error", "finished")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: int = INTERNAL,
+                 attributes: Optional[Dict[str, Any]] = None, finished: Optional[List["Span"]] = None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end = 0
+        self.attributes = attributes if attributes is not None else {}
+        self.error: Optional[str] = None
+        # Shared by the spans of one request, exported when its root span ends
+        self.finished = finished if finished is not None else []
+
+    @property
+    def traceparent(self) -> str:
+        """This span as a traceparent header value, also returned to clients as traceresponse"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def finish(self, root: bool = False) -> None:
+        self.end = time.time_ns()
+        self.finished.append(self)
+        if root and exporter is not None:
+            exporter.export(self.finished)
+
+
+# The span new spans are children of. False marks a request that was not sampled
+_current: ContextVar[Any] = ContextVar("honcho_span", default=None)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """Parse a W3C traceparent header into trace id, parent span id and sampled flag"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        if int(parts[1], 16) == 0 or int(parts[2], 16) == 0:
+            return None
+        sampled = bool(int(parts[3][:2], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1].lower(), parts[2].lower(), sampled
+
+
+def current_span() -> Optional[Span]:
+    span = _current.get()
+    return span if span else None
+
+
+def start_span(name: str, kind: int = INTERNAL, attributes: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+    """Start a child of the current span without making it current. None when not tracing"""
+    parent = _current.get()
+    if exporter is None or parent is False:
+        return None
+    if parent is None:
+        if random.random() >= sample_rate:
+            return None
+        return Span(name, f"{random.getrandbits(128):032x}", None, kind, attributes)
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes, parent.finished)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = INTERNAL, attributes: Optional[Dict[str, Any]] = None) -> Iterator[Optional[Span]]:
+    """Run a block in a span that is current for the block"""
+    if exporter is None:
+        yield None
+        return
+    new_span = start_span(name, kind, attributes)
+    if new_span is None:
+        yield None
+        return
+    root = new_span.parent_id is None
+    token = _current.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        new_span.finish(root=root)
+
+
+def traced(fn: F) -> F:
+    """Run every call of fn in a span named after it"""
+    name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if exporter is None:
+            return fn(*args, **kwargs)
+        with span(name):
+            return fn(*args, **kwargs)
+
+    return wrapper  # type: ignore[return-value]
+
+
+class TracingMiddleware:
+    """ASGI middleware running each request in a server span
+
+    Add it first so it sits inside the other middleware, where the router's
+    scope updates are visible and the span context reaches the routes.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or exporter is None:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = parse_traceparent(value.decode("latin-1"))
+                break
+        if traceparent is not None:
+            trace_id, parent_id, sampled = traceparent
+        else:
+            trace_id, parent_id, sampled = f"{random.getrandbits(128):032x}", None, random.random() < sample_rate
+        if not sampled:
+            token = _current.set(False)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _current.reset(token)
+            return
+
+        method = scope["method"]
+        server_span = Span(method, trace_id, parent_id, SERVER, {"http.request.method": method, "url.path": scope["path"]})
+
+        async def send_with_status(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                server_span.attributes["http.response.status_code"] = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"traceresponse", server_span.traceparent.encode())]
+            await send(message)
+
+        token = _current.set(server_span)
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as e:
+            server_span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            route = route_template(scope)
+            server_span.name = f"{method} {route}"
+            server_span.attributes["http.route"] = route
+            if server_span.attributes.get("http.response.status_code", 500) >= 500 and server_span.error is None:
+                server_span.error = "Internal Server Error"
+            server_span.finish(root=True)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Record a span for every SQL statement the engine executes"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if exporter is not None:
+            context._honcho_span = start_span("db.query", CLIENT, {
+                "db.system": engine.dialect.name,
+                "db.statement": statement[:MAX_STATEMENT_LENGTH],
+            })
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_span = getattr(context, "_honcho_span", None)
+        if db_span is not None:
+            if cursor.rowcount >= 0:
+                db_span.attributes["db.response.returned_rows"] = cursor.rowcount
+            db_span.finish(root=db_span.parent_id is None)
+            context._honcho_span = None
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        context = exception_context.execution_context
+        db_span = getattr(context, "_honcho_span", None)
+        if db_span is not None:
+            db_span.error = f"{type(exception_context.original_exception).__name__}: {exception_context.original_exception}"
+            db_span.finish(root=db_span.parent_id is None)
+            context._honcho_span = None
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def to_otlp(spans: List[Span]) -> Dict[str, Any]:
+    """Build an OTLP/JSON ExportTraceServiceRequest for spans"""
+    otlp_spans = []
+    for s in spans:
+        otlp_span = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": s.kind,
+            "startTimeUnixNano": str(s.start),
+            "endTimeUnixNano": str(s.end),
+            "attributes": [_attribute(key, value) for key, value in s.attributes.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            otlp_span["parentSpanId"] = s.parent_id
+        otlp_spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": "honcho"}, "spans": otlp_spans}],
+    }]}
+
+
+class StdoutExporter:
+    """Prints one JSON line per span"""
+
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]) -> None:
+        lines = [
+            json.dumps({
+                "name": s.name,
+                "trace_id": s.trace_id,
+                "span_id": s.span_id,
+                "parent_id": s.parent_id,
+                "duration_ms": round((s.end - s.start) / 1e6, 3),
+                "attributes": s.attributes,
+                "error": s.error,
+            }, default=str)
+            for s in spans
+        ]
+        with self._lock:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+
+
+class OTLPFileExporter:
+    """Appends one OTLP/JSON export request per trace to a file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]) -> None:
+        line = json.dumps(to_otlp(spans), separators=(",", ":"))
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def from_env():
+    """Build the exporter configured by TRACING_EXPORTER, None if tracing is off"""
+    name = os.getenv("TRACING_EXPORTER", "none")
+    if name == "none":
+        return None
+    if name == "stdout":
+        return StdoutExporter()
+    if name == "otlp-file":
+        return OTLPFileExporter(os.getenv("TRACING_OTLP_FILE", "traces.jsonl"))
+    raise ValueError(f"Unknown TRACING_EXPORTER {name}")
+
+
+exporter = from_env()
+sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", 1.0))
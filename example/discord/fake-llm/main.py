@@ -32,11 +32,7 @@ async def on_message(message):
     user_id = f"discord_{str(message.author.id)}"
     location_id = str(message.channel.id)
 
-    sessions = list(honcho.get_sessions_generator(user_id, location_id))
-    if len(sessions) > 0:
-        session = sessions[0]
-    else:
-        session = honcho.create_session(user_id, location_id)
+    session = honcho.get_or_create_session(user_id, location_id)
 
     inp = message.content
     session.create_message(is_user=True, content=inp)
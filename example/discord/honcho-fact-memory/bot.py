@@ -43,17 +43,12 @@ async def on_message(message):
     user_id = f"discord_{str(message.author.id)}"
     location_id=str(message.channel.id)
 
-    sessions = list(honcho.get_sessions_generator(user_id, location_id))
+    session = honcho.get_or_create_session(user_id, location_id)
     try:
         collection = honcho.get_collection(user_id=user_id, name="discord")
     except Exception:
         collection = honcho.create_collection(user_id=user_id, name="discord")
 
-    if len(sessions) > 0:
-        session = sessions[0]
-    else:
-        session = honcho.create_session(user_id, location_id)
-
     history = list(session.get_messages_generator())
     chat_history = langchain_message_converter(history)
 
@@ -58,12 +58,7 @@ async def on_message(message):
     user_id = f"discord_{str(message.author.id)}"
     location_id=str(message.channel.id)
 
-    sessions = list(honcho.get_sessions_generator(user_id, location_id))
-
-    if len(sessions) > 0:
-        session = sessions[0]
-    else:
-        session = honcho.create_session(user_id, location_id)
+    session = honcho.get_or_create_session(user_id, location_id)
 
     history = list(session.get_messages_generator())
     chat_history = langchain_message_converter(history)
@@ -11,6 +11,10 @@ with open(source_file_path, "r") as source_file:
 sync_code = re.sub(r"async\s", "", source_code)
 sync_code = re.sub(r"await\s", "", sync_code)
 sync_code = re.sub(r"Async", "", sync_code)
+sync_code = re.sub(r"\.aclose\(", ".close(", sync_code)
+sync_code = re.sub(r"def aclose\(", "def close(", sync_code)
+sync_code = re.sub(r"__a(enter|exit)__", r"__\1__", sync_code)
+sync_code = re.sub(r"\.aiter_", ".iter_", sync_code)
 
 # Write the modified code to the destination file
 destination_file_path = os.path.join(this_dir, "../sdk/honcho/sync_client.py")
@@ -30,7 +34,10 @@ sync_code = re.sub(r"@pytest.mark.asyncio\n", "", source_code)
 sync_code = re.sub(r"async\s", "", sync_code)
 sync_code = re.sub(r"await\s", "", sync_code)
 sync_code = re.sub(r"__anext__", "__next__", sync_code)
+sync_code = re.sub(r"^import asyncio$", "import time", sync_code, flags=re.M)
+sync_code = re.sub(r"asyncio\.sleep\(", "time.sleep(", sync_code)
 sync_code = re.sub(r"Async", "", sync_code)
+sync_code = re.sub(r"\.aclose\(", ".close(", sync_code)
 
 # Write the modified code to the destination file
 destination_file_path = os.path.join(this_dir, "../sdk/tests/test_sync.py")
@@ -0,0 +1,72 @@
+"""Encode and decode time of the JSON codec against the standard library
+
+Uses payloads shaped like the large responses the API returns: a page of 50
+documents with 65 KB of content each and a page of 100 short messages. The
+API's FastJSONResponse uses the same backends so the encode numbers apply to
+server side rendering as well.
+
+    python benchmarks/bench_codec.py
+"""
+import datetime
+import json
+import timeit
+import uuid
+
+from honcho import codec
+
+
+def document_page():
+    now = datetime.datetime.utcnow().isoformat()
+    return {
+        "items": [
+            {
+                "id": str(uuid.uuid4()),
+                "collection_id": str(uuid.uuid4()),
+                "content": "lorem ipsum dolor sit amet " * 2400,
+                "metadata": {"source": "benchmark", "index": i},
+                "created_at": now,
+            }
+            for i in range(50)
+        ],
+        "total": 50, "page": 1, "size": 50, "pages": 1,
+    }
+
+
+def message_page():
+    now = datetime.datetime.utcnow().isoformat()
+    return {
+        "items": [
+            {
+                "id": str(uuid.uuid4()),
+                "session_id": str(uuid.uuid4()),
+                "is_user": i % 2 == 0,
+                "content": f"message number {i}",
+                "created_at": now,
+            }
+            for i in range(100)
+        ],
+        "total": 100, "page": 1, "size": 100, "pages": 1,
+    }
+
+
+def bench(name, payload, number):
+    encoded = json.dumps(payload).encode()
+    results = {
+        "json dumps": timeit.timeit(lambda: json.dumps(payload).encode(), number=number),
+        f"{codec.BACKEND} dumps": timeit.timeit(lambda: codec.dumps(payload), number=number),
+        "json loads": timeit.timeit(lambda: json.loads(encoded), number=number),
+        f"{codec.BACKEND} loads": timeit.timeit(lambda: codec.loads(encoded), number=number),
+    }
+    print(f"{name} ({len(encoded) / 1024:.0f} KiB)")
+    for label, seconds in results.items():
+        print(f"  {label:<16} {seconds / number * 1e6:10.1f} us")
+
+
+def main():
+    print(f"codec backend: {codec.BACKEND}")
+    bench("document page", document_page(), 50)
+    bench("message page", message_page(), 2000)
+
+
+if __name__ == "__main__":
+    main()
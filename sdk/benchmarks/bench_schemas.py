@@ -0,0 +1,75 @@
+"""Memory and construction time of SDK result objects
+
+Compares the slot based, lazily parsed Message class against the previous
+plain class that kept a per instance __dict__.
+
+    python benchmarks/bench_schemas.py [count]
+"""
+import datetime
+import sys
+import time
+import tracemalloc
+import uuid
+
+from honcho import Message
+
+
+class DictMessage:
+    """The previous Message implementation with a per instance __dict__"""
+    def __init__(self, session_id, id, is_user, content, created_at):
+        self.session_id = session_id
+        self.id = id
+        self.is_user = is_user
+        self.content = content
+        self.created_at = created_at
+
+
+def raw_messages(count: int):
+    session_id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    return session_id, [
+        {
+            "id": str(uuid.uuid4()),
+            "is_user": i % 2 == 0,
+            "content": f"message {i}",
+            "created_at": (now + datetime.timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(count)
+    ]
+
+
+def measure(cls, session_id, raw):
+    tracemalloc.start()
+    start = time.perf_counter()
+    items = [
+        cls(session_id=session_id, id=m["id"], is_user=m["is_user"], content=m["content"], created_at=m["created_at"])
+        for m in raw
+    ]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return items, size, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    session_id, raw = raw_messages(count)
+
+    _, dict_size, dict_time = measure(DictMessage, session_id, raw)
+    slot_items, slot_size, slot_time = measure(Message, session_id, raw)
+
+    start = time.perf_counter()
+    for message in slot_items:
+        message.id
+        message.created_at
+    parse_time = time.perf_counter() - start
+
+    print(f"{count} messages")
+    print(f"dict based  : {dict_size / count:8.1f} B/object  build {dict_time * 1000:8.1f} ms")
+    print(f"slot based  : {slot_size / count:8.1f} B/object  build {slot_time * 1000:8.1f} ms")
+    print(f"saved       : {100 * (1 - slot_size / dict_size):8.1f} %")
+    print(f"first parse of id and created_at for every message: {parse_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
-from .client import AsyncClient, AsyncSession, AsyncCollection, AsyncGetSessionPage, AsyncGetMessagePage, AsyncGetMetamessagePage, AsyncGetDocumentPage, AsyncGetCollectionPage
-from .sync_client import Client, Session, Collection, GetSessionPage, GetMessagePage, GetMetamessagePage, GetDocumentPage, GetCollectionPage
-from .schemas import Message, Metamessage, Document
+from .client import AsyncClient, AsyncSession, AsyncCollection, AsyncCursorPage, AsyncGetSessionPage, AsyncGetMessagePage, AsyncGetMetamessagePage, AsyncGetUserMetamessagePage, AsyncSearchMessagePage, AsyncGetDocumentPage, AsyncGetCollectionPage
+from .sync_client import Client, Session, Collection, CursorPage, GetSessionPage, GetMessagePage, GetMetamessagePage, GetUserMetamessagePage, SearchMessagePage, GetDocumentPage, GetCollectionPage
+from .schemas import DeletionJob, Message, Metamessage, Document, SearchHit
 from .cache import LRUCache
+from .buffer import AsyncMessageBuffer, MessageBuffer
+from .bulk import AsyncBulkExecutor, BulkExecutor
+from .events import AsyncEventStream, Event, EventStream
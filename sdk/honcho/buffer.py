@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import threading
+from typing import Callable, List, Optional
+
+from .schemas import Message
+
+logger = logging.getLogger(__name__)
+
+ErrorCallback = Callable[[Exception, List[Message]], None]
+
+
+class AsyncMessageBuffer:
+    """Write-behind buffer that sends a session's messages to Honcho in batches
+
+    Messages are sent in the order they were added by a background task once
+    max_batch_size messages are waiting or flush_interval seconds have passed.
+    A batch that fails to send is handed to on_error and stays at the head of
+    the queue, with later messages waiting behind it so the stored order has
+    no gaps. It is sent again after flush_interval seconds with the same
+    message IDs, which the API stores only once.
+    """
+
+    def __init__(self, session, max_batch_size: int = 50, flush_interval: float = 1.0, on_error: Optional[ErrorCallback] = None):
+        """Constructor for AsyncMessageBuffer
+
+        Args:
+            session (AsyncSession): The session the messages belong to
+            max_batch_size (int, optional): Number of waiting messages that triggers a flush. At most 100
+            flush_interval (float, optional): Maximum number of seconds a message waits before being sent
+            on_error (Callable, optional): Called with the exception and the batch of messages that failed to send
+        """
+        if not 0 < max_batch_size <= 100:
+            raise ValueError("max_batch_size must be between 1 and 100")
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.closed = False
+        self._pending: List[Message] = []
+        self._wakeup = asyncio.Event()
+        self._send_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message: Message):
+        """Queue a message to be sent without waiting for the request"""
+        if self.closed:
+            raise Exception("Message buffer is closed")
+        self._pending.append(message)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not await self.flush() and not self.closed:
+                # Back off before sending the failed batch again
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self) -> bool:
+        """Send the queued messages in order until one batch fails, which is reported to on_error
+
+        Returns:
+            bool: Whether every queued message was sent
+        """
+        async with self._send_lock:
+            while self._pending:
+                batch = self._pending[:self.max_batch_size]
+                try:
+                    await self.session._send_messages(batch)
+                except Exception as e:
+                    self._report(e, batch)
+                    return False
+                del self._pending[:len(batch)]
+            return True
+
+    def _report(self, error: Exception, batch: List[Message]):
+        if self.on_error is None:
+            logger.error("Failed to send %d buffered messages", len(batch), exc_info=error)
+            return
+        try:
+            self.on_error(error, batch)
+        except Exception:
+            logger.exception("Message buffer on_error callback failed")
+
+    async def aclose(self):
+        """Stop the background task after sending every queued message
+
+        Messages that still fail to send are left in the buffer.
+        """
+        self.closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+class MessageBuffer:
+    """Write-behind buffer that sends a session's messages to Honcho in batches
+
+    Messages are sent in the order they were added by a background thread once
+    max_batch_size messages are waiting or flush_interval seconds have passed.
+    A batch that fails to send is handed to on_error and stays at the head of
+    the queue, with later messages waiting behind it so the stored order has
+    no gaps. It is sent again after flush_interval seconds with the same
+    message IDs, which the API stores only once.
+    """
+
+    def __init__(self, session, max_batch_size: int = 50, flush_interval: float = 1.0, on_error: Optional[ErrorCallback] = None):
+        """Constructor for MessageBuffer
+
+        Args:
+            session (Session): The session the messages belong to
+            max_batch_size (int, optional): Number of waiting messages that triggers a flush. At most 100
+            flush_interval (float, optional): Maximum number of seconds a message waits before being sent
+            on_error (Callable, optional): Called with the exception and the batch of messages that failed to send
+        """
+        if not 0 < max_batch_size <= 100:
+            raise ValueError("max_batch_size must be between 1 and 100")
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.closed = False
+        self._pending: List[Message] = []
+        self._wakeup = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, message: Message):
+        """Queue a message to be sent without waiting for the request"""
+        with self._wakeup:
+            if self.closed:
+                raise Exception("Message buffer is closed")
+            self._pending.append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="honcho-message-buffer", daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.max_batch_size:
+                self._wakeup.notify()
+
+    def _run(self):
+        failed = False
+        while not self.closed:
+            with self._wakeup:
+                # After a failure wait out the interval before sending the failed batch again
+                if (failed or len(self._pending) < self.max_batch_size) and not self.closed:
+                    self._wakeup.wait(self.flush_interval)
+            failed = not self.flush()
+
+    def flush(self) -> bool:
+        """Send the queued messages in order until one batch fails, which is reported to on_error
+
+        Returns:
+            bool: Whether every queued message was sent
+        """
+        with self._send_lock:
+            while True:
+                with self._wakeup:
+                    batch = self._pending[:self.max_batch_size]
+                if not batch:
+                    return True
+                try:
+                    self.session._send_messages(batch)
+                except Exception as e:
+                    self._report(e, batch)
+                    return False
+                with self._wakeup:
+                    del self._pending[:len(batch)]
+
+    def _report(self, error: Exception, batch: List[Message]):
+        if self.on_error is None:
+            logger.error("Failed to send %d buffered messages", len(batch), exc_info=error)
+            return
+        try:
+            self.on_error(error, batch)
+        except Exception:
+            logger.exception("Message buffer on_error callback failed")
+
+    def close(self):
+        """Stop the background thread after sending every queued message
+
+        Messages that still fail to send are left in the buffer.
+        """
+        with self._wakeup:
+            self.closed = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
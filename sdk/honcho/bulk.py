@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Union
+
+
+class AsyncBulkExecutor:
+    """Runs many requests concurrently with a bound on how many are in flight"""
+
+    def __init__(self, max_concurrency: int = 8):
+        """Constructor for AsyncBulkExecutor
+
+        Args:
+            max_concurrency (int, optional): Maximum number of requests in flight at once
+        """
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def map(self, fn: Callable, items: Iterable) -> List[Union[Any, Exception]]:
+        """Call fn on every item concurrently
+
+        Args:
+            fn (Callable): Coroutine function taking a single item
+            items (Iterable): The inputs to call fn with
+
+        Returns:
+            List: The result for each item in input order, or the exception raised for that item
+        """
+        async def run(item):
+            async with self._semaphore:
+                try:
+                    return await fn(item)
+                except Exception as e:
+                    return e
+
+        return list(await asyncio.gather(*[run(item) for item in items]))
+
+    async def aclose(self):
+        """Nothing to release, there for parity with BulkExecutor.close"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+class BulkExecutor:
+    """Runs many requests concurrently on a bounded thread pool"""
+
+    def __init__(self, max_concurrency: int = 8):
+        """Constructor for BulkExecutor
+
+        Args:
+            max_concurrency (int, optional): Maximum number of requests in flight at once
+        """
+        self.max_concurrency = max_concurrency
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="honcho-bulk")
+
+    def map(self, fn: Callable, items: Iterable) -> List[Union[Any, Exception]]:
+        """Call fn on every item concurrently
+
+        Args:
+            fn (Callable): Function taking a single item
+            items (Iterable): The inputs to call fn with
+
+        Returns:
+            List: The result for each item in input order, or the exception raised for that item
+        """
+        # Run each call in a copy of the caller's context so contextvars such as the trace id carry over
+        futures = [self._pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        """Shut the thread pool down, waiting for calls already submitted"""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
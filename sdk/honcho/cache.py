@@ -1,32 +1,277 @@
+import asyncio
+import threading
+import time
 from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+_MISSING = object()
+
+
+class _Entry:
+    """A single cached value along with its expiry time and weight"""
+    __slots__ = ("value", "expires_at", "weight")
+
+    def __init__(self, value, expires_at: Optional[float], weight: int):
+        self.value = value
+        self.expires_at = expires_at
+        self.weight = weight
+
+
+class _Flight:
+    """An in progress load that other callers for the same key can wait on"""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
 
 class LRUCache:
     """
-    An implementation of a basic LRUcache that utilizes the built
-    in OrderedDict data structure.
+    An implementation of an LRU cache that utilizes the built in OrderedDict
+    data structure.
+
+    The cache is bounded by the number of entries and optionally by a total
+    weight (e.g. size in bytes) computed by a user supplied weigher. Entries
+    can expire after a time to live, all operations are protected by a lock so
+    a cache can be shared by threads, and concurrent misses for the same key
+    through get_or_load / aget_or_load only trigger a single load.
     """
-    def __init__(self, capacity: int):
+    def __init__(
+        self,
+        capacity: int,
+        ttl: Optional[float] = None,
+        max_weight: Optional[int] = None,
+        weigher: Optional[Callable[[str, Any], int]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """Constructor for LRUCache
+
+        Args:
+            capacity (int): The maximum number of entries to hold
+            ttl (float, optional): Default time to live of an entry in seconds. Entries never expire if None
+            max_weight (int, optional): The maximum total weight of all entries. Requires a weigher
+            weigher (Callable, optional): Function of (key, value) returning the weight of an entry
+            clock (Callable, optional): Monotonic clock used for expiry, mainly useful for testing
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be greater than 0")
+        if max_weight is not None and weigher is None:
+            raise ValueError("max_weight requires a weigher")
         self.capacity = capacity
-        self.cache = OrderedDict()
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.clock = clock
+        self.cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.RLock()
+        self._flights: Dict[str, _Flight] = {}
+        self._async_flights: Dict[str, "asyncio.Task"] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self.cache)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self.cache.get(key)
+            return entry is not None and not self._expired(entry)
 
-    def get(self, key: str):
-        """Get a value from the cache"""
-        if key not in self.cache:
-            return None
+    def _expired(self, entry: _Entry) -> bool:
+        return entry.expires_at is not None and entry.expires_at <= self.clock()
 
+    def _remove(self, key: str) -> _Entry:
+        entry = self.cache.pop(key)
+        self.weight -= entry.weight
+        return entry
+
+    def _lookup(self, key: str):
+        """Return the value for key or _MISSING, recording hit/miss stats. Caller must hold the lock"""
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        if self._expired(entry):
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return _MISSING
         # Move the accessed key to the end to indicate it was recently used
         self.cache.move_to_end(key)
-        return self.cache[key]
-
-    def put(self, key: str, value):
-        """Put a value in the cache"""
-        if key in self.cache:
-            # If the key already exists, move it to the end and update the value
-            self.cache.move_to_end(key)
-        else:
-            if len(self.cache) >= self.capacity:
-                # If the cache is full, remove the least recently used key-value pair (the first item in the OrderedDict)
-                self.cache.popitem(last=False)
-
-        # Add or update the key-value pair at the end of the OrderedDict
-        self.cache[key] = value
+        self.hits += 1
+        return entry.value
+
+    def get(self, key: str, default=None):
+        """Get a value from the cache
+
+        Args:
+            key (str): The key to look up
+            default (optional): Value returned when the key is absent or expired. A cached
+                value of None can be told apart from a miss by passing a sentinel here
+
+        Returns:
+            The cached value or default
+        """
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def put(self, key: str, value, ttl: Optional[float] = None):
+        """Put a value in the cache
+
+        Args:
+            key (str): The key to store the value under
+            value: The value to store, None is a valid value
+            ttl (float, optional): Time to live for this entry overriding the cache default
+        """
+        ttl = self.ttl if ttl is None else ttl
+        weight = self.weigher(key, value) if self.weigher is not None else 1
+        if self.max_weight is not None and weight > self.max_weight:
+            # The value could never fit so don't flush the whole cache for it
+            self.delete(key)
+            return
+        expires_at = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self.cache:
+                self._remove(key)
+            self.cache[key] = _Entry(value, expires_at, weight)
+            self.weight += weight
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is within its bounds. Caller must hold the lock"""
+        while len(self.cache) > self.capacity or (
+            self.max_weight is not None and self.weight > self.max_weight
+        ):
+            key = next(iter(self.cache))
+            self._remove(key)
+            self.evictions += 1
+
+    def delete(self, key: str) -> bool:
+        """Remove a key from the cache
+
+        Returns:
+            bool: Whether the key was present
+        """
+        with self._lock:
+            if key not in self.cache:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        """Remove every entry from the cache. Statistics are kept"""
+        with self._lock:
+            self.cache.clear()
+            self.weight = 0
+
+    def get_or_load(self, key: str, loader: Callable[[], Any], ttl: Optional[float] = None):
+        """Get a value from the cache or load it on a miss
+
+        Concurrent callers missing on the same key wait for the first caller's
+        load instead of calling the loader themselves. If the load raises, the
+        error is propagated to every waiting caller and nothing is cached.
+
+        Args:
+            key (str): The key to look up
+            loader (Callable): Zero argument function returning the value for key
+            ttl (float, optional): Time to live for a loaded entry
+
+        Returns:
+            The cached or loaded value
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.put(key, flight.value, ttl=ttl)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.value
+
+    async def aget_or_load(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None):
+        """Async version of get_or_load where the loader is a coroutine function
+
+        Single flight is guaranteed between coroutines running on the same
+        event loop. The load runs in its own task, so cancelling any of the
+        callers, the first one included, leaves it running for the rest. If
+        the load itself is cancelled, a waiting caller starts it again.
+
+        Args:
+            key (str): The key to look up
+            loader (Callable): Zero argument coroutine function returning the value for key
+            ttl (float, optional): Time to live for a loaded entry
+
+        Returns:
+            The cached or loaded value
+        """
+        while True:
+            with self._lock:
+                value = self._lookup(key)
+                if value is not _MISSING:
+                    return value
+                task = self._async_flights.get(key)
+                if task is None:
+                    task = asyncio.ensure_future(self._aload(key, loader, ttl))
+                    # Mark the outcome retrieved so a failure no caller is left waiting for isn't logged by the loop
+                    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+                    self._async_flights[key] = task
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # This caller was cancelled, not the load
+                    raise
+
+    async def _aload(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: Optional[float]):
+        try:
+            value = await loader()
+            self.put(key, value, ttl=ttl)
+            return value
+        finally:
+            with self._lock:
+                del self._async_flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters describing the cache's effectiveness
+
+        Returns:
+            Dict: hits, misses, evictions, expirations, the hit ratio, the
+            current number of entries and their total weight
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self.cache),
+                "weight": self.weight,
+            }
@@ -0,0 +1,63 @@
+"""JSON encoding for request bodies and response decoding
+
+Uses orjson or msgspec when one of them is installed and falls back to the
+standard library otherwise. Install the fast path with `pip install honcho-ai[fast]`
+"""
+import datetime
+import json
+import uuid
+from typing import Any, Dict
+
+
+def _default(obj: Any):
+    """Encode the types the fast codecs support natively"""
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def dumps(obj: Any) -> bytes:
+        """Encode an object as JSON bytes"""
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def dumps(obj: Any) -> bytes:
+            """Encode an object as JSON bytes"""
+            return _encoder.encode(obj)
+
+        loads = _decoder.decode
+    except ImportError:
+        BACKEND = "json"
+
+        def dumps(obj: Any) -> bytes:
+            """Encode an object as JSON bytes"""
+            return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+        loads = json.loads
+
+
+def json_body(data: Any) -> Dict[str, Any]:
+    """Keyword arguments for an httpx request sending data as a JSON body
+
+    Args:
+        data: The object to send
+
+    Returns:
+        Dict: content and headers arguments for httpx
+    """
+    return {"content": dumps(data), "headers": {"Content-Type": "application/json"}}
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from typing import Dict, Optional, Union
+
+import httpx
+
+from .codec import loads
+from .schemas import Message, Metamessage
+
+# The server sends a keepalive every 15 seconds, a read taking much longer means the connection is gone
+READ_TIMEOUT = 60.0
+
+MAX_RETRY_DELAY = 30.0
+
+
+class Event:
+    """A message or metamessage created in a session"""
+    __slots__ = ("id", "type", "item")
+
+    def __init__(self, id: str, type: str, item: Union[Message, Metamessage, Dict]):
+        """Constructor for Event
+
+        Args:
+            id (str): The event ID, pass it as last_event_id to resume after this event
+            type (str): message or metamessage
+            item (Message | Metamessage | Dict): The created object, or the raw data for unknown types
+        """
+        self.id = id
+        self.type = type
+        self.item = item
+
+    def __str__(self) -> str:
+        return f"Event(id={self.id}, type={self.type}, item={self.item})"
+
+
+def _build_event(event_id: str, event_type: str, data: str) -> Event:
+    fields = loads(data)
+    if event_type == "message":
+        item = Message(
+            session_id=fields["session_id"],
+            id=fields["id"],
+            is_user=fields["is_user"],
+            content=fields["content"],
+            created_at=fields["created_at"],
+            seq=fields.get("seq"),
+        )
+    elif event_type == "metamessage":
+        item = Metamessage(
+            id=fields["id"],
+            message_id=fields["message_id"],
+            metamessage_type=fields["metamessage_type"],
+            content=fields["content"],
+            created_at=fields["created_at"],
+        )
+    else:
+        item = fields
+    return Event(event_id, event_type, item)
+
+
+class _Parser:
+    """Incremental parser for the lines of a text/event-stream"""
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.type = "message"
+        self.data = []
+        self.retry: Optional[float] = None
+
+    def feed(self, line: str) -> Optional[Event]:
+        """Consume a line, returning an event when the line completes one"""
+        if not line:
+            if not self.data:
+                return None
+            event = _build_event(self.id, self.type, "\n".join(self.data))
+            self.type, self.data = "message", []
+            return event
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "id":
+            self.id = value
+        elif field == "event":
+            self.type = value
+        elif field == "data":
+            self.data.append(value)
+        elif field == "retry" and value.isdigit():
+            self.retry = int(value) / 1000
+        return None
+
+
+class _EventStreamBase:
+    def __init__(self, session, last_event_id: Optional[str] = None, reconnect: bool = True, max_retries: int = 5):
+        """Constructor for the event stream of a session
+
+        Args:
+            session: The session to stream the events of
+            last_event_id (str, optional): Start after this event, 0 replays the whole session. Only new events by default
+            reconnect (bool, optional): Whether to reconnect after the connection drops
+            max_retries (int, optional): Consecutive failed connections before giving up
+        """
+        self.client = session.client
+        self.url = f"{session.common_prefix}/users/{session.user_id}/sessions/{session.id}/events"
+        self.last_event_id = last_event_id
+        self.reconnect = reconnect
+        self.max_retries = max_retries
+        self.retry_delay = 3.0
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Accept": "text/event-stream", "Cache-Control": "no-cache"}
+        if self.last_event_id is not None:
+            headers["Last-Event-ID"] = self.last_event_id
+        return headers
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(10.0, read=READ_TIMEOUT)
+
+
+class AsyncEventStream(_EventStreamBase):
+    """Async iterator over the events of a session
+
+    Reconnects with the ID of the last event it yielded so no event is
+    missed, although one may be yielded twice. Close it with aclose.
+    """
+
+    def __init__(self, session, last_event_id: Optional[str] = None, reconnect: bool = True, max_retries: int = 5):
+        super().__init__(session, last_event_id, reconnect, max_retries)
+        self._events = self._iterate()
+
+    def __aiter__(self) -> "AsyncEventStream":
+        return self
+
+    async def __anext__(self) -> Event:
+        return await self._events.__anext__()
+
+    async def aclose(self) -> None:
+        await self._events.aclose()
+
+    async def _iterate(self):
+        failures = 0
+        while True:
+            try:
+                async with self.client.stream("GET", self.url, headers=self._headers(), timeout=self._timeout()) as response:
+                    response.raise_for_status()
+                    failures = 0
+                    parser = _Parser()
+                    async for line in response.aiter_lines():
+                        event = parser.feed(line)
+                        if parser.retry is not None:
+                            self.retry_delay = parser.retry
+                        if event is not None:
+                            self.last_event_id = event.id
+                            yield event
+            except httpx.TransportError:
+                failures += 1
+                if not self.reconnect or failures > self.max_retries:
+                    raise
+            if not self.reconnect:
+                return
+            await asyncio.sleep(min(self.retry_delay * failures, MAX_RETRY_DELAY))
+
+
+class EventStream(_EventStreamBase):
+    """Iterator over the events of a session
+
+    Reconnects with the ID of the last event it yielded so no event is
+    missed, although one may be yielded twice. Close it with close.
+    """
+
+    def __init__(self, session, last_event_id: Optional[str] = None, reconnect: bool = True, max_retries: int = 5):
+        super().__init__(session, last_event_id, reconnect, max_retries)
+        self._events = self._iterate()
+
+    def __iter__(self) -> "EventStream":
+        return self
+
+    def __next__(self) -> Event:
+        return self._events.__next__()
+
+    def close(self) -> None:
+        self._events.close()
+
+    def _iterate(self):
+        failures = 0
+        while True:
+            try:
+                with self.client.stream("GET", self.url, headers=self._headers(), timeout=self._timeout()) as response:
+                    response.raise_for_status()
+                    failures = 0
+                    parser = _Parser()
+                    for line in response.iter_lines():
+                        event = parser.feed(line)
+                        if parser.retry is not None:
+                            self.retry_delay = parser.retry
+                        if event is not None:
+                            self.last_event_id = event.id
+                            yield event
+            except httpx.TransportError:
+                failures += 1
+                if not self.reconnect or failures > self.max_retries:
+                    raise
+            if not self.reconnect:
+                return
+            time.sleep(min(self.retry_delay * failures, MAX_RETRY_DELAY))
@@ -1,39 +1,235 @@
 import uuid
 import datetime
+from typing import Optional, Union
+
+
+def parse_uuid(value: Union[str, uuid.UUID, None]) -> Optional[uuid.UUID]:
+    """Convert an ID from an API response to a UUID, passing through values that are already parsed"""
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    return uuid.UUID(value)
+
+
+def parse_datetime(value: Union[str, datetime.datetime, None]) -> Optional[datetime.datetime]:
+    """Convert an ISO 8601 timestamp from an API response to a datetime, passing through values that are already parsed"""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(value)
+
 
 class Message:
-    def __init__(self, session_id: uuid.UUID, id: uuid.UUID, is_user: bool, content: str, created_at: datetime.datetime):
-        """Constructor for Message"""
-        self.session_id = session_id
-        self.id = id
+    """A message in a session
+
+    IDs and created_at are kept as the raw strings from the API response and
+    only parsed the first time they are accessed.
+    """
+    __slots__ = ("_session_id", "_id", "is_user", "content", "_created_at", "seq")
+
+    def __init__(
+        self, session_id: uuid.UUID, id: uuid.UUID, is_user: bool, content: str, created_at: datetime.datetime,
+        seq: Optional[int] = None,
+    ):
+        """Constructor for Message
+
+        seq is the message's position in its session, None until the API has stored it
+        """
+        self._session_id = session_id
+        self._id = id
         self.is_user = is_user
         self.content = content
-        self.created_at = created_at
+        self._created_at = created_at
+        self.seq = seq
+
+    @property
+    def session_id(self) -> uuid.UUID:
+        if not isinstance(self._session_id, uuid.UUID):
+            self._session_id = parse_uuid(self._session_id)
+        return self._session_id
+
+    @session_id.setter
+    def session_id(self, value):
+        self._session_id = value
+
+    @property
+    def id(self) -> uuid.UUID:
+        if not isinstance(self._id, uuid.UUID):
+            self._id = parse_uuid(self._id)
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        if isinstance(self._created_at, str):
+            self._created_at = parse_datetime(self._created_at)
+        return self._created_at
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created_at = value
 
     def __str__(self):
-        return f"Message(id={self.id}, is_user={self.is_user}, content={self.content})"
+        return f"Message(id={self.id}, seq={self.seq}, is_user={self.is_user}, content={self.content})"
+
+class SearchHit(Message):
+    """A message matching a search
+
+    snippet is an HTML escaped excerpt of the content with the matching words
+    in <b></b> and no other markup, rank is higher for better matches.
+    """
+    __slots__ = ("snippet", "rank")
+
+    def __init__(
+        self, session_id: uuid.UUID, id: uuid.UUID, is_user: bool, content: str, created_at: datetime.datetime,
+        seq: Optional[int], snippet: str, rank: float,
+    ):
+        """Constructor for SearchHit"""
+        super().__init__(session_id, id, is_user, content, created_at, seq)
+        self.snippet = snippet
+        self.rank = rank
+
+    def __str__(self):
+        return f"SearchHit(id={self.id}, rank={self.rank}, snippet={self.snippet})"
 
 class Metamessage:
-    def __init__(self, id: uuid.UUID, message_id: uuid.UUID, metamessage_type: str, content: str, created_at: datetime.datetime):
-        """Constructor for Metamessage"""
-        self.id = id
-        self.message_id = message_id
+    """A metamessage linked to a message
+
+    IDs and created_at are kept as the raw strings from the API response and
+    only parsed the first time they are accessed.
+    """
+    __slots__ = ("_id", "_message_id", "metamessage_type", "content", "_created_at", "_session_id")
+
+    def __init__(
+        self, id: uuid.UUID, message_id: uuid.UUID, metamessage_type: str, content: str, created_at: datetime.datetime,
+        session_id: Optional[uuid.UUID] = None,
+    ):
+        """Constructor for Metamessage
+
+        session_id is only known for metamessages listed across a user's sessions
+        """
+        self._id = id
+        self._message_id = message_id
         self.metamessage_type = metamessage_type
         self.content = content
-        self.created_at = created_at
+        self._created_at = created_at
+        self._session_id = session_id
+
+    @property
+    def id(self) -> uuid.UUID:
+        if not isinstance(self._id, uuid.UUID):
+            self._id = parse_uuid(self._id)
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    @property
+    def message_id(self) -> uuid.UUID:
+        if not isinstance(self._message_id, uuid.UUID):
+            self._message_id = parse_uuid(self._message_id)
+        return self._message_id
+
+    @message_id.setter
+    def message_id(self, value):
+        self._message_id = value
+
+    @property
+    def session_id(self) -> Optional[uuid.UUID]:
+        if isinstance(self._session_id, str):
+            self._session_id = parse_uuid(self._session_id)
+        return self._session_id
+
+    @session_id.setter
+    def session_id(self, value):
+        self._session_id = value
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        if isinstance(self._created_at, str):
+            self._created_at = parse_datetime(self._created_at)
+        return self._created_at
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created_at = value
 
     def __str__(self):
         return f"Metamessage(id={self.id}, message_id={self.message_id}, metamessage_type={self.metamessage_type}, content={self.content})"
-    
+
 class Document:
+    """A document in a collection
+
+    IDs and created_at are kept as the raw strings from the API response and
+    only parsed the first time they are accessed.
+    """
+    __slots__ = ("_id", "_collection_id", "content", "metadata", "_created_at")
+
     def __init__(self, id: uuid.UUID, collection_id: uuid.UUID, content: str, metadata: dict, created_at: datetime.datetime):
         """Constructor for Document"""
-        self.collection_id = collection_id
-        self.id = id
+        self._collection_id = collection_id
+        self._id = id
         self.content = content
         self.metadata = metadata
-        self.created_at = created_at
+        self._created_at = created_at
+
+    @property
+    def id(self) -> uuid.UUID:
+        if not isinstance(self._id, uuid.UUID):
+            self._id = parse_uuid(self._id)
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    @property
+    def collection_id(self) -> uuid.UUID:
+        if not isinstance(self._collection_id, uuid.UUID):
+            self._collection_id = parse_uuid(self._collection_id)
+        return self._collection_id
+
+    @collection_id.setter
+    def collection_id(self, value):
+        self._collection_id = value
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        if isinstance(self._created_at, str):
+            self._created_at = parse_datetime(self._created_at)
+        return self._created_at
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created_at = value
 
     def __str__(self) -> str:
         return f"Document(id={self.id}, metadata={self.metadata}, content={self.content}, created_at={self.created_at})"
 
+
+class DeletionJob:
+    """A session or collection being deleted in the background"""
+
+    def __init__(self, data: dict):
+        """Constructor for DeletionJob from an API response"""
+        self.id: uuid.UUID = parse_uuid(data["id"])
+        self.kind: str = data["kind"]
+        self.target_id: uuid.UUID = parse_uuid(data["target_id"])
+        self.status: str = data["status"]
+        # Messages for a session, documents for a collection
+        self.deleted: int = data["deleted"]
+        self.total: Optional[int] = data["total"]
+        self.error: Optional[str] = data["error"]
+        self.created_at: Optional[datetime.datetime] = parse_datetime(data["created_at"])
+        self.finished_at: Optional[datetime.datetime] = parse_datetime(data["finished_at"])
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def __str__(self) -> str:
+        return f"DeletionJob(id={self.id}, kind={self.kind}, status={self.status}, deleted={self.deleted}, total={self.total})"
@@ -1,11 +1,26 @@
+import abc
 import uuid
 import datetime
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Optional, List, Union
 import httpx
-from .schemas import Message, Metamessage, Document
-
-class GetPage:
-    """Base class for receiving Paginated API results"""
+from .schemas import DeletionJob, Message, Metamessage, Document, SearchHit
+from .buffer import MessageBuffer
+from .bulk import BulkExecutor
+from .events import EventStream
+from .codec import json_body, loads
+from .transport import CompressionTransport, ConsistencyTransport, ETagTransport
+from . import tracing
+
+def _inject_trace_context(request: httpx.Request):
+    """Request event hook propagating the caller's trace to the server"""
+    tracing.inject(request.headers)
+
+class GetPage(abc.ABC):
+    """Base class for receiving Paginated API results
+
+    Item objects are only built from the raw response the first time items is
+    accessed.
+    """
     def __init__(self, response: Dict) -> None:
         """Constructor for Page with relevant information about the results and pages
 
@@ -16,7 +31,20 @@ class GetPage:
         self.page = response["page"]
         self.page_size = response["size"]
         self.pages = response["pages"]
-        self.items =[]
+        self._raw_items: List[Dict] = response["items"]
+        self._items: Optional[List] = None
+
+    @property
+    def items(self) -> List:
+        """The results on this page"""
+        if self._items is None:
+            self._items = [self._build_item(item) for item in self._raw_items]
+            self._raw_items = []
+        return self._items
+
+    @abc.abstractmethod
+    def _build_item(self, item: Dict):
+        """Build a result object from a single raw item of the response"""
 
     def next(self):
         """Shortcut method to Get the next page of results"""
@@ -30,26 +58,28 @@ class GetSessionPage(GetPage):
         
         Args:
             client (Client): Honcho Client
-            options (Dict): Options for the request used mainly for next() to filter queries. The two parameters available are user_id which is required and location_id which is optional
+            options (Dict): Options for the request used mainly for next() to filter queries. The parameters available are user_id which is required and location_id and order_by which are optional
             response (Dict): Response from API with pagination information
         """
         super().__init__(response)
         self.client = client
         self.user_id = options["user_id"]
         self.location_id = options["location_id"]
-        self.items = [
-            Session(
-                client=client,
-                id=session["id"],
-                user_id=session["user_id"],
-                location_id=session["location_id"],
-                is_active=session["is_active"],
-                metadata=session["metadata"],
-                created_at=session["created_at"],
-            )
-            for session in response["items"]
-        ]
-       
+        self.order_by = options.get("order_by", "created_at")
+
+    def _build_item(self, session: Dict):
+        return Session(
+            client=self.client,
+            id=session["id"],
+            user_id=session["user_id"],
+            location_id=session["location_id"],
+            is_active=session["is_active"],
+            metadata=session["metadata"],
+            created_at=session["created_at"],
+            message_count=session.get("message_count", 0),
+            last_message_at=session.get("last_message_at"),
+        )
+
     def next(self):
         """Get the next page of results
         Returns:
@@ -57,30 +87,32 @@ class GetSessionPage(GetPage):
         """
         if self.page >= self.pages:
             return None
-        return self.client.get_sessions(self.user_id, self.location_id, self.page + 1, self.page_size)
+        return self.client.get_sessions(self.user_id, self.location_id, self.page + 1, self.page_size, self.order_by)
 
 class GetMessagePage(GetPage):
     """Paginated Results for Get Session Requests"""
 
-    def __init__(self, session, response: Dict):
+    def __init__(self, session, response: Dict, after_seq: Optional[int] = None):
         """Constructor for Page Result from Session Get Request
         
         Args:
             session (Session): Session the returned messages are associated with
             response (Dict): Response from API with pagination information
+            after_seq (int, optional): The after_seq the page was requested with
         """
         super().__init__(response)
         self.session = session
-        self.items = [
-                Message(
-                session_id=session.id,
-                id=message["id"],
-                is_user=message["is_user"],
-                content=message["content"],
-                created_at=message["created_at"],
-            )
-            for message in response["items"]
-        ]
+        self.after_seq = after_seq
+
+    def _build_item(self, message: Dict):
+        return Message(
+            session_id=self.session.id,
+            id=message["id"],
+            is_user=message["is_user"],
+            content=message["content"],
+            created_at=message["created_at"],
+            seq=message.get("seq"),
+        )
 
     def next(self):
         """Get the next page of results
@@ -89,7 +121,7 @@ class GetMessagePage(GetPage):
         """
         if self.page >= self.pages:
             return None
-        return self.session.get_messages((self.page + 1), self.page_size)
+        return self.session.get_messages((self.page + 1), self.page_size, self.after_seq)
 
 class GetMetamessagePage(GetPage):
     
@@ -105,16 +137,15 @@ class GetMetamessagePage(GetPage):
         self.session = session
         self.message_id = options["message_id"] if "message_id" in options else None
         self.metamessage_type = options["metamessage_type"] if "metamessage_type" in options else None
-        self.items = [
-                Metamessage(
-                    id=metamessage["id"],
-                    message_id=metamessage["message_id"],
-                    metamessage_type=metamessage["metamessage_type"],
-                    content=metamessage["content"],
-                    created_at=metamessage["created_at"],
-                    )
-                for metamessage in response["items"]
-        ]
+
+    def _build_item(self, metamessage: Dict):
+        return Metamessage(
+            id=metamessage["id"],
+            message_id=metamessage["message_id"],
+            metamessage_type=metamessage["metamessage_type"],
+            content=metamessage["content"],
+            created_at=metamessage["created_at"],
+        )
 
     def next(self):
         """Get the next page of results
@@ -125,6 +156,108 @@ class GetMetamessagePage(GetPage):
             return None
         return self.session.get_metamessages(metamessage_type=self.metamessage_type, message=self.message_id, page=(self.page + 1), page_size=self.page_size)
 
+class CursorPage(abc.ABC):
+    """Base class for receiving API results paginated with cursors
+
+    Item objects are only built from the raw response the first time items is
+    accessed.
+    """
+    def __init__(self, response: Dict) -> None:
+        """Constructor for Page with the cursor of the next page
+
+        Args:
+            response (Dict): Response from API with the items and next_cursor, None on the last page
+        """
+        self.next_cursor: Optional[str] = response["next_cursor"]
+        self._raw_items: List[Dict] = response["items"]
+        self._items: Optional[List] = None
+
+    @property
+    def items(self) -> List:
+        """The results on this page"""
+        if self._items is None:
+            self._items = [self._build_item(item) for item in self._raw_items]
+            self._raw_items = []
+        return self._items
+
+    @abc.abstractmethod
+    def _build_item(self, item: Dict):
+        """Build a result object from a single raw item of the response"""
+
+    def next(self):
+        """Shortcut method to Get the next page of results"""
+        pass
+
+class GetUserMetamessagePage(CursorPage):
+    """Results for Get User Metamessages requests, across all of a user's sessions"""
+
+    def __init__(self, client, options: Dict, response: Dict) -> None:
+        """Constructor for Page Result from User Metamessage Get Request
+
+        Args:
+            client (Client): Honcho Client
+            options (Dict): Options for the request used by next(), user_id, metamessage_type, since and page_size
+            response (Dict): Response from API with the items and next cursor
+        """
+        super().__init__(response)
+        self.client = client
+        self.options = options
+
+    def _build_item(self, metamessage: Dict):
+        return Metamessage(
+            id=metamessage["id"],
+            message_id=metamessage["message_id"],
+            metamessage_type=metamessage["metamessage_type"],
+            content=metamessage["content"],
+            created_at=metamessage["created_at"],
+            session_id=metamessage["session_id"],
+        )
+
+    def next(self):
+        """Get the next page of results
+        Returns:
+            GetUserMetamessagePage | None: Next Page of Results or None if this is the last page
+        """
+        if self.next_cursor is None:
+            return None
+        return self.client.get_user_metamessages(cursor=self.next_cursor, **self.options)
+
+class SearchMessagePage(CursorPage):
+    """Results for Search Messages requests, best matches first"""
+
+    def __init__(self, client, options: Dict, response: Dict) -> None:
+        """Constructor for Page Result from Search Messages Request
+
+        Args:
+            client (Client): Honcho Client
+            options (Dict): Options for the request used by next(), user_id, query, session_id, location_id and page_size
+            response (Dict): Response from API with the items and next cursor
+        """
+        super().__init__(response)
+        self.client = client
+        self.options = options
+
+    def _build_item(self, hit: Dict):
+        return SearchHit(
+            session_id=hit["session_id"],
+            id=hit["id"],
+            is_user=hit["is_user"],
+            content=hit["content"],
+            created_at=hit["created_at"],
+            seq=hit.get("seq"),
+            snippet=hit["snippet"],
+            rank=hit["rank"],
+        )
+
+    def next(self):
+        """Get the next page of results
+        Returns:
+            SearchMessagePage | None: Next Page of Results or None if this is the last page
+        """
+        if self.next_cursor is None:
+            return None
+        return self.client.search_messages(cursor=self.next_cursor, **self.options)
+
 class GetDocumentPage(GetPage):
     """Paginated results for Get Document requests"""
     def __init__(self, collection, response: Dict) -> None:
@@ -136,16 +269,15 @@ class GetDocumentPage(GetPage):
         """
         super().__init__(response)
         self.collection = collection
-        self.items = [
-            Document(
-                id=document["id"],
-                collection_id=collection.id,
-                content=document["content"],
-                metadata=document["metadata"],
-                created_at=document["created_at"],
-                ) 
-            for document in response["items"]
-        ]
+
+    def _build_item(self, document: Dict):
+        return Document(
+            id=document["id"],
+            collection_id=self.collection.id,
+            content=document["content"],
+            metadata=document["metadata"],
+            created_at=document["created_at"],
+        )
 
     def next(self):
         """Get the next page of results
@@ -170,17 +302,16 @@ class GetCollectionPage(GetPage):
         super().__init__(response)
         self.client = client
         self.user_id = options["user_id"]
-        self.items = [
-            Collection(
-                client=client,
-                id=collection["id"],
-                user_id=collection["user_id"],
-                name=collection["name"],
-                created_at=collection["created_at"],
-            )
-            for collection in response["items"]
-        ]
-       
+
+    def _build_item(self, collection: Dict):
+        return Collection(
+            client=self.client,
+            id=collection["id"],
+            user_id=collection["user_id"],
+            name=collection["name"],
+            created_at=collection["created_at"],
+        )
+
     def next(self):
         """Get the next page of results
         Returns:
@@ -193,17 +324,51 @@ class GetCollectionPage(GetPage):
 class Client:
     """Honcho API Client Object"""
 
-    def __init__(self, app_id: str, base_url: str = "https://demo.honcho.dev"):
-        """Constructor for Client"""
+    def __init__(self, app_id: str, base_url: str = "https://demo.honcho.dev", max_concurrency: int = 8, request_compression: Optional[str] = None, etag_cache_size: int = 256):
+        """Constructor for Client
+
+        Responses are always requested compressed with every encoding httpx can
+        decode (gzip, plus zstd with the zstd extra installed). GETs
+        that returned an ETag are revalidated with If-None-Match and an
+        unchanged resource is read from the cache instead of sent again.
+        Requests carry the consistency token of the client's last write so
+        servers with read replicas never answer from one that lacks it.
+
+        Args:
+            app_id (str): The ID of the app representing the client application using honcho
+            base_url (str, optional): Base URL for the instance of the Honcho API
+            max_concurrency (int, optional): Maximum number of requests bulk helpers run at once
+            request_compression (str, optional): gzip or zstd to compress request bodies of 1 KB or more. Requires a server that accepts compressed bodies
+            etag_cache_size (int, optional): Number of responses kept for revalidation. 0 disables the cache
+        """
         self.base_url = base_url  # Base URL for the instance of the Honcho API
         self.app_id = app_id # Representing ID of the client application
-        self.client = httpx.Client()
+        transport = httpx.HTTPTransport(limits=httpx.Limits(max_connections=100, max_keepalive_connections=max(20, max_concurrency)))
+        if request_compression is not None:
+            transport = CompressionTransport(transport, request_compression)
+        if etag_cache_size > 0:
+            transport = ETagTransport(transport, etag_cache_size)
+        # Reads after a write are served by a replica that has the write, or the primary
+        transport = ConsistencyTransport(transport)
+        self.client = httpx.Client(transport=transport, event_hooks={"request": [_inject_trace_context]})
+        self.executor = BulkExecutor(max_concurrency)
 
     @property
     def common_prefix(self):
         """Shorcut for common API prefix. made a property to prevent tampering"""
         return f"{self.base_url}/apps/{self.app_id}"
 
+    def close(self):
+        """Close the HTTP connections and the bulk helpers' workers, the client can't be used afterwards"""
+        self.executor.close()
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def get_session(self, user_id: str, session_id: uuid.UUID):
         """Get a specific session for a user by ID
 
@@ -218,7 +383,7 @@ class Client:
         url = f"{self.common_prefix}/users/{user_id}/sessions/{session_id}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Session(
             client=self,
             id=data["id"],
@@ -226,10 +391,27 @@ class Client:
             location_id=data["location_id"],
             is_active=data["is_active"],
             metadata=data["metadata"],
-            created_at=data["created_at"]
+            created_at=data["created_at"],
+            message_count=data.get("message_count", 0),
+            last_message_at=data.get("last_message_at"),
         )
 
-    def get_sessions(self, user_id: str, location_id: Optional[str] = None, page: int = 1, page_size: int = 50):
+    def get_sessions_by_id(self, user_id: str, session_ids: List[uuid.UUID]) -> List[Union["Session", Exception]]:
+        """Get many sessions for a user by ID concurrently
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            session_ids (List[uuid.UUID]): The IDs of the Sessions to retrieve
+
+        Returns:
+            List[Session | Exception]: The Session for each ID in input order, or the exception raised retrieving it
+
+        """
+        return self.executor.map(lambda session_id: self.get_session(user_id, session_id), session_ids)
+
+    def get_sessions(
+        self, user_id: str, location_id: Optional[str] = None, page: int = 1, page_size: int = 50, order_by: str = "created_at"
+    ):
         """Return sessions associated with a user paginated
 
         Args:
@@ -237,29 +419,32 @@ class Client:
             location_id (str, optional): Optional Location ID representing the location of a session
             page (int, optional): The page of results to return
             page_size (int, optional): The number of results to return
+            order_by (str, optional): created_at for oldest first, or last_activity for the most recently active first
 
         Returns:
             GetSessionPage: Page or results for get_sessions query
 
         """
-        url = f"{self.common_prefix}/users/{user_id}/sessions?page={page}&size={page_size}" + (
+        url = f"{self.common_prefix}/users/{user_id}/sessions?page={page}&size={page_size}&order_by={order_by}" + (
             f"&location_id={location_id}" if location_id else ""
         )
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         options = {
                 "location_id": location_id,
-                "user_id": user_id
+                "user_id": user_id,
+                "order_by": order_by,
                 }
         return GetSessionPage(self, options, data)
 
-    def get_sessions_generator(self, user_id: str, location_id: Optional[str] = None):
+    def get_sessions_generator(self, user_id: str, location_id: Optional[str] = None, order_by: str = "created_at"):
         """Shortcut Generator for get_sessions. Generator to iterate through all sessions for a user in an app
 
         Args:
             user_id (str): The User ID representing the user, managed by the user
             location_id (str, optional): Optional Location ID representing the location of a session
+            order_by (str, optional): created_at for oldest first, or last_activity for the most recently active first
 
         Yields:
             Session: The Session object of the requested Session
@@ -267,7 +452,7 @@ class Client:
         """
         page = 1
         page_size = 50
-        get_session_response = self.get_sessions(user_id, location_id, page, page_size)
+        get_session_response = self.get_sessions(user_id, location_id, page, page_size, order_by)
         while True:
             # get_session_response = self.get_sessions(user_id, location_id, page, page_size)
             for session in get_session_response.items:
@@ -295,9 +480,9 @@ class Client:
         """
         data = {"location_id": location_id, "metadata": metadata}
         url = f"{self.common_prefix}/users/{user_id}/sessions"
-        response = self.client.post(url, json=data)
+        response = self.client.post(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Session(
             self,
             id=data["id"],
@@ -306,8 +491,172 @@ class Client:
             metadata=metadata,
             is_active=data["is_active"],
             created_at=data["created_at"],
+            message_count=data.get("message_count", 0),
+            last_message_at=data.get("last_message_at"),
+        )
+
+    def get_or_create_session(
+        self, user_id: str, location_id: str = "default", metadata: Dict = {}
+    ):
+        """Get the newest active session for a user at a location, creating one if there is none
+
+        Resolved on the server in a single request, safe to call concurrently
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            location_id (str, optional): Optional Location ID representing the location of a session
+            metadata (Dict, optional): Optional session metadata used if a session is created
+
+        Returns:
+            Session: The existing or new Session
+
+        """
+        data = {"location_id": location_id, "metadata": metadata}
+        url = f"{self.common_prefix}/users/{user_id}/sessions/resolve"
+        response = self.client.post(url, **json_body(data))
+        response.raise_for_status()
+        data = loads(response.content)
+        return Session(
+            self,
+            id=data["id"],
+            user_id=data["user_id"],
+            location_id=data["location_id"],
+            metadata=data["metadata"],
+            is_active=data["is_active"],
+            created_at=data["created_at"],
+            message_count=data.get("message_count", 0),
+            last_message_at=data.get("last_message_at"),
         )
 
+    def get_user_metamessages(
+        self,
+        user_id: str,
+        metamessage_type: Optional[str] = None,
+        since: Optional[datetime.datetime] = None,
+        cursor: Optional[str] = None,
+        page_size: int = 50,
+    ) -> GetUserMetamessagePage:
+        """Get a user's metamessages across all of their sessions, oldest first
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            metamessage_type (str, optional): Only metamessages of this type
+            since (datetime, optional): Only metamessages created at or after this time
+            cursor (str, optional): The next_cursor of the previous page
+            page_size (int, optional): The number of results to return per page
+
+        Returns:
+            GetUserMetamessagePage: Page of Metamessage objects, each with its session_id
+
+        """
+        params: Dict = {"size": page_size}
+        if metamessage_type is not None:
+            params["metamessage_type"] = metamessage_type
+        if since is not None:
+            params["since"] = since.isoformat()
+        if cursor is not None:
+            params["cursor"] = cursor
+        url = f"{self.common_prefix}/users/{user_id}/metamessages"
+        response = self.client.get(url, params=params)
+        response.raise_for_status()
+        options = {"user_id": user_id, "metamessage_type": metamessage_type, "since": since, "page_size": page_size}
+        return GetUserMetamessagePage(self, options, loads(response.content))
+
+    def get_user_metamessages_generator(
+        self, user_id: str, metamessage_type: Optional[str] = None, since: Optional[datetime.datetime] = None
+    ):
+        """Shortcut Generator for get_user_metamessages. Generator to iterate through all of a user's metamessages
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            metamessage_type (str, optional): Only metamessages of this type
+            since (datetime, optional): Only metamessages created at or after this time
+
+        Yields:
+            Metamessage: The next Metamessage object, with its session_id
+
+        """
+        page = self.get_user_metamessages(user_id, metamessage_type=metamessage_type, since=since)
+        while page is not None:
+            for metamessage in page.items:
+                yield metamessage
+            page = page.next()
+
+    def search_messages(
+        self,
+        user_id: str,
+        query: str,
+        session_id: Optional[uuid.UUID] = None,
+        location_id: Optional[str] = None,
+        cursor: Optional[str] = None,
+        page_size: int = 20,
+    ) -> SearchMessagePage:
+        """Search a user's messages by keyword, best matches first
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            query (str): The words to search for
+            session_id (uuid.UUID, optional): Only messages of this session
+            location_id (str, optional): Only messages of sessions at this location
+            cursor (str, optional): The next_cursor of the previous page
+            page_size (int, optional): The number of results to return per page
+
+        Returns:
+            SearchMessagePage: Page of SearchHit objects
+
+        """
+        params: Dict = {"q": query, "size": page_size}
+        if session_id is not None:
+            params["session_id"] = str(session_id)
+        if location_id is not None:
+            params["location_id"] = location_id
+        if cursor is not None:
+            params["cursor"] = cursor
+        url = f"{self.common_prefix}/users/{user_id}/messages/search"
+        response = self.client.get(url, params=params)
+        response.raise_for_status()
+        options = {
+            "user_id": user_id, "query": query, "session_id": session_id, "location_id": location_id, "page_size": page_size
+        }
+        return SearchMessagePage(self, options, loads(response.content))
+
+    def search_messages_generator(
+        self, user_id: str, query: str, session_id: Optional[uuid.UUID] = None, location_id: Optional[str] = None
+    ):
+        """Shortcut Generator for search_messages. Generator to iterate through all of a user's messages matching a query
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            query (str): The words to search for
+            session_id (uuid.UUID, optional): Only messages of this session
+            location_id (str, optional): Only messages of sessions at this location
+
+        Yields:
+            SearchHit: The next matching message
+
+        """
+        page = self.search_messages(user_id, query, session_id=session_id, location_id=location_id)
+        while page is not None:
+            for hit in page.items:
+                yield hit
+            page = page.next()
+
+    def get_deletion_job(self, user_id: str, job_id: uuid.UUID) -> DeletionJob:
+        """Get the progress of a session or collection deleted in the background
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            job_id (uuid.UUID): The ID of the job returned by delete(background=True)
+
+        Returns:
+            DeletionJob: The job as it stands
+
+        """
+        url = f"{self.common_prefix}/users/{user_id}/deletions/{job_id}"
+        response = self.client.get(url)
+        response.raise_for_status()
+        return DeletionJob(loads(response.content))
+
     def create_collection(
             self, user_id: str, name: str,
     ):
@@ -323,9 +672,9 @@ class Client:
         """
         data = {"name": name}
         url = f"{self.common_prefix}/users/{user_id}/collections"
-        response = self.client.post(url, json=data)
+        response = self.client.post(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Collection(
             self,
             id=data["id"],
@@ -348,7 +697,7 @@ class Client:
         url = f"{self.common_prefix}/users/{user_id}/collections/name/{name}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Collection(
             client=self,
             id=data["id"],
@@ -372,7 +721,7 @@ class Client:
         url = f"{self.common_prefix}/users/{user_id}/collections/all?page={page}&size={page_size}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         options = {"user_id": user_id}
         return GetCollectionPage(self, options, data)
 
@@ -400,6 +749,31 @@ class Client:
            
             get_collection_response = new_collections
 
+    def export_user(self, user_id: str, path: str, gzip: bool = False, include_embeddings: bool = False) -> int:
+        """Write everything stored for a user to a file as NDJSON
+
+        Each line is a JSON object with a type (session, message, metamessage,
+        collection or document) and the object's data. The export is streamed
+        to the file so it never has to fit in memory.
+
+        Args:
+            user_id (str): The User ID representing the user, managed by the user
+            path (str): The file to write
+            gzip (bool, optional): Write a gzip compressed file
+            include_embeddings (bool, optional): Whether to include document embeddings
+
+        Returns:
+            int: The number of bytes written
+        """
+        url = f"{self.common_prefix}/users/{user_id}/export?gzip={str(gzip).lower()}&include_embeddings={str(include_embeddings).lower()}"
+        written = 0
+        with self.client.stream("GET", url, timeout=httpx.Timeout(10.0, read=300.0)) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_bytes():
+                    written += f.write(chunk)
+        return written
+
 
 class Session:
     """Represents a single session for a user in an app"""
@@ -412,11 +786,14 @@ class Session:
         location_id: str,
         metadata: dict,
         is_active: bool,
-        created_at: datetime.datetime
+        created_at: datetime.datetime,
+        message_count: int = 0,
+        last_message_at: Optional[datetime.datetime] = None,
     ):
         """Constructor for Session"""
         self.base_url: str = client.base_url
         self.client: httpx.Client = client.client
+        self.executor: BulkExecutor = client.executor
         self.app_id: str = client.app_id
         self.id: uuid.UUID = id
         self.user_id: str = user_id
@@ -424,6 +801,10 @@ class Session:
         self.metadata: dict = metadata
         self._is_active: bool = is_active
         self.created_at: datetime.datetime = created_at
+        # As of when the session was fetched, they are not updated as messages are added
+        self.message_count: int = message_count
+        self.last_message_at: Optional[datetime.datetime] = last_message_at
+        self._buffer: Optional[MessageBuffer] = None
 
     @property
     def common_prefix(self):
@@ -440,9 +821,94 @@ class Session:
         """Returns whether the session is active - made property to prevent tampering"""
         return self._is_active
 
+    def enable_buffering(self, max_batch_size: int = 50, flush_interval: float = 1.0, on_error: Optional[Callable] = None) -> MessageBuffer:
+        """Opt in to write-behind buffering of messages for this session
+
+        Once enabled create_message returns immediately with a client generated
+        ID and messages are sent in order in batches in the background.
+
+        Args:
+            max_batch_size (int, optional): Number of waiting messages that triggers a flush. At most 100
+            flush_interval (float, optional): Maximum number of seconds a message waits before being sent
+            on_error (Callable, optional): Called with the exception and the list of messages when a batch fails to send
+
+        Returns:
+            MessageBuffer: The buffer holding messages waiting to be sent
+
+        """
+        if self._buffer is None:
+            self._buffer = MessageBuffer(self, max_batch_size=max_batch_size, flush_interval=flush_interval, on_error=on_error)
+        return self._buffer
+
+    def flush(self) -> bool:
+        """Send any buffered messages and wait for them to be written
+
+        Returns:
+            bool: Whether every buffered message was written, those that were not stay buffered
+        """
+        if self._buffer is not None:
+            return self._buffer.flush()
+        return True
+
+    def stop_buffering(self):
+        """Send any buffered messages and go back to writing messages immediately"""
+        if self._buffer is not None:
+            buffer = self._buffer
+            self._buffer = None
+            buffer.close()
+
+    def _send_messages(self, messages: List[Message]) -> List[Message]:
+        """Write a batch of messages with client generated IDs in order"""
+        data = [{"id": str(message.id), "is_user": message.is_user, "content": message.content} for message in messages]
+        url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/messages/batch"
+        response = self.client.post(url, **json_body(data))
+        response.raise_for_status()
+        return [
+            Message(
+                session_id=self.id, id=message["id"], is_user=message["is_user"], content=message["content"],
+                created_at=message["created_at"], seq=message.get("seq"),
+            )
+            for message in loads(response.content)
+        ]
+
+    def create_messages(self, messages: List[Dict]) -> List[Union[Message, Exception]]:
+        """Adds many messages to the session in order
+
+        Messages are written in batches of 100 with one request per batch.
+        Batches are sent one after another so the stored order matches the
+        input order. Batches after one that fails are not sent, so the stored
+        messages never have gaps.
+
+        Args:
+            messages (List[Dict]): The messages to add, each with is_user and content keys
+
+        Returns:
+            List[Message | Exception]: The Message for each input in order, or the exception raised writing its
+            batch or an earlier one
+
+        """
+        if not self.is_active:
+            raise Exception("Session is inactive")
+        self.flush()
+        results = []
+        for start in range(0, len(messages), 100):
+            batch = [
+                Message(session_id=self.id, id=uuid.uuid4(), is_user=message["is_user"], content=message["content"], created_at=None)
+                for message in messages[start:start + 100]
+            ]
+            try:
+                results.extend(self._send_messages(batch))
+            except Exception as e:
+                results.extend([e] * (len(messages) - start))
+                break
+        return results
+
     def create_message(self, is_user: bool, content: str):
         """Adds a message to the session
 
+        If buffering is enabled the message is queued and returned with a
+        client generated ID and created_at before it is written.
+
         Args:
             is_user (bool): Whether the message is from the user
             content (str): The content of the message
@@ -453,12 +919,16 @@ class Session:
         """
         if not self.is_active:
             raise Exception("Session is inactive")
+        if self._buffer is not None:
+            message = Message(session_id=self.id, id=uuid.uuid4(), is_user=is_user, content=content, created_at=datetime.datetime.utcnow())
+            self._buffer.add(message)
+            return message
         data = {"is_user": is_user, "content": content}
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/messages"
-        response = self.client.post(url, json=data)
+        response = self.client.post(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
-        return Message(session_id=self.id, id=data["id"], is_user=is_user, content=content, created_at=data["created_at"])
+        data = loads(response.content)
+        return Message(session_id=self.id, id=data["id"], is_user=is_user, content=content, created_at=data["created_at"], seq=data.get("seq"))
 
     def get_message(self, message_id: uuid.UUID) -> Message:
         """Get a specific message for a session based on ID
@@ -473,36 +943,46 @@ class Session:
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/messages/{message_id}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
-        return Message(session_id=self.id, id=data["id"], is_user=data["is_user"], content=data["content"], created_at=data["created_at"])
+        data = loads(response.content)
+        return Message(
+            session_id=self.id, id=data["id"], is_user=data["is_user"], content=data["content"],
+            created_at=data["created_at"], seq=data.get("seq"),
+        )
 
-    def get_messages(self, page: int = 1, page_size: int = 50) -> GetMessagePage:
-        """Get all messages for a session
+    def get_messages(self, page: int = 1, page_size: int = 50, after_seq: Optional[int] = None) -> GetMessagePage:
+        """Get all messages for a session in order
 
         Args:
             page (int, optional): The page of results to return
             page_size (int, optional): The number of results to return per page
+            after_seq (int, optional): Only return messages with a greater seq, pass the seq of the last message seen to fetch what is new
 
         Returns:
             GetMessagePage: Page of Message objects
 
         """
-        url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/messages?page={page}&size={page_size}"
+        self.flush()
+        url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/messages?page={page}&size={page_size}" + (
+            f"&after_seq={after_seq}" if after_seq is not None else ""
+        )
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
-        return GetMessagePage(self, data)
+        data = loads(response.content)
+        return GetMessagePage(self, data, after_seq)
         
-    def get_messages_generator(self):
+    def get_messages_generator(self, after_seq: Optional[int] = None):
         """Shortcut Generator for get_messages. Generator to iterate through all messages for a session in an app
 
+        Args:
+            after_seq (int, optional): Only yield messages with a greater seq
+
         Yields:
             Message: The Message object of the next Message
 
         """
         page = 1
         page_size = 50
-        get_messages_page= self.get_messages(page, page_size)
+        get_messages_page= self.get_messages(page, page_size, after_seq)
         while True:
             # get_session_response = self.get_sessions(user_id, location_id, page, page_size)
             for message in get_messages_page.items:
@@ -514,6 +994,19 @@ class Session:
            
             get_messages_page = new_messages
 
+    def events(self, last_event_id: Optional[str] = None, reconnect: bool = True) -> EventStream:
+        """Stream the messages and metamessages created in the session as they happen
+
+        Args:
+            last_event_id (str, optional): Start after this event, 0 replays the whole session. Only new events by default
+            reconnect (bool, optional): Whether to reconnect and resume after the connection drops
+
+        Returns:
+            EventStream: Iterator of Event objects holding the created Message or Metamessage
+
+        """
+        return EventStream(self, last_event_id=last_event_id, reconnect=reconnect)
+
     def create_metamessage(self, message: Message, metamessage_type: str, content: str):
         """Adds a metamessage to a session and links it to a specific message
 
@@ -528,11 +1021,12 @@ class Session:
         """
         if not self.is_active:
             raise Exception("Session is inactive")
-        data = {"metamessage_type": metamessage_type, "content": content, "message_id": message.id}
+        self.flush()
+        data = {"metamessage_type": metamessage_type, "content": content, "message_id": str(message.id)}
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/metamessages"
-        response = self.client.post(url, json=data)
+        response = self.client.post(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Metamessage(id=data["id"], message_id=message.id, metamessage_type=metamessage_type, content=content, created_at=data["created_at"])
 
 
@@ -549,7 +1043,7 @@ class Session:
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}/metamessages/{metamessage_id}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Metamessage(id=data["id"], message_id=data["message_id"], metamessage_type=data["metamessage_type"], content=data["content"], created_at=data["created_at"])
 
     def get_metamessages(self, metamessage_type: Optional[str] = None, message: Optional[Message] = None, page: int = 1, page_size: int = 50) -> GetMetamessagePage:
@@ -570,7 +1064,7 @@ class Session:
             url += f"&message_id={message.id}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         options = {
                 "metamessage_type": metamessage_type,
                 "message_id": message.id if message else None
@@ -614,18 +1108,38 @@ class Session:
         """
         info = {"metadata": metadata}
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}"
-        response = self.client.put(url, json=info)
+        response = self.client.put(url, **json_body(info))
         success = response.status_code < 400
         self.metadata = metadata
         return success
 
     def close(self):
         """Closes a session by marking it as inactive"""
+        self.stop_buffering()
         url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}"
         response = self.client.delete(url)
         response.raise_for_status()
         self._is_active = False
 
+    def delete(self, background: bool = False) -> Optional[DeletionJob]:
+        """Delete the session with its messages and metamessages for good
+
+        Args:
+            background (bool, optional): Return as soon as the API accepts the deletion, with a job to follow its progress
+
+        Returns:
+            DeletionJob | None: The job when deleting in the background
+
+        """
+        self.stop_buffering()
+        url = f"{self.common_prefix}/users/{self.user_id}/sessions/{self.id}?hard=true" + (
+            "&background=true" if background else ""
+        )
+        response = self.client.delete(url)
+        response.raise_for_status()
+        self._is_active = False
+        return DeletionJob(loads(response.content)) if background else None
+
 class Collection:
     """Represents a single collection for a user in an app"""
 
@@ -640,6 +1154,7 @@ class Collection:
         """Constructor for Collection"""
         self.base_url: str = client.base_url
         self.client: httpx.Client = client.client
+        self.executor: BulkExecutor = client.executor
         self.app_id: str = client.app_id
         self.id: uuid.UUID = id
         self.user_id: str = user_id
@@ -666,17 +1181,28 @@ class Collection:
         """
         info = {"name": name}
         url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}"
-        response = self.client.put(url, json=info)
+        response = self.client.put(url, **json_body(info))
         response.raise_for_status()
         success = response.status_code < 400
         self.name = name
         return success
 
-    def delete(self):
-        """Delete a collection and all associated documents"""
-        url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}"
+    def delete(self, background: bool = False) -> Optional[DeletionJob]:
+        """Delete a collection and all associated documents
+
+        Args:
+            background (bool, optional): Return as soon as the API accepts the deletion, with a job to follow its progress
+
+        Returns:
+            DeletionJob | None: The job when deleting in the background
+
+        """
+        url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}" + (
+            "?background=true" if background else ""
+        )
         response = self.client.delete(url)
         response.raise_for_status()
+        return DeletionJob(loads(response.content)) if background else None
 
     def create_document(self, content: str, metadata: Dict = {}):
         """Adds a document to the collection
@@ -691,9 +1217,9 @@ class Collection:
         """
         data = {"metadata": metadata, "content": content}
         url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}/documents"
-        response = self.client.post(url, json=data)
+        response = self.client.post(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Document(
                 collection_id=self.id,
                 id=data["id"],
@@ -702,6 +1228,21 @@ class Collection:
                 created_at=data["created_at"]
             )
 
+    def create_documents(self, documents: List[Dict]) -> List[Union[Document, Exception]]:
+        """Adds many documents to the collection concurrently
+
+        Args:
+            documents (List[Dict]): The documents to add, each with a content key and an optional metadata key
+
+        Returns:
+            List[Document | Exception]: The Document for each input in order, or the exception raised adding it
+
+        """
+        return self.executor.map(
+            lambda document: self.create_document(content=document["content"], metadata=document.get("metadata", {})),
+            documents,
+        )
+
     def get_document(self, document_id: uuid.UUID) -> Document:
         """Get a specific document for a collection based on ID
 
@@ -715,7 +1256,7 @@ class Collection:
         url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}/documents/{document_id}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Document(
                 collection_id=self.id,
                 id=data["id"],
@@ -738,7 +1279,7 @@ class Collection:
         url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}/documents?page={page}&size={page_size}"
         response = self.client.get(url)
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return GetDocumentPage(self, data)
         
     def get_documents_generator(self):
@@ -781,7 +1322,7 @@ class Collection:
                created_at=document["created_at"],
                metadata=document["metadata"]
            )
-           for document in response.json()
+           for document in loads(response.content)
         ]
         return data
 
@@ -800,9 +1341,9 @@ class Collection:
             raise ValueError("metadata and content cannot both be None")
         data = {"metadata": metadata, "content": content}
         url = f"{self.common_prefix}/users/{self.user_id}/collections/{self.id}/documents/{document.id}"
-        response = self.client.put(url, json=data)
+        response = self.client.put(url, **json_body(data))
         response.raise_for_status()
-        data = response.json()
+        data = loads(response.content)
         return Document(
             data["id"],
             metadata=data["metadata"],
@@ -0,0 +1,56 @@
+"""W3C trace context propagation for requests to the Honcho API
+
+Requests carry a traceparent header so the server's spans join the caller's
+trace. When opentelemetry-api is installed the current OpenTelemetry context
+is propagated. Otherwise calls made inside `trace()` share a trace id:
+
+    with honcho.tracing.trace() as trace_id:
+        session.create_message(is_user=True, content="Hi")
+        session.get_messages()
+"""
+import contextlib
+import random
+from contextvars import ContextVar
+from typing import Iterator, MutableMapping, Optional
+
+try:
+    from opentelemetry import propagate
+except ImportError:  # pragma: no cover - optional dependency
+    propagate = None
+
+_trace_id: ContextVar[Optional[str]] = ContextVar("honcho_trace_id", default=None)
+
+
+def new_trace_id() -> str:
+    return f"{random.getrandbits(128):032x}"
+
+
+@contextlib.contextmanager
+def trace(trace_id: Optional[str] = None) -> Iterator[str]:
+    """Send the requests made in the block as part of one trace
+
+    Args:
+        trace_id (str, optional): 32 hex digit trace id to continue, a new one by default
+
+    Yields:
+        str: The trace id, to look the trace up on the server
+    """
+    trace_id = trace_id or new_trace_id()
+    token = _trace_id.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        _trace_id.reset(token)
+
+
+def inject(headers: MutableMapping[str, str]) -> None:
+    """Add a traceparent header for the current trace if there is one"""
+    if "traceparent" in headers:
+        return
+    if propagate is not None:
+        propagate.inject(headers)
+        if "traceparent" in headers:
+            return
+    trace_id = _trace_id.get()
+    if trace_id is not None:
+        headers["traceparent"] = f"00-{trace_id}-{random.getrandbits(64):016x}-01"
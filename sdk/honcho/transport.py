@@ -0,0 +1,225 @@
+"""httpx transports wrapping the connection pool used by the clients"""
+import gzip
+from typing import List, NamedTuple, Optional, Tuple
+
+import httpx
+
+from .cache import LRUCache
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+def compress_request(request: httpx.Request, encoding: str, minimum_size: int) -> httpx.Request:
+    """Return a copy of request with its body compressed if it is large enough
+
+    Args:
+        request (httpx.Request): The request to send
+        encoding (str): gzip or zstd
+        minimum_size (int): Smallest body in bytes worth compressing
+
+    Returns:
+        httpx.Request: The request to send in its place
+    """
+    if "content-encoding" in request.headers:
+        return request
+    body = request.content
+    if len(body) < minimum_size:
+        return request
+    if encoding == "zstd":
+        compressed = zstandard.ZstdCompressor(level=3).compress(body)
+    else:
+        compressed = gzip.compress(body, compresslevel=6)
+    headers = request.headers.copy()
+    headers["Content-Encoding"] = encoding
+    headers["Content-Length"] = str(len(compressed))
+    return httpx.Request(request.method, request.url, headers=headers, content=compressed, extensions=request.extensions)
+
+
+def _check_encoding(encoding: str):
+    if encoding not in ("gzip", "zstd"):
+        raise ValueError("request_compression must be gzip or zstd")
+    if encoding == "zstd" and zstandard is None:
+        raise ValueError("zstd request compression requires the zstandard package")
+
+
+class AsyncCompressionTransport(httpx.AsyncBaseTransport):
+    """Compresses request bodies before handing them to the wrapped transport"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, encoding: str = "gzip", minimum_size: int = 1024):
+        _check_encoding(encoding)
+        self.transport = transport
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.transport.handle_async_request(compress_request(request, self.encoding, self.minimum_size))
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class CompressionTransport(httpx.BaseTransport):
+    """Compresses request bodies before handing them to the wrapped transport"""
+
+    def __init__(self, transport: httpx.BaseTransport, encoding: str = "gzip", minimum_size: int = 1024):
+        _check_encoding(encoding)
+        self.transport = transport
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self.transport.handle_request(compress_request(request, self.encoding, self.minimum_size))
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class _Cached(NamedTuple):
+    """A response body kept for revalidation, still in its content encoding"""
+    etag: str
+    headers: List[Tuple[bytes, bytes]]
+    raw: bytes
+
+
+def _etag_cache(capacity: int, max_bytes: int) -> LRUCache:
+    return LRUCache(capacity, max_weight=max_bytes, weigher=lambda key, cached: len(cached.raw))
+
+
+def _conditional(request: httpx.Request, cache: LRUCache) -> Optional[_Cached]:
+    """Add If-None-Match to a GET the cache holds a response for"""
+    if request.method != "GET" or "if-none-match" in request.headers:
+        return None
+    cached = cache.get(str(request.url))
+    if cached is not None:
+        request.headers["If-None-Match"] = cached.etag
+    return cached
+
+
+def _replay(cached: _Cached, response: httpx.Response) -> httpx.Response:
+    return httpx.Response(200, headers=cached.headers, stream=httpx.ByteStream(cached.raw), extensions=response.extensions)
+
+
+def _cacheable(request: httpx.Request, response: httpx.Response) -> bool:
+    return request.method == "GET" and response.status_code == 200 and "etag" in response.headers
+
+
+class AsyncETagTransport(httpx.AsyncBaseTransport):
+    """Revalidates GETs with their last ETag and replays the cached body on a 304"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, capacity: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.transport = transport
+        self.cache = _etag_cache(capacity, max_bytes)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        cached = _conditional(request, self.cache)
+        response = await self.transport.handle_async_request(request)
+        if cached is not None and response.status_code == 304:
+            await response.aclose()
+            return _replay(cached, response)
+        if not _cacheable(request, response):
+            return response
+        raw = b"".join([chunk async for chunk in response.aiter_raw()])
+        await response.aclose()
+        self.cache.put(str(request.url), _Cached(response.headers["etag"], response.headers.raw, raw))
+        return httpx.Response(200, headers=response.headers, stream=httpx.ByteStream(raw), extensions=response.extensions)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class ETagTransport(httpx.BaseTransport):
+    """Revalidates GETs with their last ETag and replays the cached body on a 304"""
+
+    def __init__(self, transport: httpx.BaseTransport, capacity: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.transport = transport
+        self.cache = _etag_cache(capacity, max_bytes)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        cached = _conditional(request, self.cache)
+        response = self.transport.handle_request(request)
+        if cached is not None and response.status_code == 304:
+            response.close()
+            return _replay(cached, response)
+        if not _cacheable(request, response):
+            return response
+        raw = b"".join(response.iter_raw())
+        response.close()
+        self.cache.put(str(request.url), _Cached(response.headers["etag"], response.headers.raw, raw))
+        return httpx.Response(200, headers=response.headers, stream=httpx.ByteStream(raw), extensions=response.extensions)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+CONSISTENCY_HEADER = "X-Honcho-Consistency"
+
+
+def _position(token: str) -> int:
+    """Order consistency tokens, which are Postgres WAL positions such as 16/B374D848"""
+    high, _, low = token.partition("/")
+    try:
+        return (int(high, 16) << 32) + int(low, 16)
+    except ValueError:
+        return -1
+
+
+class _Consistency:
+    """The newest consistency token a server returned, sent back on every request
+
+    A server reading from replicas only answers from one that has caught
+    up with the token, so reads always see this client's earlier writes.
+    """
+
+    def __init__(self):
+        self.latest: Optional[Tuple[int, str]] = None
+
+    def apply(self, request: httpx.Request) -> None:
+        latest = self.latest
+        if latest is not None and CONSISTENCY_HEADER not in request.headers:
+            request.headers[CONSISTENCY_HEADER] = latest[1]
+
+    def update(self, response: httpx.Response) -> None:
+        token = response.headers.get(CONSISTENCY_HEADER)
+        if token is None:
+            return
+        position = _position(token)
+        latest = self.latest
+        if latest is None or position > latest[0]:
+            self.latest = (position, token)
+
+
+class AsyncConsistencyTransport(httpx.AsyncBaseTransport):
+    """Sends the newest consistency token the server returned with every request"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.consistency = _Consistency()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.consistency.apply(request)
+        response = await self.transport.handle_async_request(request)
+        self.consistency.update(response)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class ConsistencyTransport(httpx.BaseTransport):
+    """Sends the newest consistency token the server returned with every request"""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self.transport = transport
+        self.consistency = _Consistency()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.consistency.apply(request)
+        response = self.transport.handle_request(request)
+        self.consistency.update(response)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
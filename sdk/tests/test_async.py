@@ -1,7 +1,13 @@
+import asyncio
+import gzip
+import json
+
+import httpx
 import pytest
 from honcho import AsyncGetSessionPage, AsyncGetMessagePage, AsyncGetMetamessagePage, AsyncGetDocumentPage, AsyncSession, Message, Metamessage, Document
 from honcho import AsyncClient as Honcho
-from uuid import uuid1
+from uuid import uuid1, UUID
+import datetime
 
 
 @pytest.mark.asyncio
@@ -17,6 +23,35 @@ async def test_session_creation_retrieval():
     assert retrieved_session.metadata == {}
 
 
+@pytest.mark.asyncio
+async def test_client_close():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    async with Honcho(app_id, "http://localhost:8000") as client:
+        created_session = await client.create_session(user_id)
+        retrieved = await client.get_sessions_by_id(user_id, [created_session.id])
+        assert retrieved[0].id == created_session.id
+    assert client.client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_closed_session_rejects_writes():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id)
+    message = await session.create_message(is_user=True, content="Hello")
+    # A copy that still thinks the session is active, so the requests reach the server
+    stale = await client.get_session(user_id, session.id)
+    await session.close()
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        await stale.create_message(is_user=True, content="Hello again")
+    assert excinfo.value.response.status_code == 404
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        await stale.create_metamessage(message, metamessage_type="thought", content="Too late")
+    assert excinfo.value.response.status_code == 404
+
+
 @pytest.mark.asyncio
 async def test_session_multiple_retrieval():
     app_id = str(uuid1())
@@ -32,6 +67,46 @@ async def test_session_multiple_retrieval():
     assert retrieved_sessions[1].id == created_session_2.id
 
 
+@pytest.mark.asyncio
+async def test_session_activity():
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    user_id = str(uuid1())
+    quiet_session = await client.create_session(user_id)
+    busy_session = await client.create_session(user_id)
+    assert busy_session.message_count == 0
+    assert busy_session.last_message_at is None
+    await busy_session.create_message(is_user=True, content="Hello")
+    await busy_session.create_messages([{"is_user": False, "content": "Hi"}, {"is_user": True, "content": "Bye"}])
+
+    retrieved_session = await client.get_session(user_id, busy_session.id)
+    assert retrieved_session.message_count == 3
+    assert retrieved_session.last_message_at is not None
+    response = await client.get_sessions(user_id, order_by="last_activity")
+    assert [session.id for session in response.items] == [busy_session.id, quiet_session.id]
+    await quiet_session.create_message(is_user=True, content="Hello")
+    response = await client.get_sessions(user_id, order_by="last_activity")
+    assert [session.id for session in response.items] == [quiet_session.id, busy_session.id]
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_session():
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    user_id = str(uuid1())
+    created_session = await client.get_or_create_session(user_id, "channel", {"foo": "bar"})
+    assert created_session.location_id == "channel"
+    assert created_session.metadata == {"foo": "bar"}
+    resolved_session = await client.get_or_create_session(user_id, "channel")
+    assert resolved_session.id == created_session.id
+    other_session = await client.get_or_create_session(user_id, "other")
+    assert other_session.id != created_session.id
+    await created_session.close()
+    new_session = await client.get_or_create_session(user_id, "channel")
+    assert new_session.id != created_session.id
+    assert new_session.is_active is True
+
+
 @pytest.mark.asyncio
 async def test_session_update():
     user_id = str(uuid1())
@@ -57,6 +132,35 @@ async def test_session_deletion():
     assert retrieved_session.id == created_session.id
 
 
+@pytest.mark.asyncio
+async def test_session_hard_deletion():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id)
+    await session.create_messages([{"is_user": True, "content": str(i)} for i in range(5)])
+    assert await session.delete() is None
+    with pytest.raises(Exception):
+        await client.get_session(user_id, session.id)
+
+    session = await client.create_session(user_id)
+    await session.create_messages([{"is_user": True, "content": str(i)} for i in range(5)])
+    job = await session.delete(background=True)
+    assert job.kind == "session"
+    assert job.total == 5
+    for _ in range(100):
+        job = await client.get_deletion_job(user_id, job.id)
+        if job.finished:
+            break
+        await asyncio.sleep(0.05)
+    assert job.status == "done"
+    assert job.deleted == 5
+    with pytest.raises(Exception):
+        await client.get_session(user_id, session.id)
+    response = await client.get_sessions(user_id)
+    assert response.items == []
+
+
 @pytest.mark.asyncio
 async def test_messages():
     user_id = str(uuid1())
@@ -74,6 +178,160 @@ async def test_messages():
     assert user_message.is_user is True
     assert ai_message.content == "Hi"
     assert ai_message.is_user is False
+    assert isinstance(user_message.id, UUID)
+    assert isinstance(user_message.created_at, datetime.datetime)
+    assert user_message.created_at <= ai_message.created_at
+
+@pytest.mark.asyncio
+async def test_message_seq():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id)
+    first = await session.create_message(is_user=True, content="Hello")
+    batch = await session.create_messages([{"is_user": False, "content": str(i)} for i in range(3)])
+    assert first.seq == 1
+    assert [message.seq for message in batch] == [2, 3, 4]
+
+    response = await session.get_messages(after_seq=2)
+    assert [message.seq for message in response.items] == [3, 4]
+    assert [message.content for message in response.items] == ["1", "2"]
+    assert [message.seq async for message in session.get_messages_generator(after_seq=first.seq)] == [2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_buffered_messages():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = await client.create_session(user_id)
+    created_session.enable_buffering(max_batch_size=3, flush_interval=60)
+    sent = []
+    for i in range(5):
+        sent.append(await created_session.create_message(is_user=i % 2 == 0, content=f"Hello {i}"))
+    await created_session.flush()
+    response = await created_session.get_messages()
+    messages = response.items
+    assert [message.content for message in messages] == [f"Hello {i}" for i in range(5)]
+    assert [str(message.id) for message in messages] == [str(message.id) for message in sent]
+    await created_session.create_message(is_user=True, content="Last")
+    await created_session.stop_buffering()
+    response = await created_session.get_messages()
+    assert len(response.items) == 6
+
+@pytest.mark.asyncio
+async def test_buffered_messages_retry():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id)
+    failures = []
+    buffer = session.enable_buffering(max_batch_size=10, flush_interval=60, on_error=lambda e, batch: failures.append(len(batch)))
+    send = session._send_messages
+
+    async def fail_once(batch):
+        session._send_messages = send
+        raise Exception("Connection lost")
+
+    session._send_messages = fail_once
+    sent = [await session.create_message(is_user=True, content=f"Hello {i}") for i in range(3)]
+    assert await session.flush() is False
+    assert failures == [3]
+    assert len(buffer) == 3
+    assert await session.flush() is True
+    assert len(buffer) == 0
+    await session.stop_buffering()
+
+    # Sending the same messages again stores nothing new
+    resent = await session._send_messages(sent)
+    assert [message.seq for message in resent] == [1, 2, 3]
+    response = await session.get_messages()
+    assert [message.content for message in response.items] == [f"Hello {i}" for i in range(3)]
+
+@pytest.mark.asyncio
+async def test_bulk_messages_and_sessions():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = await client.create_session(user_id)
+    results = await created_session.create_messages([{"is_user": i % 2 == 0, "content": f"Hello {i}"} for i in range(120)])
+    assert len(results) == 120
+    assert all(isinstance(result, Message) for result in results)
+    response = await created_session.get_messages(page=3, page_size=50)
+    assert [message.content for message in response.items] == [f"Hello {i}" for i in range(100, 120)]
+
+    other_session = await client.create_session(user_id)
+    sessions = await client.get_sessions_by_id(user_id, [other_session.id, str(uuid1()), created_session.id])
+    assert sessions[0].id == other_session.id
+    assert isinstance(sessions[1], Exception)
+    assert sessions[2].id == created_session.id
+
+@pytest.mark.asyncio
+async def test_compressed_requests():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000", request_compression="gzip")
+    created_session = await client.create_session(user_id)
+    content = "Hello " * 2000
+    await created_session.create_message(is_user=True, content=content)
+    response = await created_session.get_messages()
+    assert response.items[0].content == content
+
+@pytest.mark.asyncio
+async def test_conditional_requests():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = await client.create_session(user_id)
+    await created_session.create_message(is_user=True, content="Hello")
+    first = await created_session.get_messages()
+    second = await created_session.get_messages()
+    assert [message.id for message in first.items] == [message.id for message in second.items]
+    await created_session.create_message(is_user=False, content="Hi")
+    third = await created_session.get_messages()
+    assert [message.content for message in third.items] == ["Hello", "Hi"]
+    assert (await client.get_session(user_id, created_session.id)).metadata == {}
+    await created_session.update({"foo": "bar"})
+    retrieved_session = await client.get_session(user_id, created_session.id)
+    assert retrieved_session.metadata == {"foo": "bar"}
+
+@pytest.mark.asyncio
+async def test_session_events():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = await client.create_session(user_id)
+    first = await created_session.create_message(is_user=True, content="Hello")
+    metamessage = await created_session.create_metamessage(first, metamessage_type="thought", content="Greeting")
+    second = await created_session.create_message(is_user=False, content="Hi")
+    stream = created_session.events(last_event_id="0")
+    events = [await stream.__anext__() for _ in range(3)]
+    await stream.aclose()
+    assert [event.type for event in events] == ["message", "metamessage", "message"]
+    assert [event.item.id for event in events] == [first.id, metamessage.id, second.id]
+    resumed = created_session.events(last_event_id=events[1].id)
+    event = await resumed.__anext__()
+    await resumed.aclose()
+    assert event.item.id == second.id
+    assert event.item.content == "Hi"
+
+@pytest.mark.asyncio
+async def test_export_user(tmp_path):
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = await client.create_session(user_id)
+    message = await created_session.create_message(is_user=True, content="Hello")
+    await created_session.create_metamessage(message, metamessage_type="thought", content="Greeting")
+    await client.create_collection(user_id, "export")
+    path = tmp_path / "export.ndjson.gz"
+    written = await client.export_user(user_id, str(path), gzip=True)
+    assert written == path.stat().st_size
+    with gzip.open(path, "rt") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["type"] for record in records] == ["session", "message", "metamessage", "collection"]
+    assert records[1]["data"]["content"] == "Hello"
+    assert records[2]["data"]["session_id"] == str(created_session.id)
 
 @pytest.mark.asyncio
 async def test_rate_limit():
@@ -271,6 +529,85 @@ async def test_paginated_metamessages_generator():
         await gen.__anext__()
 
 
+@pytest.mark.asyncio
+async def test_user_metamessages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    sessions = [await client.create_session(user_id) for _ in range(2)]
+    for session in sessions:
+        message = await session.create_message(is_user=True, content="Hello")
+        for i in range(3):
+            await session.create_metamessage(message, metamessage_type="fact", content=f"Fact {i}")
+        await session.create_metamessage(message, metamessage_type="thought", content="Thought")
+
+    page = await client.get_user_metamessages(user_id, metamessage_type="fact", page_size=4)
+    assert len(page.items) == 4
+    assert page.next_cursor is not None
+    next_page = await page.next()
+    assert len(next_page.items) == 2
+    assert next_page.next_cursor is None
+    assert await next_page.next() is None
+
+    facts = [metamessage async for metamessage in client.get_user_metamessages_generator(user_id, metamessage_type="fact")]
+    assert [fact.content for fact in facts] == ["Fact 0", "Fact 1", "Fact 2"] * 2
+    assert [str(fact.session_id) for fact in facts] == [str(sessions[0].id)] * 3 + [str(sessions[1].id)] * 3
+    since = facts[3].created_at
+    recent = [metamessage async for metamessage in client.get_user_metamessages_generator(user_id, since=since)]
+    assert [metamessage.content for metamessage in recent] == ["Fact 0", "Fact 1", "Fact 2", "Thought"]
+
+
+@pytest.mark.asyncio
+async def test_search_messages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id, location_id="kitchen")
+    other = await client.create_session(user_id, location_id="garden")
+    await session.create_message(is_user=True, content="My cat likes tuna")
+    await session.create_message(is_user=False, content="Cats often like fish, tuna especially, tuna every day")
+    await session.create_message(is_user=True, content="Thanks for the help")
+    await other.create_message(is_user=True, content="The tuna sandwich was good")
+
+    page = await client.search_messages(user_id, "tuna", page_size=2)
+    assert len(page.items) == 2
+    assert all("<b>" in hit.snippet for hit in page.items)
+    assert page.items[0].rank >= page.items[1].rank
+    next_page = await page.next()
+    assert len(next_page.items) == 1
+    assert await next_page.next() is None
+
+    hits = [hit async for hit in client.search_messages_generator(user_id, "tuna")]
+    assert len({hit.id for hit in hits}) == 3
+    in_session = [hit async for hit in client.search_messages_generator(user_id, "tuna", session_id=session.id)]
+    assert {str(hit.session_id) for hit in in_session} == {str(session.id)}
+    in_garden = [hit async for hit in client.search_messages_generator(user_id, "tuna", location_id="garden")]
+    assert [hit.content for hit in in_garden] == ["The tuna sandwich was good"]
+    assert [hit async for hit in client.search_messages_generator(user_id, "thanks help")][0].content == "Thanks for the help"
+    assert [hit async for hit in client.search_messages_generator(user_id, "elephant")] == []
+
+    await session.create_message(is_user=True, content="<script>alert(1)</script> & more tuna")
+    escaped = [hit async for hit in client.search_messages_generator(user_id, "alert")]
+    assert escaped[0].snippet == "&lt;script&gt;<b>alert</b>(1)&lt;/script&gt; &amp; more tuna"
+
+
+@pytest.mark.asyncio
+async def test_search_messages_equal_rank_pages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = await client.create_session(user_id)
+    created = [await session.create_message(is_user=True, content="The tuna sandwich was good") for _ in range(5)]
+
+    page = await client.search_messages(user_id, "tuna", page_size=2)
+    assert len({hit.rank for hit in page.items}) == 1
+    hits = []
+    while page is not None:
+        hits.extend(page.items)
+        page = await page.next()
+    assert sorted(str(hit.id) for hit in hits) == sorted(str(message.id) for message in created)
+
+
 @pytest.mark.asyncio
 async def test_collections():
     col_name = str(uuid1())
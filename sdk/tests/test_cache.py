@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from honcho import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_none_values_are_cached():
+    cache = LRUCache(2)
+    missing = object()
+    cache.put("a", None)
+    assert cache.get("a", missing) is None
+    assert cache.get("b", missing) is missing
+    assert "a" in cache
+    assert "b" not in cache
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = LRUCache(10, ttl=5, clock=clock)
+    cache.put("a", 1)
+    cache.put("b", 2, ttl=20)
+    clock.now = 6
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    clock.now = 21
+    assert cache.get("b") is None
+    assert cache.stats()["expirations"] == 2
+
+
+def test_weight_bound():
+    cache = LRUCache(100, max_weight=10, weigher=lambda key, value: len(value))
+    cache.put("a", "xxxx")
+    cache.put("b", "xxxx")
+    cache.put("c", "xxxx")
+    assert "a" not in cache
+    assert cache.stats()["weight"] == 8
+    cache.put("d", "x" * 11)
+    assert "d" not in cache
+    assert len(cache) == 2
+
+
+def test_stats():
+    cache = LRUCache(10)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["hit_ratio"] == pytest.approx(2 / 3)
+
+
+def test_get_or_load_single_flight():
+    cache = LRUCache(10)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("a", loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ["value"] * 8
+
+
+def test_get_or_load_error_not_cached():
+    cache = LRUCache(10)
+
+    def loader():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_load("a", loader)
+    assert cache.get_or_load("a", lambda: 1) == 1
+
+
+@pytest.mark.asyncio
+async def test_aget_or_load_single_flight():
+    cache = LRUCache(10)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    results = await asyncio.gather(*[cache.aget_or_load("a", loader) for _ in range(8)])
+    assert len(calls) == 1
+    assert results == ["value"] * 8
+    assert await cache.aget_or_load("a", loader) == "value"
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_aget_or_load_leader_cancelled():
+    cache = LRUCache(10)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    leader = asyncio.ensure_future(cache.aget_or_load("a", loader))
+    await asyncio.sleep(0)
+    waiters = [asyncio.ensure_future(cache.aget_or_load("a", loader)) for _ in range(3)]
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await asyncio.gather(*waiters) == ["value"] * 3
+    assert leader.cancelled()
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_aget_or_load_retries_cancelled_load():
+    cache = LRUCache(10)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        if len(calls) == 1:
+            raise asyncio.CancelledError
+        return "value"
+
+    results = await asyncio.gather(*[cache.aget_or_load("a", loader) for _ in range(3)])
+    assert results == ["value"] * 3
+    assert len(calls) == 2
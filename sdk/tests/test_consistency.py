@@ -0,0 +1,30 @@
+import httpx
+
+from honcho.transport import ConsistencyTransport
+
+
+def make_client(tokens):
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request.headers.get("X-Honcho-Consistency"))
+        token = tokens.pop(0)
+        return httpx.Response(200, headers={"X-Honcho-Consistency": token} if token else {})
+
+    return httpx.Client(transport=ConsistencyTransport(httpx.MockTransport(handler))), seen
+
+
+def test_token_sent_after_write():
+    client, seen = make_client(["0/16B3D10", None, None])
+    client.post("http://honcho/write")
+    client.get("http://honcho/read")
+    client.get("http://honcho/read")
+    assert seen == [None, "0/16B3D10", "0/16B3D10"]
+
+
+def test_newest_token_wins():
+    client, seen = make_client(["1/0", "0/FFFFFFFF", None, None])
+    client.post("http://honcho/write")
+    client.post("http://honcho/write")
+    client.get("http://honcho/read")
+    assert seen == [None, "1/0", "1/0"]
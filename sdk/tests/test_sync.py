@@ -1,7 +1,13 @@
+import time
+import gzip
+import json
+
+import httpx
 import pytest
 from honcho import GetSessionPage, GetMessagePage, GetMetamessagePage, GetDocumentPage, Session, Message, Metamessage, Document
 from honcho import Client as Honcho
-from uuid import uuid1
+from uuid import uuid1, UUID
+import datetime
 
 
 def test_session_creation_retrieval():
@@ -16,6 +22,33 @@ def test_session_creation_retrieval():
     assert retrieved_session.metadata == {}
 
 
+def test_client_close():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    with Honcho(app_id, "http://localhost:8000") as client:
+        created_session = client.create_session(user_id)
+        retrieved = client.get_sessions_by_id(user_id, [created_session.id])
+        assert retrieved[0].id == created_session.id
+    assert client.client.is_closed
+
+
+def test_closed_session_rejects_writes():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id)
+    message = session.create_message(is_user=True, content="Hello")
+    # A copy that still thinks the session is active, so the requests reach the server
+    stale = client.get_session(user_id, session.id)
+    session.close()
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        stale.create_message(is_user=True, content="Hello again")
+    assert excinfo.value.response.status_code == 404
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        stale.create_metamessage(message, metamessage_type="thought", content="Too late")
+    assert excinfo.value.response.status_code == 404
+
+
 def test_session_multiple_retrieval():
     app_id = str(uuid1())
     client = Honcho(app_id, "http://localhost:8000")
@@ -30,6 +63,44 @@ def test_session_multiple_retrieval():
     assert retrieved_sessions[1].id == created_session_2.id
 
 
+def test_session_activity():
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    user_id = str(uuid1())
+    quiet_session = client.create_session(user_id)
+    busy_session = client.create_session(user_id)
+    assert busy_session.message_count == 0
+    assert busy_session.last_message_at is None
+    busy_session.create_message(is_user=True, content="Hello")
+    busy_session.create_messages([{"is_user": False, "content": "Hi"}, {"is_user": True, "content": "Bye"}])
+
+    retrieved_session = client.get_session(user_id, busy_session.id)
+    assert retrieved_session.message_count == 3
+    assert retrieved_session.last_message_at is not None
+    response = client.get_sessions(user_id, order_by="last_activity")
+    assert [session.id for session in response.items] == [busy_session.id, quiet_session.id]
+    quiet_session.create_message(is_user=True, content="Hello")
+    response = client.get_sessions(user_id, order_by="last_activity")
+    assert [session.id for session in response.items] == [quiet_session.id, busy_session.id]
+
+
+def test_get_or_create_session():
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    user_id = str(uuid1())
+    created_session = client.get_or_create_session(user_id, "channel", {"foo": "bar"})
+    assert created_session.location_id == "channel"
+    assert created_session.metadata == {"foo": "bar"}
+    resolved_session = client.get_or_create_session(user_id, "channel")
+    assert resolved_session.id == created_session.id
+    other_session = client.get_or_create_session(user_id, "other")
+    assert other_session.id != created_session.id
+    created_session.close()
+    new_session = client.get_or_create_session(user_id, "channel")
+    assert new_session.id != created_session.id
+    assert new_session.is_active is True
+
+
 def test_session_update():
     user_id = str(uuid1())
     app_id = str(uuid1())
@@ -53,6 +124,34 @@ def test_session_deletion():
     assert retrieved_session.id == created_session.id
 
 
+def test_session_hard_deletion():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id)
+    session.create_messages([{"is_user": True, "content": str(i)} for i in range(5)])
+    assert session.delete() is None
+    with pytest.raises(Exception):
+        client.get_session(user_id, session.id)
+
+    session = client.create_session(user_id)
+    session.create_messages([{"is_user": True, "content": str(i)} for i in range(5)])
+    job = session.delete(background=True)
+    assert job.kind == "session"
+    assert job.total == 5
+    for _ in range(100):
+        job = client.get_deletion_job(user_id, job.id)
+        if job.finished:
+            break
+        time.sleep(0.05)
+    assert job.status == "done"
+    assert job.deleted == 5
+    with pytest.raises(Exception):
+        client.get_session(user_id, session.id)
+    response = client.get_sessions(user_id)
+    assert response.items == []
+
+
 def test_messages():
     user_id = str(uuid1())
     app_id = str(uuid1())
@@ -69,6 +168,152 @@ def test_messages():
     assert user_message.is_user is True
     assert ai_message.content == "Hi"
     assert ai_message.is_user is False
+    assert isinstance(user_message.id, UUID)
+    assert isinstance(user_message.created_at, datetime.datetime)
+    assert user_message.created_at <= ai_message.created_at
+
+def test_message_seq():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id)
+    first = session.create_message(is_user=True, content="Hello")
+    batch = session.create_messages([{"is_user": False, "content": str(i)} for i in range(3)])
+    assert first.seq == 1
+    assert [message.seq for message in batch] == [2, 3, 4]
+
+    response = session.get_messages(after_seq=2)
+    assert [message.seq for message in response.items] == [3, 4]
+    assert [message.content for message in response.items] == ["1", "2"]
+    assert [message.seq for message in session.get_messages_generator(after_seq=first.seq)] == [2, 3, 4]
+
+
+def test_buffered_messages():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = client.create_session(user_id)
+    created_session.enable_buffering(max_batch_size=3, flush_interval=60)
+    sent = []
+    for i in range(5):
+        sent.append(created_session.create_message(is_user=i % 2 == 0, content=f"Hello {i}"))
+    created_session.flush()
+    response = created_session.get_messages()
+    messages = response.items
+    assert [message.content for message in messages] == [f"Hello {i}" for i in range(5)]
+    assert [str(message.id) for message in messages] == [str(message.id) for message in sent]
+    created_session.create_message(is_user=True, content="Last")
+    created_session.stop_buffering()
+    response = created_session.get_messages()
+    assert len(response.items) == 6
+
+def test_buffered_messages_retry():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id)
+    failures = []
+    buffer = session.enable_buffering(max_batch_size=10, flush_interval=60, on_error=lambda e, batch: failures.append(len(batch)))
+    send = session._send_messages
+
+    def fail_once(batch):
+        session._send_messages = send
+        raise Exception("Connection lost")
+
+    session._send_messages = fail_once
+    sent = [session.create_message(is_user=True, content=f"Hello {i}") for i in range(3)]
+    assert session.flush() is False
+    assert failures == [3]
+    assert len(buffer) == 3
+    assert session.flush() is True
+    assert len(buffer) == 0
+    session.stop_buffering()
+
+    # Sending the same messages again stores nothing new
+    resent = session._send_messages(sent)
+    assert [message.seq for message in resent] == [1, 2, 3]
+    response = session.get_messages()
+    assert [message.content for message in response.items] == [f"Hello {i}" for i in range(3)]
+
+def test_bulk_messages_and_sessions():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = client.create_session(user_id)
+    results = created_session.create_messages([{"is_user": i % 2 == 0, "content": f"Hello {i}"} for i in range(120)])
+    assert len(results) == 120
+    assert all(isinstance(result, Message) for result in results)
+    response = created_session.get_messages(page=3, page_size=50)
+    assert [message.content for message in response.items] == [f"Hello {i}" for i in range(100, 120)]
+
+    other_session = client.create_session(user_id)
+    sessions = client.get_sessions_by_id(user_id, [other_session.id, str(uuid1()), created_session.id])
+    assert sessions[0].id == other_session.id
+    assert isinstance(sessions[1], Exception)
+    assert sessions[2].id == created_session.id
+
+def test_compressed_requests():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000", request_compression="gzip")
+    created_session = client.create_session(user_id)
+    content = "Hello " * 2000
+    created_session.create_message(is_user=True, content=content)
+    response = created_session.get_messages()
+    assert response.items[0].content == content
+
+def test_conditional_requests():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = client.create_session(user_id)
+    created_session.create_message(is_user=True, content="Hello")
+    first = created_session.get_messages()
+    second = created_session.get_messages()
+    assert [message.id for message in first.items] == [message.id for message in second.items]
+    created_session.create_message(is_user=False, content="Hi")
+    third = created_session.get_messages()
+    assert [message.content for message in third.items] == ["Hello", "Hi"]
+    assert (client.get_session(user_id, created_session.id)).metadata == {}
+    created_session.update({"foo": "bar"})
+    retrieved_session = client.get_session(user_id, created_session.id)
+    assert retrieved_session.metadata == {"foo": "bar"}
+
+def test_session_events():
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = client.create_session(user_id)
+    first = created_session.create_message(is_user=True, content="Hello")
+    metamessage = created_session.create_metamessage(first, metamessage_type="thought", content="Greeting")
+    second = created_session.create_message(is_user=False, content="Hi")
+    stream = created_session.events(last_event_id="0")
+    events = [stream.__next__() for _ in range(3)]
+    stream.close()
+    assert [event.type for event in events] == ["message", "metamessage", "message"]
+    assert [event.item.id for event in events] == [first.id, metamessage.id, second.id]
+    resumed = created_session.events(last_event_id=events[1].id)
+    event = resumed.__next__()
+    resumed.close()
+    assert event.item.id == second.id
+    assert event.item.content == "Hi"
+
+def test_export_user(tmp_path):
+    user_id = str(uuid1())
+    app_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    created_session = client.create_session(user_id)
+    message = created_session.create_message(is_user=True, content="Hello")
+    created_session.create_metamessage(message, metamessage_type="thought", content="Greeting")
+    client.create_collection(user_id, "export")
+    path = tmp_path / "export.ndjson.gz"
+    written = client.export_user(user_id, str(path), gzip=True)
+    assert written == path.stat().st_size
+    with gzip.open(path, "rt") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["type"] for record in records] == ["session", "message", "metamessage", "collection"]
+    assert records[1]["data"]["content"] == "Hello"
+    assert records[2]["data"]["session_id"] == str(created_session.id)
 
 def test_rate_limit():
     app_id = str(uuid1())
@@ -257,6 +502,82 @@ def test_paginated_metamessages_generator():
         gen.__next__()
 
 
+def test_user_metamessages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    sessions = [client.create_session(user_id) for _ in range(2)]
+    for session in sessions:
+        message = session.create_message(is_user=True, content="Hello")
+        for i in range(3):
+            session.create_metamessage(message, metamessage_type="fact", content=f"Fact {i}")
+        session.create_metamessage(message, metamessage_type="thought", content="Thought")
+
+    page = client.get_user_metamessages(user_id, metamessage_type="fact", page_size=4)
+    assert len(page.items) == 4
+    assert page.next_cursor is not None
+    next_page = page.next()
+    assert len(next_page.items) == 2
+    assert next_page.next_cursor is None
+    assert next_page.next() is None
+
+    facts = [metamessage for metamessage in client.get_user_metamessages_generator(user_id, metamessage_type="fact")]
+    assert [fact.content for fact in facts] == ["Fact 0", "Fact 1", "Fact 2"] * 2
+    assert [str(fact.session_id) for fact in facts] == [str(sessions[0].id)] * 3 + [str(sessions[1].id)] * 3
+    since = facts[3].created_at
+    recent = [metamessage for metamessage in client.get_user_metamessages_generator(user_id, since=since)]
+    assert [metamessage.content for metamessage in recent] == ["Fact 0", "Fact 1", "Fact 2", "Thought"]
+
+
+def test_search_messages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id, location_id="kitchen")
+    other = client.create_session(user_id, location_id="garden")
+    session.create_message(is_user=True, content="My cat likes tuna")
+    session.create_message(is_user=False, content="Cats often like fish, tuna especially, tuna every day")
+    session.create_message(is_user=True, content="Thanks for the help")
+    other.create_message(is_user=True, content="The tuna sandwich was good")
+
+    page = client.search_messages(user_id, "tuna", page_size=2)
+    assert len(page.items) == 2
+    assert all("<b>" in hit.snippet for hit in page.items)
+    assert page.items[0].rank >= page.items[1].rank
+    next_page = page.next()
+    assert len(next_page.items) == 1
+    assert next_page.next() is None
+
+    hits = [hit for hit in client.search_messages_generator(user_id, "tuna")]
+    assert len({hit.id for hit in hits}) == 3
+    in_session = [hit for hit in client.search_messages_generator(user_id, "tuna", session_id=session.id)]
+    assert {str(hit.session_id) for hit in in_session} == {str(session.id)}
+    in_garden = [hit for hit in client.search_messages_generator(user_id, "tuna", location_id="garden")]
+    assert [hit.content for hit in in_garden] == ["The tuna sandwich was good"]
+    assert [hit for hit in client.search_messages_generator(user_id, "thanks help")][0].content == "Thanks for the help"
+    assert [hit for hit in client.search_messages_generator(user_id, "elephant")] == []
+
+    session.create_message(is_user=True, content="<script>alert(1)</script> & more tuna")
+    escaped = [hit for hit in client.search_messages_generator(user_id, "alert")]
+    assert escaped[0].snippet == "&lt;script&gt;<b>alert</b>(1)&lt;/script&gt; &amp; more tuna"
+
+
+def test_search_messages_equal_rank_pages():
+    app_id = str(uuid1())
+    user_id = str(uuid1())
+    client = Honcho(app_id, "http://localhost:8000")
+    session = client.create_session(user_id)
+    created = [session.create_message(is_user=True, content="The tuna sandwich was good") for _ in range(5)]
+
+    page = client.search_messages(user_id, "tuna", page_size=2)
+    assert len({hit.rank for hit in page.items}) == 1
+    hits = []
+    while page is not None:
+        hits.extend(page.items)
+        page = page.next()
+    assert sorted(str(hit.id) for hit in hits) == sorted(str(message.id) for message in created)
+
+
 def test_collections():
     col_name = str(uuid1())
     app_id = str(uuid1())
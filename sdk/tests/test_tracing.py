@@ -0,0 +1,25 @@
+from honcho import tracing
+
+
+def test_inject_outside_trace():
+    headers = {}
+    tracing.inject(headers)
+    assert "traceparent" not in headers
+
+
+def test_inject_in_trace():
+    with tracing.trace() as trace_id:
+        first, second = {}, {}
+        tracing.inject(first)
+        tracing.inject(second)
+    version, first_trace, first_span, flags = first["traceparent"].split("-")
+    assert (version, first_trace, flags) == ("00", trace_id, "01")
+    assert second["traceparent"].split("-")[1] == trace_id
+    assert second["traceparent"].split("-")[2] != first_span
+
+
+def test_inject_keeps_existing_traceparent():
+    headers = {"traceparent": "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"}
+    with tracing.trace():
+        tracing.inject(headers)
+    assert headers["traceparent"] == "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"